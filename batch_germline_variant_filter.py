@@ -0,0 +1,299 @@
+from utils.utils import *
+from utils.pipeline_utils import *
+import logging
+import argparse
+import multiprocessing
+import multiprocessing.connection
+import csv
+import sys
+
+########################################################################################################################################################
+# Parse Arguments
+########################################################################################################################################################
+
+def get_parser():
+	"""
+	The command line arguments.
+
+	"""
+
+	parser = argparse.ArgumentParser(
+		formatter_class=argparse.RawTextHelpFormatter,
+		description='Run the germline variant filter on a batch of worksheets, loading the reference data once. See readme for details.')
+
+	parser.add_argument('--config', type=str, nargs=1, required=True,
+						help='Filepath to YAML config file. See config/ directory for an example of what these look like.')
+
+	parser.add_argument('--manifest', type=str, nargs=1, required=True,
+						help='Filepath to a TSV file with the columns input, ped, worksheet, results_dir and optionally patient_hpos - one row per job.')
+
+	parser.add_argument('--summary', type=str, nargs=1, required=True,
+						help='Where to write the TSV summary of the timings and outcome of each job.')
+
+	parser.add_argument('--panelapp', action='store_true',
+						help='Whether to add PanelApp annotations. Default = False.')
+
+	parser.add_argument('--local-panel-app-dump', type=str, nargs=1,
+						help='Filepath local panelapp store.')
+
+	parser.add_argument('--panel-app-cache', type=str, nargs=1,
+						help='Filepath to a SQLite PanelApp cache to use instead of the local panelapp store. If --local-panel-app-dump is also given it is imported into the cache the first time.')
+
+	parser.add_argument('--csq', type=str, nargs=1,
+						help='The VEP CSQ string. Required if any of the inputs are CSV files, read from the VCF header for VCF inputs if not given.')
+
+	parser.add_argument('--spliceai', action='store_true',
+						help='Attempt to parse SpliceAI annotations added by VEP. Default = False.')
+
+	parser.add_argument('--smart-synonymous', action='store_true',
+						help='Smart synonymous variant filtering. See readme for details. Default = False.')
+
+	parser.add_argument('--add-ccrs', action='store_true',
+						help='Add the CCR annotations from VEP. Default = False.')
+
+	parser.add_argument('--gnomad-constraint-scores', action='store_true',
+						help='Add the per gene gnomad constraint scores. Default = False.')
+
+	parser.add_argument('--chunk-size', type=int, nargs=1,
+						help='Read each input in chunks of this many variants to limit memory use. Default = read the whole file at once.')
+
+	parser.add_argument('--regions', type=str, nargs=1,
+						help='BED file of the regions to filter in every job e.g. a virtual panel. Variants outside the regions are dropped as each input is read. Default = all variants.')
+
+	parser.add_argument('--no-compact-dtypes', action='store_true',
+						help='Keep the repeated string columns e.g. Consequence and SYMBOL as plain strings rather than categoricals. Uses more memory. Default = False.')
+
+	parser.add_argument('--cache-dir', type=str, nargs=1,
+						help='Directory to cache the filtered variants in so that reruns with the same input skip the variant level filtering. Samples whose output would not change are also skipped. Default = no cache.')
+
+	parser.add_argument('--cache-max-size', type=float, nargs=1, default=[10.0],
+						help='Remove the least recently used entries from the cache when it gets bigger than this many GB. Default = 10.')
+
+	parser.add_argument('--metrics', action='store_true',
+						help='Write the time, memory and number of variants going in and out of each stage of each job to metrics.json in its results directory. Default = False.')
+
+	parser.add_argument('--profile', action='store_true',
+						help='Profile each stage of each job with cProfile and write the profiles and a report of the slowest functions to the profile directory in its results directory. Default = False.')
+
+	parser.add_argument('--profile-memory', action='store_true',
+						help='Also record the peak memory allocated in each stage with tracemalloc when profiling. Makes the run much slower. Default = False.')
+
+	parser.add_argument('--profile-top', type=int, nargs=1, default=[20],
+						help='Number of functions to show for each stage in the profile report. Default = 20.')
+
+	parser.add_argument('--jobs', type=int, nargs=1, default=[1],
+						help='Number of jobs to run at the same time. Default = 1.')
+
+	parser.add_argument('--max-memory', type=float, nargs=1,
+						help='Do not start a job if the estimated memory of the running jobs would go over this many GB. Default = no limit.')
+
+	parser.add_argument('--memory-factor', type=float, nargs=1, default=[10.0],
+						help='Estimated peak memory of a job as a multiple of its uncompressed input size. Default = 10.')
+
+	return parser
+
+
+def main(argv=None):
+	"""
+	Run the filter on each job in the manifest with the command line arguments in argv.
+
+	Exits with status 1 if any of the jobs failed.
+
+	"""
+
+	args = get_parser().parse_args(argv)
+
+	jobs = args.jobs[0]
+	max_memory = args.max_memory[0] if args.max_memory != None else None
+	local_panel_app_dump = args.local_panel_app_dump[0] if args.local_panel_app_dump != None else None
+	panel_app_cache = args.panel_app_cache[0] if args.panel_app_cache != None else None
+
+	if jobs < 1:
+
+		raise Exception('The number of jobs must be at least 1.')
+
+	####################################################################################################################################################
+	# Parse Config and Manifest
+	####################################################################################################################################################
+
+	config_dict = parse_config(args.config[0])
+
+	manifest_jobs = parse_batch_manifest(args.manifest[0])
+
+	add_hpo = any(manifest_job.get('patient_hpos') != None for manifest_job in manifest_jobs)
+
+	# Build the options for each job in the same way as germline_variant_filter.py
+	batch_jobs = []
+	summaries = {}
+
+	for job_id, manifest_job in enumerate(manifest_jobs, start=1):
+
+		input_file = manifest_job['input']
+		is_vcf = input_file.endswith(('.vcf', '.vcf.gz'))
+
+		try:
+
+			options = get_options(
+				csv_file = None if is_vcf else input_file,
+				vcf_file = input_file if is_vcf else None,
+				ped_file = manifest_job['ped'],
+				csq_desc = args.csq[0] if args.csq != None else None,
+				parse_splice_ai = args.spliceai,
+				smart_synonymous_filtering = args.smart_synonymous,
+				add_ccrs = args.add_ccrs,
+				add_gnomad_constraint_scores = args.gnomad_constraint_scores,
+				add_panel_app_info = args.panelapp,
+				local_panel_app_dump = local_panel_app_dump,
+				panel_app_cache = panel_app_cache,
+				patient_hpos = manifest_job.get('patient_hpos'),
+				worksheet = manifest_job['worksheet'],
+				results_dir = manifest_job['results_dir'],
+				chunk_size = args.chunk_size[0] if args.chunk_size != None else None,
+				regions = args.regions[0] if args.regions != None else None,
+				workers = 1,
+				compact_dtypes = args.no_compact_dtypes == False,
+				cache_dir = args.cache_dir[0] if args.cache_dir != None else None,
+				cache_max_size = args.cache_max_size[0],
+				metrics_json = f"{manifest_job['results_dir']}/metrics.json" if args.metrics == True else None,
+				profile_dir = f"{manifest_job['results_dir']}/profile" if args.profile == True else None,
+				profile_memory = args.profile_memory,
+				profile_top = args.profile_top[0]
+				)
+
+			job_args = argparse.Namespace(**vars(args))
+			job_args.csq = ['|'.join(options['csq_desc'])]
+			job_args.patient_hpos = [options['patient_hpos']] if options['patient_hpos'] != None else None
+
+			if are_arguments_valid(job_args, config_dict) == False:
+
+				raise Exception('Invalid command line options.')
+
+			memory = estimate_job_memory(input_file, args.memory_factor[0])
+
+		except Exception as e:
+
+			logger.error(f'Job {job_id} failed: {e}')
+			summaries[job_id] = {'job_id': job_id, 'worksheet': manifest_job['worksheet'], 'input': input_file, 'status': 'FAILED', 'error': str(e), 'no_variants_samples': '', 'seconds': 0.0}
+			continue
+
+		batch_jobs.append((job_id, options, memory))
+
+	####################################################################################################################################################
+	# Load shared data once for all jobs
+	####################################################################################################################################################
+
+	resources = load_resources(config_dict, args.gnomad_constraint_scores, args.panelapp, local_panel_app_dump, add_hpo, panel_app_cache)
+
+	worker_state['config_dict'] = config_dict
+	worker_state['resources'] = resources
+
+	####################################################################################################################################################
+	# Run the jobs
+	####################################################################################################################################################
+
+	panel_app_updates = {}
+
+	# The summary is written even if the batch stops part way through
+	try:
+
+		# Each job runs in its own forked process which shares the resources loaded above - a job whose process dies only fails that job
+		pending = list(batch_jobs)
+		running = {}
+
+		while len(pending) > 0 or len(running) > 0:
+
+			# Start jobs while we have free slots and enough memory - a job is always started if nothing else is running
+			while len(pending) > 0 and len(running) < jobs:
+
+				job_id, options, memory = pending[0]
+
+				running_memory = sum(running_job['memory'] for running_job in running.values())
+
+				if max_memory != None and len(running) > 0 and running_memory + memory > max_memory:
+
+					break
+
+				pending.pop(0)
+
+				try:
+
+					running_job = start_batch_job(job_id, options)
+
+				except Exception as e:
+
+					logger.error(f'Job {job_id} failed: {e}')
+					summaries[job_id] = new_batch_summary(job_id, options)
+					summaries[job_id].update({'status': 'FAILED', 'error': str(e), 'seconds': 0.0})
+					continue
+
+				running_job['memory'] = memory
+				running[running_job['receiver']] = running_job
+
+			for connection in multiprocessing.connection.wait(list(running)):
+
+				running_job = running.pop(connection)
+
+				summaries[running_job['job_id']], panel_app_updates[running_job['job_id']] = finish_batch_job(running_job)
+
+		# Merge PanelApp data fetched by each job in manifest order
+		if args.panelapp == True:
+
+			for job_id in sorted(panel_app_updates):
+
+				resources['panel_app_dict'].update(panel_app_updates[job_id])
+
+		################################################################################################################################################
+		# Clean up
+		################################################################################################################################################
+
+		# Write panel app data to the local dump or cache if requested
+		if args.panelapp == True:
+
+			save_panel_app_data(resources, config_dict, local_panel_app_dump, panel_app_cache)
+
+	finally:
+
+		for job_id, options, memory in batch_jobs:
+
+			if job_id not in summaries:
+
+				summaries[job_id] = new_batch_summary(job_id, options)
+				summaries[job_id].update({'status': 'FAILED', 'error': 'The batch stopped before the job finished.', 'seconds': 0.0})
+
+		with open(args.summary[0], 'w') as f:
+
+			summary_fields = ['job_id', 'worksheet', 'input', 'status', 'seconds', 'no_variants_samples', 'error']
+
+			writer = csv.DictWriter(f, fieldnames=summary_fields, delimiter='\t')
+			writer.writeheader()
+
+			for job_id in sorted(summaries):
+
+				writer.writerow(summaries[job_id])
+
+	failed_jobs = [job_id for job_id in summaries if summaries[job_id]['status'] != 'SUCCESS']
+
+	logger.info(f'Finished {len(summaries)} jobs - {len(failed_jobs)} failed.')
+
+	if len(failed_jobs) > 0:
+
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+
+	####################################################################################################################################################
+	# Set up Logger
+	####################################################################################################################################################
+
+	logger = logging.getLogger('germline_variant_filter')
+	logger.setLevel(logging.DEBUG)
+	handler = logging.StreamHandler()
+	handler.setLevel(logging.DEBUG)
+	formatter = logging.Formatter(
+		'%(levelname)s\t%(asctime)s\t%(name)s\t%(message)s'
+	)
+	handler.setFormatter(formatter)
+	logger.addHandler(handler)
+
+	main()
@@ -0,0 +1,529 @@
+"""
+Benchmarks for the germline variant filter.
+
+Generates synthetic GATK VariantsToTable style inputs, times each stage of the filter on them and \
+compares the timings and peak memory with a saved baseline.
+
+Generate an input:
+
+python benchmarks/benchmark.py generate --variants 50000 --trios 1 --out bench_data
+
+Run the benchmarks and save the results as a baseline:
+
+python benchmarks/benchmark.py run --sizes panel exome --out baseline.json
+
+Compare a later run with the baseline - exits with status 1 if anything has got slower:
+
+python benchmarks/benchmark.py compare baseline.json current.json
+
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.utils import *
+from utils.pipeline_utils import *
+import argparse
+import datetime
+import json
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import yaml
+
+# The sizes which can be given to run - from a small gene panel up to a whole genome
+benchmark_sizes = {
+	'panel': {'variants': 2000, 'trios': 1, 'singles': 0, 'transcripts': 3, 'density': 0.5},
+	'exome': {'variants': 50000, 'trios': 1, 'singles': 1, 'transcripts': 4, 'density': 0.5},
+	'multi_exome': {'variants': 50000, 'trios': 3, 'singles': 2, 'transcripts': 4, 'density': 0.5},
+	'genome': {'variants': 4000000, 'trios': 1, 'singles': 0, 'transcripts': 6, 'density': 0.3},
+}
+
+# The stages timed by run_filter in the order they run
+benchmark_stages = ['load_resources', 'read', 'qc', 'frequency_prefilter', 'genotypes', 'csq_split', 'frequency', 'variant_id', 'splice_ai', 'consequence',
+	'transcript_annotation', 'workflow', 'sample_annotation', 'write']
+
+benchmark_csq_desc = ['Allele', 'Consequence', 'IMPACT', 'SYMBOL', 'Gene', 'Feature_type', 'Feature', 'BIOTYPE', 'EXON', 'INTRON',
+	'HGVSc', 'HGVSp', 'Existing_variation', 'PICK', 'SIFT', 'PolyPhen', 'CLIN_SIG', 'gnomADg_AF_POPMAX', 'gnomADe_AF_POPMAX',
+	'ccrs', 'SpliceAI_DS_AG', 'SpliceAI_DS_AL', 'SpliceAI_DS_DG', 'SpliceAI_DS_DL', 'SpliceAI_SYMBOL']
+
+# Roughly the mix of consequences seen in a whole genome - most variants are intronic or intergenic
+benchmark_consequences = [('intron_variant', 30), ('upstream_gene_variant', 10), ('downstream_gene_variant', 10),
+	('intergenic_variant', 10), ('non_coding_transcript_variant&intron_variant', 8), ('3_prime_UTR_variant', 5),
+	('5_prime_UTR_variant', 2), ('synonymous_variant', 6), ('missense_variant', 8), ('splice_region_variant&intron_variant', 3),
+	('splice_region_variant&synonymous_variant', 1), ('stop_gained', 1), ('frameshift_variant', 1), ('inframe_deletion', 1),
+	('splice_donor_variant', 1), ('start_lost', 1), ('regulatory_region_variant', 2)]
+
+benchmark_chroms = [str(chrom) for chrom in range(1, 23)] + ['X', 'Y', 'MT']
+
+
+def get_benchmark_samples(trios, singles):
+	"""
+	Names of the samples and the PED rows for a number of trios and single samples.
+
+	"""
+
+	samples = []
+	ped_rows = []
+
+	for trio in range(trios):
+
+		family = f'FAM{trio}'
+
+		samples = samples + [f'proband{trio}', f'father{trio}', f'mother{trio}']
+		ped_rows.append([family, f'proband{trio}', f'father{trio}', f'mother{trio}', str(1 + trio % 2), '2'])
+		ped_rows.append([family, f'father{trio}', '0', '0', '1', '1'])
+		ped_rows.append([family, f'mother{trio}', '0', '0', '2', '1'])
+
+	for single in range(singles):
+
+		samples.append(f'single{single}')
+		ped_rows.append([f'SINGLE{single}', f'single{single}', '0', '0', str(1 + single % 2), '2'])
+
+	return samples, ped_rows
+
+
+def generate_frequency(rng, density):
+	"""
+	A gnomAD AF_POPMAX value - most variants are common and some have two values e.g. 0.001&0.3
+
+	"""
+
+	if rng.random() > density:
+
+		return '.'
+
+	frequency = rng.choice(['0.00001', '0.0001', '0.0005', '0.002', '0.008', '0.02', '0.1', '0.3', '0.45', '0.5'])
+
+	if rng.random() < 0.05:
+
+		return frequency + '&' + rng.choice(['.', '0.0004', '0.2'])
+
+	return frequency
+
+
+def generate_splice_ai(rng, density):
+	"""
+	A set of SpliceAI scores for a transcript.
+
+	"""
+
+	if rng.random() > density:
+
+		return ['.', '.', '.', '.']
+
+	return [f'0.{rng.randint(0, 99):02d}' for i in range(4)]
+
+
+def generate_benchmark_data(out_dir, variants, trios=1, singles=0, transcripts=4, density=0.5, seed=1):
+	"""
+	Write a synthetic input and the files needed to run the filter on it to out_dir.
+
+	variants = number of rows in the input
+	trios = number of trios in the PED file
+	singles = number of samples analysed on their own
+	transcripts = the most transcripts in a CSQ field - each variant gets between 1 and this many
+	density = fraction of the optional annotations (gnomAD, SpliceAI, ClinVar, CCRs, SIFT, PolyPhen, HGVS) which are filled in
+
+	Returns a dictionary of the files written.
+
+	"""
+
+	os.makedirs(out_dir, exist_ok=True)
+
+	rng = random.Random(seed)
+
+	samples, ped_rows = get_benchmark_samples(trios, singles)
+
+	n_genes = max(50, variants // 50)
+	genes = [(f'GENE{gene}', str(10000 + gene)) for gene in range(n_genes)]
+
+	consequences = [consequence for consequence, weight in benchmark_consequences for i in range(weight)]
+
+	files = {}
+	files['input'] = os.path.join(out_dir, 'input.tsv')
+	files['ped'] = os.path.join(out_dir, 'family.ped')
+	files['csq'] = os.path.join(out_dir, 'csq.txt')
+	files['hpo'] = os.path.join(out_dir, 'hpo.txt')
+	files['constraint'] = os.path.join(out_dir, 'constraint.txt')
+	files['patient_hpos'] = os.path.join(out_dir, 'patient_hpos.tsv')
+	files['panel_app'] = os.path.join(out_dir, 'panelapp.tsv')
+	files['config'] = os.path.join(out_dir, 'config.yaml')
+
+	header = ['CHROM', 'POS', 'REF', 'ALT', 'ID', 'QUAL', 'FILTER', 'CSQ', 'AC'] + [f'{sample}.{field}' for sample in samples for field in ['GT', 'GQ', 'DP']]
+
+	# Coordinate sorted like a real input
+	chrom_variants = sorted(rng.randrange(len(benchmark_chroms)) for i in range(variants))
+
+	with open(files['input'], 'w') as f:
+
+		f.write('\t'.join(header) + '\n')
+
+		pos = 0
+		last_chrom = None
+
+		for chrom_index in chrom_variants:
+
+			chrom = benchmark_chroms[chrom_index]
+
+			if chrom != last_chrom:
+
+				pos = 0
+				last_chrom = chrom
+
+			pos = pos + rng.randint(1, 2000)
+
+			ref, alt = rng.sample('ACGT', 2)
+
+			gnomadg = generate_frequency(rng, density)
+			gnomade = generate_frequency(rng, density)
+
+			gene_index = rng.randrange(n_genes)
+
+			blocks = []
+
+			for transcript in range(rng.randint(1, transcripts)):
+
+				symbol, gene_id = genes[(gene_index + transcript // 3) % n_genes]
+
+				annotated = rng.random() < density
+
+				splice_ai = generate_splice_ai(rng, density)
+
+				block = {
+					'Allele': alt,
+					'Consequence': rng.choice(consequences),
+					'IMPACT': 'MODIFIER',
+					'SYMBOL': symbol,
+					'Gene': gene_id,
+					'Feature_type': 'Transcript',
+					'Feature': f'NM_{int(gene_id) * 10 + transcript % 3}.{rng.randint(1, 3)}',
+					'BIOTYPE': 'protein_coding',
+					'EXON': f'{rng.randint(1, 20)}/20' if annotated else '.',
+					'INTRON': f'{rng.randint(1, 19)}/19' if not annotated else '.',
+					'HGVSc': f'NM_{gene_id}.1:c.{rng.randint(1, 5000)}{ref}>{alt}' if annotated else '.',
+					'HGVSp': f'NP_{gene_id}.1:p.Ala{rng.randint(1, 1500)}Thr' if annotated else '.',
+					'Existing_variation': f'rs{rng.randint(1, 10 ** 8)}' if rng.random() < density else '.',
+					'PICK': '1' if transcript == 0 else '.',
+					'SIFT': rng.choice(['deleterious(0.01)', 'tolerated(0.3)']) if annotated else '.',
+					'PolyPhen': rng.choice(['benign(0.1)', 'probably_damaging(0.99)']) if annotated else '.',
+					'CLIN_SIG': rng.choice(['pathogenic', 'benign', 'uncertain_significance', 'likely_pathogenic&benign']) if rng.random() < density / 5 else '.',
+					'gnomADg_AF_POPMAX': gnomadg,
+					'gnomADe_AF_POPMAX': gnomade,
+					'ccrs': f'{rng.uniform(0, 100):.2f}' if annotated else '.',
+					'SpliceAI_DS_AG': splice_ai[0],
+					'SpliceAI_DS_AL': splice_ai[1],
+					'SpliceAI_DS_DG': splice_ai[2],
+					'SpliceAI_DS_DL': splice_ai[3],
+					'SpliceAI_SYMBOL': symbol if splice_ai[0] != '.' else '.',
+				}
+
+				blocks.append('|'.join(block[field] for field in benchmark_csq_desc))
+
+			row = [chrom, str(pos), ref, alt, '.', '50', rng.choice(['PASS'] * 9 + ['LowQual']), ','.join(blocks), str(rng.randint(1, 20))]
+
+			for sample in samples:
+
+				genotype = rng.choice([f'{ref}/{alt}', f'{ref}/{alt}', f'{alt}/{alt}', f'{ref}/{ref}', f'{ref}|{alt}', './.'])
+
+				row = row + [genotype, str(rng.choice([5, 30, 60, 99])), str(rng.choice([5, 20, 40]))]
+
+			f.write('\t'.join(row) + '\n')
+
+	with open(files['ped'], 'w') as f:
+
+		for ped_row in ped_rows:
+
+			f.write('\t'.join(ped_row) + '\n')
+
+	with open(files['csq'], 'w') as f:
+
+		f.write('|'.join(benchmark_csq_desc))
+
+	with open(files['hpo'], 'w') as f:
+
+		f.write('#Format: entrez-gene-id<tab>entrez-gene-symbol<tab>HPO-Term-Name<tab>HPO-Term-ID\n')
+
+		for symbol, gene_id in genes:
+
+			for hpo in rng.sample(range(1, 2000), 10):
+
+				f.write(f'{gene_id}\t{symbol}\tname\tHP:{hpo:07d}\n')
+
+	with open(files['constraint'], 'w') as f:
+
+		f.write('transcript,gene,pLI,oe_lof,oe_lof_lower,oe_lof_upper\n')
+
+		for symbol, gene_id in genes:
+
+			for transcript in range(3):
+
+				f.write(f'NM_{int(gene_id) * 10 + transcript},{symbol},{rng.random():.3f},{rng.random():.3f},{rng.random():.3f},{rng.random():.3f}\n')
+
+	probands = [sample for sample in samples if sample.startswith(('proband', 'single'))]
+
+	with open(files['patient_hpos'], 'w') as f:
+
+		f.write('\t' + '\t'.join(probands) + '\n')
+
+		for row in range(5):
+
+			f.write(str(row) + '\t' + '\t'.join(f'HP:{rng.randint(1, 2000):07d}' for proband in probands) + '\n')
+
+	# Every gene is in the PanelApp dump so that nothing is fetched during the benchmark
+	panel_app_date = str(datetime.datetime.now())
+
+	panel_app_dict = {symbol: {'date': panel_app_date, 'disease': f'Disease {symbol}' if rng.random() < 0.3 else None, 'inheritance': 'BIALLELIC' if rng.random() < 0.3 else None}
+		for symbol, gene_id in genes}
+
+	write_panel_app_dump(panel_app_dict, files['panel_app'])
+
+	# The example config with the reference files pointing at the generated ones
+	with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config', 'config.yaml')) as f:
+
+		config_dict = yaml.safe_load(f)
+
+	config_dict['hpo_file'] = files['hpo']
+	config_dict['gnomad_gene_scores'] = files['constraint']
+	config_dict['panel_app_dump_max_time'] = 36500
+
+	with open(files['config'], 'w') as f:
+
+		yaml.safe_dump(config_dict, f)
+
+	return files
+
+
+def run_benchmark_once(data_dir):
+	"""
+	Run the filter on a generated input in this process.
+
+	Returns the total seconds, the seconds for each stage and the peak memory in MB.
+
+	"""
+
+	files = {name: os.path.join(data_dir, filename) for name, filename in [('input', 'input.tsv'), ('ped', 'family.ped'), ('csq', 'csq.txt'),
+		('patient_hpos', 'patient_hpos.tsv'), ('panel_app', 'panelapp.tsv'), ('config', 'config.yaml')]}
+
+	config_dict = parse_config(files['config'])
+
+	# The SettingWithCopyWarning can be ignored - see readme
+	pd.options.mode.chained_assignment = None
+
+	with open(files['csq']) as f:
+
+		csq_desc = f.read().strip().split('|')
+
+	with tempfile.TemporaryDirectory() as results_dir:
+
+		options = get_options(csv_file=files['input'], ped_file=files['ped'], csq_desc=csq_desc, parse_splice_ai=True, smart_synonymous_filtering=True,
+			add_ccrs=True, add_gnomad_constraint_scores=True, add_panel_app_info=True, local_panel_app_dump=files['panel_app'],
+			patient_hpos=files['patient_hpos'], worksheet='BENCHMARK', results_dir=results_dir)
+
+		metrics = new_metrics()
+
+		start = time.perf_counter()
+
+		with measure_stage({'metrics': metrics}, 'load_resources'):
+
+			resources = load_resources(config_dict, True, True, options['local_panel_app_dump'], True)
+
+		run_filter(options, config_dict, resources, metrics)
+
+		seconds = time.perf_counter() - start
+
+	stage_timings = {stage: measurement['wall_seconds'] for stage, measurement in metrics['stages'].items()}
+
+	return {'seconds': seconds, 'stages': stage_timings, 'peak_memory_mb': get_peak_memory_mb()}
+
+
+def run_benchmarks(sizes, work_dir, repeats=1):
+	"""
+	Generate the inputs for each size and run the filter on them.
+
+	Each run is in a fresh process so that the peak memory is only for that run. The fastest time \
+	for each stage over the repeats is kept.
+
+	"""
+
+	results = {}
+	results['created'] = datetime.datetime.now().isoformat()
+	results['version'] = version
+	results['python'] = platform.python_version()
+	results['pandas'] = pd.__version__
+	results['numpy'] = np.__version__
+	results['machine'] = platform.node()
+	results['sizes'] = {}
+
+	for size in sizes:
+
+		size_settings = benchmark_sizes[size]
+
+		data_dir = os.path.join(work_dir, '_'.join(f'{key}{value}' for key, value in sorted(size_settings.items())))
+
+		# Inputs are only generated once for each size
+		if not os.path.exists(os.path.join(data_dir, 'config.yaml')):
+
+			print(f'Generating {size} input in {data_dir}', file=sys.stderr)
+
+			generate_benchmark_data(data_dir, **size_settings)
+
+		size_results = None
+
+		for repeat in range(repeats):
+
+			print(f'Running {size} benchmark {repeat + 1} of {repeats}', file=sys.stderr)
+
+			output = subprocess.run([sys.executable, os.path.abspath(__file__), 'run-once', '--data', data_dir],
+				stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+
+			run_results = json.loads(output)
+
+			if size_results == None:
+
+				size_results = run_results
+
+			else:
+
+				size_results['seconds'] = min(size_results['seconds'], run_results['seconds'])
+				size_results['peak_memory_mb'] = max(size_results['peak_memory_mb'], run_results['peak_memory_mb'])
+
+				for stage, seconds in run_results['stages'].items():
+
+					size_results['stages'][stage] = min(size_results['stages'].get(stage, seconds), seconds)
+
+		size_results.update(size_settings)
+		size_results['repeats'] = repeats
+
+		results['sizes'][size] = size_results
+
+	return results
+
+
+def compare_benchmarks(baseline, current, threshold=0.2, min_seconds=0.5):
+	"""
+	Compare two sets of benchmark results.
+
+	A stage has regressed if it is more than threshold (as a fraction) slower than the baseline and \
+	at least min_seconds slower - this stops small stages being flagged because of noise. The peak \
+	memory has regressed if it is more than threshold bigger.
+
+	Returns a list of rows [size, measure, baseline, current, change, regressed].
+
+	"""
+
+	comparison = []
+
+	for size, current_size in current['sizes'].items():
+
+		if size not in baseline['sizes']:
+
+			continue
+
+		baseline_size = baseline['sizes'][size]
+
+		measures = [('total', baseline_size['seconds'], current_size['seconds'])]
+
+		for stage in benchmark_stages + sorted(set(current_size['stages']) - set(benchmark_stages)):
+
+			if stage in baseline_size['stages'] and stage in current_size['stages']:
+
+				measures.append((stage, baseline_size['stages'][stage], current_size['stages'][stage]))
+
+		for measure, baseline_seconds, current_seconds in measures:
+
+			change = (current_seconds - baseline_seconds) / baseline_seconds if baseline_seconds > 0 else 0.0
+
+			regressed = change > threshold and current_seconds - baseline_seconds >= min_seconds
+
+			comparison.append([size, measure, baseline_seconds, current_seconds, change, regressed])
+
+		baseline_memory = baseline_size['peak_memory_mb']
+		current_memory = current_size['peak_memory_mb']
+
+		change = (current_memory - baseline_memory) / baseline_memory if baseline_memory > 0 else 0.0
+
+		comparison.append([size, 'peak_memory_mb', baseline_memory, current_memory, change, change > threshold])
+
+	return comparison
+
+
+def main():
+
+	parser = argparse.ArgumentParser(description='Benchmark the germline variant filter on synthetic data.')
+
+	subparsers = parser.add_subparsers(dest='command')
+	subparsers.required = True
+
+	generate_parser = subparsers.add_parser('generate', help='Write a synthetic input and the files needed to run it.')
+	generate_parser.add_argument('--out', type=str, required=True, help='Directory to write the files to.')
+	generate_parser.add_argument('--variants', type=int, default=10000, help='Number of variants. Default = 10000.')
+	generate_parser.add_argument('--trios', type=int, default=1, help='Number of trios. Default = 1.')
+	generate_parser.add_argument('--singles', type=int, default=0, help='Number of samples analysed on their own. Default = 0.')
+	generate_parser.add_argument('--transcripts', type=int, default=4, help='Most transcripts in each CSQ field. Default = 4.')
+	generate_parser.add_argument('--density', type=float, default=0.5, help='Fraction of the optional annotations which are filled in. Default = 0.5.')
+	generate_parser.add_argument('--seed', type=int, default=1, help='Random seed. Default = 1.')
+
+	run_parser = subparsers.add_parser('run', help='Run the benchmarks and write the results as JSON.')
+	run_parser.add_argument('--sizes', type=str, nargs='+', default=['panel', 'exome'], choices=sorted(benchmark_sizes), help='Which sizes to run. Default = panel exome.')
+	run_parser.add_argument('--out', type=str, required=True, help='Where to write the JSON results.')
+	run_parser.add_argument('--work-dir', type=str, default='benchmark_data', help='Where to keep the generated inputs. Default = benchmark_data.')
+	run_parser.add_argument('--repeats', type=int, default=3, help='Number of times to run each size. Default = 3.')
+
+	once_parser = subparsers.add_parser('run-once', help='Run the filter once on a generated input and print the timings as JSON.')
+	once_parser.add_argument('--data', type=str, required=True, help='Directory written by generate.')
+
+	compare_parser = subparsers.add_parser('compare', help='Compare results with a baseline. Exits with status 1 if there are regressions.')
+	compare_parser.add_argument('baseline', type=str, help='The baseline JSON results.')
+	compare_parser.add_argument('current', type=str, help='The JSON results to check.')
+	compare_parser.add_argument('--threshold', type=float, default=0.2, help='Fractional slowdown or memory increase counted as a regression. Default = 0.2.')
+	compare_parser.add_argument('--min-seconds', type=float, default=0.5, help='Ignore slowdowns smaller than this many seconds. Default = 0.5.')
+
+	args = parser.parse_args()
+
+	if args.command == 'generate':
+
+		generate_benchmark_data(args.out, args.variants, args.trios, args.singles, args.transcripts, args.density, args.seed)
+
+	elif args.command == 'run':
+
+		results = run_benchmarks(args.sizes, args.work_dir, args.repeats)
+
+		with open(args.out, 'w') as f:
+
+			json.dump(results, f, indent=2, sort_keys=True)
+
+	elif args.command == 'run-once':
+
+		print(json.dumps(run_benchmark_once(args.data)))
+
+	elif args.command == 'compare':
+
+		with open(args.baseline) as f:
+
+			baseline = json.load(f)
+
+		with open(args.current) as f:
+
+			current = json.load(f)
+
+		comparison = compare_benchmarks(baseline, current, args.threshold, args.min_seconds)
+
+		print('size\tmeasure\tbaseline\tcurrent\tchange\tstatus')
+
+		for size, measure, baseline_value, current_value, change, regressed in comparison:
+
+			print(f"{size}\t{measure}\t{baseline_value:.3f}\t{current_value:.3f}\t{change:+.1%}\t{'REGRESSION' if regressed == True else 'ok'}")
+
+		if any(row[5] for row in comparison):
+
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+
+	main()
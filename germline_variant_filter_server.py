@@ -0,0 +1,104 @@
+from utils.utils import *
+from utils.pipeline_utils import *
+from utils.filter_server import *
+import logging
+import argparse
+
+########################################################################################################################################################
+# Parse Arguments
+########################################################################################################################################################
+
+def get_parser():
+	"""
+	The command line arguments.
+
+	"""
+
+	parser = argparse.ArgumentParser(
+		formatter_class=argparse.RawTextHelpFormatter,
+		description='Run the germline variant filter as a server which keeps the reference data loaded between jobs. See readme for details.')
+
+	parser.add_argument('--config', type=str, nargs=1, required=True,
+						help='Filepath to YAML config file. See config/ directory for an example of what these look like.')
+
+	parser.add_argument('--panelapp', action='store_true',
+						help='Load the PanelApp data so jobs can add PanelApp annotations. Default = False.')
+
+	parser.add_argument('--local-panel-app-dump', type=str, nargs=1,
+						help='Filepath local panelapp store.')
+
+	parser.add_argument('--panel-app-cache', type=str, nargs=1,
+						help='Filepath to a SQLite PanelApp cache to use instead of the local panelapp store. If --local-panel-app-dump is also given it is imported into the cache the first time.')
+
+	parser.add_argument('--jobs', type=int, nargs=1, default=[1],
+						help='Number of jobs to run at the same time. Default = 1.')
+
+	parser.add_argument('--host', type=str, nargs=1, default=['127.0.0.1'],
+						help='Address to listen on. There is no authentication so only change this on a trusted network. Default = 127.0.0.1.')
+
+	parser.add_argument('--port', type=int, nargs=1, default=[8765],
+						help='Port to listen on. Default = 8765.')
+
+	return parser
+
+
+def main(argv=None):
+	"""
+	Run the server with the command line arguments in argv until it is interrupted.
+
+	"""
+
+	args = get_parser().parse_args(argv)
+
+	local_panel_app_dump = args.local_panel_app_dump[0] if args.local_panel_app_dump != None else None
+	panel_app_cache = args.panel_app_cache[0] if args.panel_app_cache != None else None
+
+	if (local_panel_app_dump != None or panel_app_cache != None) and args.panelapp == False:
+
+		raise Exception('Cannot select to use PanelApp dump or cache and not select to add PanelApp Data.')
+
+	####################################################################################################################################################
+	# Load the config
+	####################################################################################################################################################
+
+	state = new_server_state(args.config[0], args.panelapp, local_panel_app_dump, panel_app_cache, args.jobs[0])
+
+	####################################################################################################################################################
+	# Take jobs until stopped
+	####################################################################################################################################################
+
+	server = start_filter_server(state, args.host[0], args.port[0])
+
+	logger.info(f'Listening on http://{args.host[0]}:{server.server_address[1]} - running up to {args.jobs[0]} jobs at a time.')
+
+	try:
+
+		server.serve_forever()
+
+	except KeyboardInterrupt:
+
+		logger.info('Stopping - waiting for the queued jobs to finish.')
+
+	finally:
+
+		server.server_close()
+		stop_server_jobs(state)
+
+
+if __name__ == '__main__':
+
+	####################################################################################################################################################
+	# Set up Logger
+	####################################################################################################################################################
+
+	logger = logging.getLogger('germline_variant_filter')
+	logger.setLevel(logging.DEBUG)
+	handler = logging.StreamHandler()
+	handler.setLevel(logging.DEBUG)
+	formatter = logging.Formatter(
+		'%(levelname)s\t%(asctime)s\t%(name)s\t%(message)s'
+	)
+	handler.setFormatter(formatter)
+	logger.addHandler(handler)
+
+	main()
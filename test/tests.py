@@ -1,7 +1,28 @@
 from utils.utils import *
 from utils.inheritance_utils import *
+from utils.panel_app_cache import *
+from utils.variant_cache import *
+from utils.regions import *
+from utils.pipeline_utils import *
+from utils.filter_server import *
+from benchmarks.benchmark import generate_benchmark_data, compare_benchmarks
 import unittest
+import unittest.mock
 import pandas as pd
+import numpy as np
+import tempfile
+import gzip
+import os
+import json
+import pstats
+import subprocess
+import time
+import urllib.request
+import sys
+import yaml
+import datetime
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
 
 class WorkFlowTrioTest(unittest.TestCase):
 	"""
@@ -53,6 +74,171 @@ class WorkFlowTrioTest(unittest.TestCase):
 
 			self.assertEqual(row.Workflow, row.Comment)
 
+def write_script_config(config_file, add_panel_app_info=False):
+	"""
+	Write a copy of the example config without the output fields which need the gnomad scores, \
+	HPO terms or PanelApp data so the filter can be run on the test input on its own. The PanelApp \
+	fields are kept if add_panel_app_info is True.
+
+	"""
+
+	with open('config/config.yaml') as f:
+
+		config_dict = yaml.safe_load(f)
+
+	removed_fields = ['CCR_percentile', 'pLI', 'HPOCount']
+
+	if add_panel_app_info == False:
+
+		removed_fields = removed_fields + ['DiseaseName', 'ModeOfInheritance']
+
+	for key in ['final_fields_trio', 'final_fields_single']:
+
+		config_dict[key] = [field for field in config_dict[key] if field not in removed_fields]
+
+	with open(config_file, 'w') as f:
+
+		yaml.safe_dump(config_dict, f)
+
+
+def run_filter_script(config_file, input_file, results_dir, extra_args=[]):
+	"""
+	Run germline_variant_filter.py on an input with the test PED file and return the contents of each output file.
+
+	"""
+
+	with open('test/test_data_csq.txt') as f:
+
+		csq = f.read().strip()
+
+	os.makedirs(results_dir)
+
+	result = subprocess.run([sys.executable, 'germline_variant_filter.py', '--config', config_file, '--ped', 'test/test_data_family.ped',
+		'--input', input_file, '--csq', csq, '--worksheet', 'WS1', '--results-dir', results_dir] + extra_args, capture_output=True, text=True)
+
+	if result.returncode != 0:
+
+		raise Exception(result.stderr)
+
+	outputs = {}
+
+	for output_file in sorted(os.listdir(results_dir)):
+
+		with open(f'{results_dir}/{output_file}') as f:
+
+			outputs[output_file] = f.read()
+
+	return outputs
+
+
+class ChunkedInputTest(unittest.TestCase):
+
+	"""
+	Test reading the input in chunks gives the same output as reading the whole file.
+
+	"""
+
+	def test_read_variant_chunks(self):
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			csv_file = f'{out_dir}/input.tsv'
+
+			df = pd.DataFrame({'CHROM': ['1', '1', '1', '1', '2', '2'], 'POS': [5, 6, 6, 6, 6, 7]})
+
+			df.to_csv(csv_file, sep='\t', index=False)
+
+			# The records at 1:6 are split across the first two chunks of the file
+			chunks = list(read_variant_chunks(csv_file, 2))
+
+			self.assertEqual([list(chunk.index) for chunk in chunks], [[0], [1, 2, 3, 4], [5]])
+
+			# An input with no rows still gives a chunk with the columns
+			df.iloc[0:0].to_csv(csv_file, sep='\t', index=False)
+
+			chunks = list(read_variant_chunks(csv_file, 2))
+
+			self.assertEqual(len(chunks), 1)
+			self.assertEqual(list(chunks[0].columns), ['CHROM', 'POS'])
+
+	def test_chunked_output(self):
+
+		chunk_size = 7
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			config_file = f'{out_dir}/config.yaml'
+			input_file = f'{out_dir}/input.tsv'
+
+			write_script_config(config_file)
+
+			# Put a second record for the same position either side of each chunk boundary
+			input_df = pd.read_csv('test/test_data_input.tsv', sep='\t', dtype={'CHROM': object})
+
+			for boundary in range(chunk_size, input_df.shape[0], chunk_size):
+
+				input_df.loc[boundary, ['CHROM', 'POS']] = input_df.loc[boundary - 1, ['CHROM', 'POS']].values
+
+			input_df.to_csv(input_file, sep='\t', index=False)
+
+			expected = run_filter_script(config_file, input_file, f'{out_dir}/whole')
+
+			# Make sure the compound het counts are being compared
+			self.assertTrue(any('COMPOUND_HET' in output for output in expected.values()))
+
+			self.assertEqual(run_filter_script(config_file, input_file, f'{out_dir}/chunked', ['--chunk-size', str(chunk_size)]), expected)
+
+			# An input with no variants gives the same empty outputs as reading the whole file
+			input_df.iloc[0:0].to_csv(input_file, sep='\t', index=False)
+
+			expected = run_filter_script(config_file, input_file, f'{out_dir}/whole_empty')
+
+			self.assertEqual(run_filter_script(config_file, input_file, f'{out_dir}/chunked_empty', ['--chunk-size', str(chunk_size)]), expected)
+
+
+class WorkersTest(unittest.TestCase):
+
+	"""
+	Test processing the samples in several worker processes gives the same results as one process.
+
+	"""
+
+	def test_workers_output(self):
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			config_file = f'{out_dir}/config.yaml'
+
+			write_script_config(config_file, add_panel_app_info=True)
+
+			outputs = {}
+
+			date = datetime.datetime.now()
+
+			for workers in [1, 2]:
+
+				# Every gene is in the local dump so PanelApp is not queried
+				panel_app_dump = f'{out_dir}/panelapp_{workers}.tsv'
+
+				with open(panel_app_dump, 'w') as f:
+
+					f.write('\tdate\tdisease\tinheritance\n')
+
+					for gene_number in range(40):
+
+						f.write(f'GENE{gene_number}\t{date}\tDisease {gene_number}\tBIALLELIC\n')
+
+				outputs[workers] = run_filter_script(config_file, 'test/test_data_input.tsv', f'{out_dir}/workers_{workers}',
+					['--workers', str(workers), '--panelapp', '--local-panel-app-dump', panel_app_dump])
+
+				with open(panel_app_dump) as f:
+
+					outputs[workers]['panel_app_dump'] = f.read()
+
+			self.assertEqual(outputs[2], outputs[1])
+			self.assertTrue(any('Disease' in output for output in outputs[1].values()))
+
+
 class WorkFlowSingleTest(unittest.TestCase):
 
 	"""
@@ -104,9 +290,1288 @@ class WorkFlowSingleTest(unittest.TestCase):
 			self.assertEqual(row.Workflow, row.Comment)
 
 
+class VectorisedWorkFlowTest(unittest.TestCase):
+
+	"""
+	Test the vectorised workflow assignment gives the same annotations as the row wise functions.
 
+	"""
 
+	def test_trio(self):
 
-if __name__ == '__main__':
-    unittest.main()
+		for test_file, sample_sex in [('test/test_data_male_trio.csv', 'Male'), ('test/test_data_female_trio.csv', 'Female')]:
+
+			df = pd.read_csv(test_file, sep='\t')
+
+			compound_het_dict = df.groupby('Feature').count()['CHROM'].to_dict()
+
+			workflows = annotate_workflows_trio(df, 'proband', 'mother', 'father', sample_sex, compound_het_dict, 10, 20, 10, 10, 'DP')
+
+			self.assertEqual(list(workflows), list(df['Comment']))
+
+	def test_single(self):
+
+		for test_file, sample_sex in [('test/test_data_male_single.csv', 'Male'), ('test/test_data_female_single.csv', 'Female')]:
+
+			df = pd.read_csv(test_file, sep='\t')
+
+			compound_het_dict = df.groupby('Feature').count()['CHROM'].to_dict()
+
+			workflows = annotate_workflows_single(df, 'proband', sample_sex, compound_het_dict)
+
+			self.assertEqual(list(workflows), list(df['Comment']))
+
+class SelectVariantsTest(unittest.TestCase):
+
+	"""
+	Test the vectorised selection of relevant variants for each sample.
+
+	"""
+
+	def test_select_variants_for_samples(self):
+
+		for test_file in ['test/test_data_male_trio.csv', 'test/test_data_female_trio.csv']:
+
+			df = pd.read_csv(test_file, sep='\t')
+
+			# Use the column names from the GATK table e.g. proband.GT
+			df.columns = [column.replace('sample_', '', 1).replace('_', '.', 1) if column.startswith('sample_') else column for column in df.columns]
+
+			samples = ['proband', 'mother', 'father']
+
+			genotype_df = decode_genotypes(df, samples, 'DP')
+
+			for column in genotype_df.columns:
+				df[column] = genotype_df[column]
+
+			relevant_df = select_variants_for_samples(df, samples, 10, 20, 'DP')
+
+			for sample in samples:
+
+				expected = df.apply(select_variants_for_sample, args=(sample, 10, 20, 'DP'), axis=1)
+
+				self.assertEqual(list(relevant_df[sample + '_is_relevant']), list(expected))
+
+	def test_decode_genotypes(self):
+
+		df = pd.DataFrame({'ALT': ['G', 'G', 'T', 'T'],
+			'proband.GT': ['A/G', 'G|G', './.', 'A/A'],
+			'proband.GQ': ['99', '.', '50', '20'],
+			'proband.DP': [30, 12, 0, 40]})
+
+		genotype_df = decode_genotypes(df, ['proband'], 'DP')
+
+		self.assertEqual(genotype_df['proband.DOSAGE'].dtype, np.int8)
+		self.assertEqual(list(genotype_df['proband.DOSAGE']), [1, 2, missing_dosage, 0])
+		self.assertEqual(list(genotype_df['proband.PHASED']), [False, True, False, False])
+		self.assertEqual(list(genotype_df['proband.GQ'].fillna(-1)), [99, -1, 50, 20])
+
+		# Malformed values are not silently treated as missing
+		df['proband.GQ'] = ['99', 'x', '50', '20']
+
+		with self.assertRaises(ValueError):
+
+			decode_genotypes(df, ['proband'], 'DP')
+
+class SplitVepTranscriptsTest(unittest.TestCase):
+
+	"""
+	Test splitting the CSQ field so each transcript is on its own row.
+
+	"""
+
+	def test_split_vep_transcripts(self):
+
+		csq_desc = ['Allele', 'Consequence', 'SYMBOL', 'Feature']
+
+		df = pd.DataFrame({'CHROM': ['1', '2'], 'CSQ': ['G|missense_variant|GENE1|NM_1.1,G|intron_variant|.|NM_2.1', None]})
+
+		vep_df = split_vep_transcripts(df, csq_desc, ['Consequence', 'SYMBOL'], list(df.columns))
+
+		self.assertEqual(list(vep_df.columns), ['CHROM', 'CSQ', 'Consequence', 'SYMBOL'])
+		self.assertEqual(list(vep_df['CHROM']), ['1', '1', '2'])
+		self.assertEqual(list(vep_df['Consequence']), ['missense_variant', 'intron_variant', None])
+		self.assertEqual(list(vep_df['SYMBOL']), ['GENE1', None, None])
+
+	def test_compile_csq_projection(self):
+
+		csq_projection = compile_csq_projection(['Allele', 'Consequence', 'SYMBOL', 'Feature'], ['Feature', 'Consequence'])
+
+		self.assertEqual(csq_projection['positions'], [3, 1])
+		self.assertEqual(csq_projection['max_split'], 4)
+
+		with self.assertRaises(Exception):
+
+			compile_csq_projection(['Allele', 'Consequence'], ['SYMBOL'])
+
+	def test_csq_mismatch(self):
+
+		df = pd.DataFrame({'CHROM': ['1'], 'CSQ': ['G|missense_variant|GENE1']})
+
+		with self.assertRaises(Exception):
+
+			split_vep_transcripts(df, ['Allele', 'Consequence', 'SYMBOL', 'Feature'], ['Consequence'], list(df.columns))
+
+class ReadVcfTest(unittest.TestCase):
+
+	"""
+	Test reading a VCF directly into the same format as the GATK VariantsToTable output.
+
+	"""
+
+	def test_read_vcf_chunks(self):
+
+		vcf = ('##fileformat=VCFv4.2\n'
+			'##INFO=<ID=CSQ,Number=.,Type=String,Description="Consequence annotations from Ensembl VEP. Format: Allele|Consequence">\n'
+			'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tmother\tproband\n'
+			'1\t100\t.\tA\tG\t50\tPASS\tAC=1;CSQ=G|missense_variant\tGT:GQ:DP\t0/0:30:20\t0|1:40:25\n'
+			'X\t200\t.\tC\tT\t50\t.\tAC=2\tGT:GQ:DP\t./.:.:.\t1/1:50:30\n')
+
+		with tempfile.TemporaryDirectory() as temp_dir:
+
+			vcf_file = os.path.join(temp_dir, 'test.vcf.gz')
+
+			with gzip.open(vcf_file, 'wt') as f:
+
+				f.write(vcf)
+
+			self.assertEqual(get_vcf_csq_description(vcf_file), 'Allele|Consequence')
+
+			df = next(read_vcf_chunks(vcf_file, ['proband', 'mother'], ['GT', 'GQ', 'DP']))
+
+			# No records in the regions still gives the columns when reading in chunks
+			empty_chunks = list(read_vcf_chunks(vcf_file, ['proband', 'mother'], ['GT', 'GQ', 'DP'], 1, {'Z': {'starts': [0], 'ends': [100]}}))
+
+			self.assertEqual(len(empty_chunks), 1)
+			self.assertEqual(empty_chunks[0].shape[0], 0)
+			self.assertEqual(list(empty_chunks[0].columns), list(df.columns))
+
+		self.assertEqual(list(df.columns), ['CHROM', 'POS', 'REF', 'ALT', 'ID', 'QUAL', 'FILTER', 'CSQ', 'AC', 'proband.GT', 'proband.GQ', 'proband.DP', 'mother.GT', 'mother.GQ', 'mother.DP'])
+		self.assertEqual(list(df['proband.GT']), ['A|G', 'T/T'])
+		self.assertEqual(list(df['mother.GT']), ['A/A', './.'])
+		self.assertEqual(list(df['proband.GQ']), [40, 50])
+		self.assertTrue(pd.isna(df['mother.DP'][1]))
+		self.assertTrue(pd.isna(df['FILTER'][1]))
+		self.assertTrue(pd.isna(df['CSQ'][1]))
+
+class BatchManifestTest(unittest.TestCase):
+
+	"""
+	Test parsing the batch manifest.
+
+	"""
+
+	def test_parse_batch_manifest(self):
+
+		with tempfile.TemporaryDirectory() as temp_dir:
+
+			manifest_file = os.path.join(temp_dir, 'manifest.tsv')
+
+			with open(manifest_file, 'w') as f:
+
+				f.write('input\tped\tworksheet\tresults_dir\tpatient_hpos\n')
+				f.write('ws1.csv\tws1.ped\tws1\tresults/ws1\tws1_hpos.tsv\n')
+				f.write('ws2.vcf.gz\tws2.ped\tws2\tresults/ws2\t\n')
+
+			jobs = parse_batch_manifest(manifest_file)
+
+			self.assertEqual(len(jobs), 2)
+			self.assertEqual(jobs[0]['patient_hpos'], 'ws1_hpos.tsv')
+			self.assertEqual(jobs[1]['input'], 'ws2.vcf.gz')
+			self.assertEqual(jobs[1]['patient_hpos'], None)
+
+			with open(manifest_file, 'w') as f:
+
+				f.write('input\tped\tworksheet\tresults_dir\n')
+				f.write('ws1.csv\t\tws1\tresults/ws1\n')
+
+			with self.assertRaises(Exception):
+
+				parse_batch_manifest(manifest_file)
+
+	def test_batch_exit_status(self):
+
+		import batch_germline_variant_filter
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			files = generate_benchmark_data(out_dir, 100, trios=1, singles=0)
+
+			with open(files['csq']) as f:
+
+				csq = f.read().strip()
+
+			manifest_file = os.path.join(out_dir, 'manifest.tsv')
+			summary_file = os.path.join(out_dir, 'summary.tsv')
+
+			# The second job has an input which does not exist
+			with open(manifest_file, 'w') as f:
+
+				f.write('input\tped\tworksheet\tresults_dir\tpatient_hpos\n')
+				f.write(f"{files['input']}\t{files['ped']}\tWS1\t{out_dir}\t{files['patient_hpos']}\n")
+				f.write(f"{out_dir}/missing.csv\t{files['ped']}\tWS2\t{out_dir}\t\n")
+
+			with self.assertRaises(SystemExit) as context:
+
+				batch_germline_variant_filter.main(['--config', files['config'], '--manifest', manifest_file, '--summary', summary_file,
+					'--csq', csq, '--spliceai', '--smart-synonymous', '--add-ccrs', '--gnomad-constraint-scores', '--panelapp',
+					'--local-panel-app-dump', files['panel_app']])
+
+			self.assertEqual(context.exception.code, 1)
+
+			summary_df = pd.read_csv(summary_file, sep='\t')
+
+			self.assertEqual(list(summary_df['status']), ['SUCCESS', 'FAILED'])
+
+	def test_batch_job_process_dies(self):
+
+		import batch_germline_variant_filter
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			files = generate_benchmark_data(out_dir, 100, trios=1, singles=0)
+
+			with open(files['csq']) as f:
+
+				csq = f.read().strip()
+
+			manifest_file = os.path.join(out_dir, 'manifest.tsv')
+			summary_file = os.path.join(out_dir, 'summary.tsv')
+
+			with open(manifest_file, 'w') as f:
+
+				f.write('input\tped\tworksheet\tresults_dir\tpatient_hpos\n')
+
+				for worksheet in ['WS1', 'WS2', 'WS3']:
+
+					os.mkdir(f'{out_dir}/{worksheet}')
+
+					f.write(f"{files['input']}\t{files['ped']}\t{worksheet}\t{out_dir}/{worksheet}\t{files['patient_hpos']}\n")
+
+			# The process of the second job dies as if it had been killed for using too much memory
+			def run_or_die(job_id, options, metrics=None):
+
+				if job_id == 2:
+
+					os._exit(9)
+
+				return run_batch_job(job_id, options, metrics)
+
+			with unittest.mock.patch('utils.pipeline_utils.run_batch_job', run_or_die):
+
+				with self.assertRaises(SystemExit) as context:
+
+					batch_germline_variant_filter.main(['--config', files['config'], '--manifest', manifest_file, '--summary', summary_file,
+						'--csq', csq, '--spliceai', '--smart-synonymous', '--add-ccrs', '--gnomad-constraint-scores', '--panelapp',
+						'--local-panel-app-dump', files['panel_app'], '--jobs', '2'])
+
+			self.assertEqual(context.exception.code, 1)
+
+			summary_df = pd.read_csv(summary_file, sep='\t')
+
+			self.assertEqual(list(summary_df['status']), ['SUCCESS', 'FAILED', 'SUCCESS'])
+			self.assertIn('exit code 9', summary_df['error'][1])
+			self.assertTrue(os.path.getsize(f'{out_dir}/WS3/proband0.csv') > 0)
+
+
+
+class ApplyOncePerValueTest(unittest.TestCase):
+
+	"""
+	Test applying the sample independent annotations once per unique value.
+
+	"""
+
+	def test_apply_once_per_value(self):
+
+		df = pd.DataFrame({'EXON': ['1/10', None, '1/10', '2/10'], 'ccrs': ['95.1&96.2', '.', None, '80']}, index=[4, 7, 9, 12])
+
+		self.assertEqual(list(apply_once_per_value(df, fix_exon, ['EXON'])), list(df.apply(fix_exon, axis=1)))
+
+		ccrs = apply_once_per_value(df, fix_ccrs, ['ccrs'])
+
+		self.assertEqual(list(ccrs[[0, 3]]), [96.2, 80.0])
+		self.assertTrue(pd.isna(ccrs[1]) and pd.isna(ccrs[2]))
+
+class CompactDtypesTest(unittest.TestCase):
+
+	"""
+	Test storing the repeated string columns as categoricals.
+
+	"""
+
+	def test_compact_dtypes(self):
+
+		df = pd.DataFrame({'EXON': ['1/10', None, '1/10', '2/10'], 'POS': [1, 2, 3, 4]})
+
+		expected = list(df.apply(fix_exon, axis=1))
+
+		df = compact_dtypes(df, ['EXON', 'POS', 'SYMBOL'])
+
+		self.assertEqual(df['EXON'].dtype, 'category')
+		self.assertEqual(df['POS'].dtype, np.int64)
+		self.assertEqual(list(apply_once_per_value(df, fix_exon, ['EXON'])), expected)
+
+	def test_unify_categories(self):
+
+		dfs = [compact_dtypes(pd.DataFrame({'SYMBOL': ['A', 'B']}), ['SYMBOL']), compact_dtypes(pd.DataFrame({'SYMBOL': ['C', None]}), ['SYMBOL'])]
+
+		df = pd.concat(unify_categories(dfs), ignore_index=True)
+
+		self.assertEqual(df['SYMBOL'].dtype, 'category')
+		self.assertEqual(list(df['SYMBOL'].astype(object).fillna('')), ['A', 'B', 'C', ''])
+
+class ConsequenceRanksTest(unittest.TestCase):
+
+	"""
+	Test the vectorised consequence filter against the row wise functions.
+
+	"""
+
+	def test_worst_consequences(self):
+
+		consequence_severity = ['stop_gained', 'missense_variant', 'synonymous_variant', 'intron_variant']
+		to_keep_consequences = {'stop_gained': 'stop_gained', 'missense_variant': 'missense_variant'}
+		clin_sig_words = ['pathogenic']
+
+		df = pd.DataFrame({'VariantId': ['1:1A>G', '1:1A>G', '1:2C>T', '1:2C>T', '1:2C>T', '1:3G>A'],
+			'Consequence': ['intron_variant', 'synonymous_variant&missense_variant', 'intron_variant', None, 'stop_gained', 'synonymous_variant'],
+			'CLIN_SIG': ['Likely_Pathogenic', None, 'benign', 'benign&PATHOGENIC', None, 'uncertain_significance']})
+
+		consequence_ranks = compile_consequence_ranks(consequence_severity, to_keep_consequences, clin_sig_words)
+
+		worst_ranks, worst_consequences = get_worst_consequences(df, consequence_ranks)
+
+		expected = df.groupby('VariantId')['Consequence'].transform(get_worst_consequence, consequence_severity)
+
+		self.assertEqual(list(worst_consequences), list(expected))
+		self.assertEqual(list(worst_ranks), [1, 1, 3, 3, 3, 2])
+		self.assertEqual(list(get_important_clinsigs(df, consequence_ranks)), list(df.apply(has_important_clinsig, axis=1, args=(clin_sig_words,))))
+		self.assertEqual(consequence_ranks['keep_ranks'], {0, 1})
+
+		df['Consequence'][0] = 'made_up_variant'
+
+		with self.assertRaises(Exception):
+
+			get_worst_consequences(df, consequence_ranks)
+
+		# A typo in the consequences to keep is not silently ignored
+		with self.assertRaises(Exception):
+
+			compile_consequence_ranks(consequence_severity, {'stop_gainde': 'stop_gainde'}, clin_sig_words)
+
+class WorkflowFilterTest(unittest.TestCase):
+
+	"""
+	Test the table driven workflow frequency filter.
+
+	"""
 
+	def test_workflow_filter(self):
+
+		config_dict = {}
+
+		config_dict['wf_restrictiveness'] = ['UNIPARENTAL_ISODISOMY', 'COMPOUND_HET', 'MITOCHONDRIAL', 'OTHER', 'RECCESSIVE_X_FEMALE', 'RECCESSIVE_AUTOSOMAL', 'X_LINKED_MALE', 'Y_LINKED_MALE','DOMINANT_AUTOSOMAL', 'DOMINANT_X_FEMALE' ,'DE_NOVO_HC', 'DE_NOVO_LC']
+
+		for prefix in ['other', 'upi', 'compound_het', 'mito', 'reccessive_x_female', 'reccessive_autosomal', 'x_linked_male', 'y_linked_male', 'dom_autosomal', 'dom_x_female', 'de_novo']:
+
+			config_dict[f'{prefix}_gnomadg'] = 0.01
+			config_dict[f'{prefix}_gnomade'] = 0.01
+			config_dict[f'{prefix}_ac'] = 5
+
+		config_dict['dom_autosomal_gnomadg'] = 0.001
+
+		workflow_filters = compile_workflow_filters(config_dict)
+
+		df = pd.DataFrame({'gnomADg_AF_POPMAX': [0.005, 0.005, 0.005, np.nan, 0.02],
+			'gnomADe_AF_POPMAX': [0.0, 0.0, 0.0, 0.0, 0.0],
+			'AC': [2, 2, 10, 10, 1],
+			'Workflow': ['DOMINANT_AUTOSOMAL', 'COMPOUND_HET|DOMINANT_AUTOSOMAL', 'COMPOUND_HET|DOMINANT_AUTOSOMAL', 'OTHER', 'OTHER']})
+
+		flags = get_workflow_frequency_flags(df, workflow_filters)
+
+		workflow_codes, workflows = pd.factorize(df['Workflow'])
+
+		least_restrictive = get_least_restrictive_workflows(workflows, workflow_filters)
+
+		self.assertEqual(list(least_restrictive), [8, 1, 3])
+
+		passes = flags[np.arange(df.shape[0]), least_restrictive[workflow_codes]]
+
+		# Compound hets are not filtered on AC
+		self.assertEqual(list(passes), [False, True, True, False, False])
+
+		with self.assertRaises(Exception):
+
+			get_least_restrictive_workflows(['DOMINANT_AUTOSOMAL|MADE_UP'], workflow_filters)
+
+class PanelAppPrefetchTest(unittest.TestCase):
+
+	"""
+	Test fetching PanelApp data in the background against a local stub of the PanelApp API.
+
+	"""
+
+	def setUp(self):
+
+		requests_seen = []
+
+		class StubPanelAppHandler(BaseHTTPRequestHandler):
+
+			def do_GET(self):
+
+				gene = self.path.split('/')[-1]
+				requests_seen.append(gene)
+
+				# GENE3 fails the first time it is asked for, genes starting with DOWN always fail
+				if gene.startswith('DOWN') or (gene == 'GENE3' and requests_seen.count(gene) == 1):
+
+					self.send_response(503)
+					self.end_headers()
+					return
+
+				if gene == 'NONE':
+
+					body = {'meta': {'numOfResults': 0}, 'results': []}
+
+				else:
+
+					body = {'meta': {'numOfResults': 1}, 'results': [{'version': '2.0', 'SpecificDiseaseName': f'{gene} disease', 'ModeOfInheritance': 'BIALLELIC'}]}
+
+				self.send_response(200)
+				self.send_header('Content-Type', 'application/json')
+				self.end_headers()
+				self.wfile.write(json.dumps(body).encode())
+
+			def log_message(self, *args):
+
+				pass
+
+		self.requests_seen = requests_seen
+		self.server = HTTPServer(('127.0.0.1', 0), StubPanelAppHandler)
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+		self.config_dict = {'panel_app_url': f'http://127.0.0.1:{self.server.server_port}/{{gene}}',
+			'panel_app_dump_max_time': 100.0, 'panel_app_workers': 4, 'panel_app_retries': 1, 'panel_app_max_failures': 2}
+
+	def tearDown(self):
+
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_prefetch(self):
+
+		panel_app_dict = {'CACHED': {'disease': 'cached disease', 'inheritance': 'MONOALLELIC', 'date': str(datetime.datetime.now())}}
+
+		prefetch = start_panel_app_prefetch(self.config_dict)
+		submit_panel_app_prefetch(prefetch, ['GENE1', 'CACHED', None], panel_app_dict)
+		submit_panel_app_prefetch(prefetch, ['GENE1', 'GENE3', 'NONE'], panel_app_dict)
+		stats = finish_panel_app_prefetch(prefetch, panel_app_dict)
+
+		self.assertEqual(panel_app_dict['GENE1']['disease'], 'GENE1 disease')
+		self.assertEqual(panel_app_dict['GENE3']['inheritance'], 'BIALLELIC')
+		self.assertEqual(panel_app_dict['NONE']['disease'], None)
+		self.assertEqual(panel_app_dict['CACHED']['disease'], 'cached disease')
+		self.assertEqual(sorted(self.requests_seen), ['GENE1', 'GENE3', 'GENE3', 'NONE'])
+		self.assertEqual((stats['genes'], stats['hits'], stats['fetched'], stats['failed']), (4, 1, 3, 0))
+		self.assertEqual(stats['hit_rate'], 0.25)
+
+		# Genes which were not prefetched are fetched from the same PanelApp URL when the transcripts are annotated
+		disease = apply_panel_app_data_disease(pd.Series({'SYMBOL': 'GENE5'}), panel_app_dict, 100.0, prefetch)
+		inheritance = apply_panel_app_data_inheritance(pd.Series({'SYMBOL': 'GENE5'}), panel_app_dict, 100.0, prefetch)
+
+		close_panel_app_prefetch(prefetch)
+
+		self.assertEqual((disease, inheritance), ('GENE5 disease', 'BIALLELIC'))
+		self.assertEqual(self.requests_seen.count('GENE5'), 1)
+
+	def test_circuit_breaker(self):
+
+		self.config_dict['panel_app_workers'] = 1
+
+		panel_app_dict = {}
+
+		prefetch = start_panel_app_prefetch(self.config_dict)
+		submit_panel_app_prefetch(prefetch, ['DOWN', 'DOWN2', 'DOWN3', 'DOWN4'], panel_app_dict)
+		stats = finish_panel_app_prefetch(prefetch, panel_app_dict)
+
+		self.assertTrue(stats['circuit_open'])
+		self.assertEqual(stats['failed'], 4)
+		self.assertEqual(panel_app_dict['DOWN4']['disease'], None)
+
+		# Two genes tried twice each then the rest are skipped
+		self.assertEqual(len(self.requests_seen), 4)
+
+		# Once the breaker is open genes which were not prefetched are not fetched either
+		disease = apply_panel_app_data_disease(pd.Series({'SYMBOL': 'GENE5'}), panel_app_dict, 100.0, prefetch)
+
+		close_panel_app_prefetch(prefetch)
+
+		self.assertEqual(disease, None)
+		self.assertEqual(panel_app_dict['GENE5']['inheritance'], None)
+		self.assertEqual(len(self.requests_seen), 4)
+
+
+class PanelAppCacheTest(unittest.TestCase):
+
+	"""
+	Test storing the PanelApp data in the SQLite cache.
+
+	"""
+
+	def test_panel_app_cache(self):
+
+		with tempfile.TemporaryDirectory() as temp_dir:
+
+			panel_app_dump = os.path.join(temp_dir, 'panelapp.tsv')
+			panel_app_cache = os.path.join(temp_dir, 'panelapp.db')
+
+			today = datetime.datetime.now()
+			old = today - datetime.timedelta(days=200)
+
+			write_panel_app_dump({'GENE1': {'date': str(today), 'disease': 'disease 1', 'inheritance': 'BIALLELIC'},
+				'GENE2': {'date': str(old), 'disease': 'disease 2', 'inheritance': 'MONOALLELIC'}}, panel_app_dump)
+
+			connection = open_panel_app_cache(panel_app_cache)
+
+			self.assertEqual(import_panel_app_dump(connection, panel_app_dump, 100.0), 2)
+			self.assertEqual(import_panel_app_dump(connection, panel_app_dump, 100.0), None)
+
+			# GENE2 has expired
+			panel_app_dict = read_panel_app_cache(connection)
+
+			self.assertEqual(list(panel_app_dict.keys()), ['GENE1'])
+			self.assertEqual(panel_app_dict['GENE1']['disease'], 'disease 1')
+			self.assertTrue(is_panel_app_data_current('GENE1', panel_app_dict, 100.0))
+
+			# Older data from another run does not replace newer data
+			update_panel_app_cache(connection, {'GENE1': {'date': str(old), 'disease': 'old disease', 'inheritance': None},
+				'GENE2': {'date': str(today), 'disease': None, 'inheritance': None}}, 100.0)
+
+			panel_app_dict = read_panel_app_cache(connection)
+
+			self.assertEqual(panel_app_dict['GENE1']['disease'], 'disease 1')
+			self.assertEqual(panel_app_dict['GENE2']['disease'], None)
+
+			connection.close()
+
+	def test_concurrent_import(self):
+
+		with tempfile.TemporaryDirectory() as temp_dir:
+
+			panel_app_dump = os.path.join(temp_dir, 'panelapp.tsv')
+			panel_app_cache = os.path.join(temp_dir, 'panelapp.db')
+
+			write_panel_app_dump({f'GENE{i}': {'date': str(datetime.datetime.now()), 'disease': f'disease {i}', 'inheritance': 'BIALLELIC'} for i in range(1000)}, panel_app_dump)
+
+			open_panel_app_cache(panel_app_cache).close()
+
+			# Several runs starting on a fresh cache at once - only one of them imports the dump
+			barrier = threading.Barrier(4)
+			results = []
+
+			def import_dump():
+
+				connection = open_panel_app_cache(panel_app_cache)
+
+				barrier.wait()
+
+				try:
+
+					results.append(import_panel_app_dump(connection, panel_app_dump, 100.0))
+
+				except Exception as e:
+
+					results.append(e)
+
+				connection.close()
+
+			threads = [threading.Thread(target=import_dump) for i in range(4)]
+
+			for thread in threads:
+
+				thread.start()
+
+			for thread in threads:
+
+				thread.join()
+
+			self.assertEqual(sorted(results, key=str), [1000, None, None, None])
+
+
+
+class VariantCacheTest(unittest.TestCase):
+
+	"""
+	Test caching the filtered variants and skipping unchanged samples.
+
+	"""
+
+	def test_variant_cache(self):
+
+		with tempfile.TemporaryDirectory() as cache_dir:
+
+			df = pd.DataFrame({'SYMBOL': ['A', None], 'POS': [1, 2]})
+
+			self.assertEqual(read_variant_cache(cache_dir, 'key1'), None)
+
+			write_variant_cache(cache_dir, 'key1', df, 10 ** 9)
+
+			pd.testing.assert_frame_equal(read_variant_cache(cache_dir, 'key1'), df)
+
+			# Only room for one entry so the least recently used is removed
+			os.utime(os.path.join(cache_dir, 'key1.parquet'), (0, 0))
+
+			write_variant_cache(cache_dir, 'key2', df, 1)
+
+			self.assertEqual(read_variant_cache(cache_dir, 'key1'), None)
+			pd.testing.assert_frame_equal(read_variant_cache(cache_dir, 'key2'), df)
+
+	def test_parquet_round_trip(self):
+
+		with tempfile.TemporaryDirectory() as cache_dir:
+
+			df = pd.DataFrame({'CHROM': ['1', '1', 'X'], 'POS': [1, 2, 3], 'SYMBOL': ['A', None, 'B'], 'gnomad_AF': [0.1, np.nan, 0.2]})
+
+			df['CHROM'] = df['CHROM'].astype('category')
+			df['SYMBOL'] = pd.Categorical(df['SYMBOL'], categories=['B', 'A', 'C'])
+
+			write_variant_cache(cache_dir, 'key1', df, 10 ** 9)
+
+			# The categoricals come back with the same categories in the same order
+			pd.testing.assert_frame_equal(read_variant_cache(cache_dir, 'key1'), df)
+
+			# A table which can't be stored as Parquet is not cached rather than pickled
+			mixed_df = pd.DataFrame({'SYMBOL': ['A', 1]})
+
+			self.assertEqual(write_variant_cache(cache_dir, 'key2', mixed_df, 10 ** 9), None)
+			self.assertEqual(read_variant_cache(cache_dir, 'key2'), None)
+			self.assertEqual(sorted(os.listdir(cache_dir)), ['key1.parquet'])
+
+	def test_sample_record(self):
+
+		with tempfile.TemporaryDirectory() as results_dir:
+
+			self.assertFalse(is_sample_output_current(results_dir, 'sample1', 'key1'))
+
+			with open(os.path.join(results_dir, 'sample1.csv'), 'w') as f:
+				f.write('#header\n')
+
+			write_sample_record(results_dir, 'sample1', 'key1')
+
+			self.assertTrue(is_sample_output_current(results_dir, 'sample1', 'key1'))
+			self.assertFalse(is_sample_output_current(results_dir, 'sample1', 'key2'))
+
+
+class HpoIndexTest(unittest.TestCase):
+
+	"""
+	Test compiling the HPO gene map and counting the matching HPO terms.
+
+	"""
+
+	def write_hpo_file(self, hpo_file, rows):
+
+		with open(hpo_file, 'w') as f:
+
+			f.write('#Format: entrez-gene-id<tab>entrez-gene-symbol<tab>HPO-Term-Name<tab>HPO-Term-ID\n')
+
+			for gene, term in rows:
+
+				f.write(f'{gene}\tSYMBOL\tname\t{term}\n')
+
+	def test_count_hpo_matches(self):
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			hpo_file = f'{out_dir}/hpo.txt'
+
+			self.write_hpo_file(hpo_file, [('1', 'HP:1'), ('1', 'HP:2'), ('1', 'HP:2'), ('2', 'HP:3'), ('3', 'HP:1')])
+
+			hpo_index = load_hpo_index(hpo_file)
+
+			genes = pd.Series(['1', '2', '4', None, '1', '3'], dtype='category').values
+
+			counts = count_hpo_matches(genes, ['HP:1', 'HP:2', 'HP:2', 'HP:9', np.nan], hpo_index)
+
+			self.assertEqual(list(counts), [2, 0, 0, 0, 2, 1])
+
+	def test_load_hpo_index(self):
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			hpo_file = f'{out_dir}/hpo.txt'
+
+			self.write_hpo_file(hpo_file, [('1', 'HP:1'), ('2', 'HP:2')])
+
+			load_hpo_index(hpo_file)
+
+			# Reused and memory mapped the second time
+			hpo_index = load_hpo_index(hpo_file)
+
+			self.assertIsInstance(hpo_index['gene_terms'], np.memmap)
+			self.assertEqual(list(hpo_index['genes']), ['1', '2'])
+
+			# Touching the file does not compile a new index but changing it does
+			os.utime(hpo_file, (0, 0))
+
+			load_hpo_index(hpo_file)
+
+			self.assertEqual(len([name for name in os.listdir(f'{hpo_file}.index') if name.startswith('v')]), 1)
+
+			self.write_hpo_file(hpo_file, [('1', 'HP:1'), ('3', 'HP:2')])
+
+			hpo_index = load_hpo_index(hpo_file)
+
+			self.assertEqual(list(hpo_index['genes']), ['1', '3'])
+
+			# The old index is removed
+			self.assertEqual(len([name for name in os.listdir(f'{hpo_file}.index') if name.startswith('v')]), 1)
+
+
+class BenchmarkTest(unittest.TestCase):
+
+	"""
+	Test the synthetic benchmark data and the comparison of benchmark results.
+
+	"""
+
+	def test_generate_benchmark_data(self):
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			files = generate_benchmark_data(out_dir, 50, trios=1, singles=1, transcripts=3)
+
+			df = pd.read_csv(files['input'], sep='\t')
+
+			self.assertEqual(df.shape[0], 50)
+			self.assertEqual(len(parse_ped_file(files['ped'])), 4)
+
+			with open(files['csq']) as f:
+
+				csq_desc = f.read().split('|')
+
+			vep_df = split_vep_transcripts(df, csq_desc, ['Consequence', 'Feature'], list(df.columns))
+
+			self.assertTrue(50 <= vep_df.shape[0] <= 150)
+
+	def test_compare_benchmarks(self):
+
+		baseline = {'sizes': {'panel': {'seconds': 10.0, 'peak_memory_mb': 100.0, 'stages': {'read': 1.0, 'write': 0.1}}}}
+		current = {'sizes': {'panel': {'seconds': 10.5, 'peak_memory_mb': 150.0, 'stages': {'read': 2.0, 'write': 0.2}}}}
+
+		regressions = [row[1] for row in compare_benchmarks(baseline, current, threshold=0.2, min_seconds=0.5) if row[5] == True]
+
+		# write is twice as slow but only by 0.1 seconds
+		self.assertEqual(regressions, ['read', 'peak_memory_mb'])
+
+
+class FilterApiTest(unittest.TestCase):
+
+	"""
+	Test running the whole filter from Python.
+
+	"""
+
+	def test_stream_filter(self):
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			files = generate_benchmark_data(out_dir, 200, trios=1, singles=1)
+
+			config_dict = parse_config(files['config'])
+
+			with open(files['csq']) as f:
+
+				csq = f.read().strip()
+
+			options = get_options(csv_file=files['input'], ped_file=files['ped'], csq_desc=csq, parse_splice_ai=True, smart_synonymous_filtering=True,
+				add_ccrs=True, add_gnomad_constraint_scores=True, add_panel_app_info=True, local_panel_app_dump=files['panel_app'],
+				patient_hpos=files['patient_hpos'], worksheet='WS1', results_dir=out_dir, workers=2)
+
+			no_variants_samples = run_filter(options, config_dict)
+
+			streamed = list(stream_filter(options, config_dict))
+
+			# Same samples in the same order as the PED file
+			self.assertEqual([sample for sample, sample_df in streamed], list(parse_ped_file(files['ped']).keys()))
+
+			for sample, sample_df in streamed:
+
+				if sample in no_variants_samples:
+
+					self.assertEqual(sample_df.shape[0], 0)
+					continue
+
+				with open(f'{out_dir}/{sample}.csv') as f:
+
+					f.readline()
+					expected = f.read()
+
+				self.assertEqual(sample_df.to_csv(sep='\t', float_format='%.6f', index=False), expected)
+
+	def test_get_options(self):
+
+		options = get_options(csv_file='input.csv', ped_file='family.ped', csq_desc='Allele|Consequence', patient_hpos='hpos.tsv')
+
+		self.assertEqual(options['csq_desc'], ['Allele', 'Consequence'])
+		self.assertEqual(options['add_hpo'], True)
+		self.assertEqual(options['workers'], 1)
+
+		with self.assertRaises(Exception):
+
+			get_options(csv_file='input.csv', ped_file='family.ped', csq_desc='Allele', unknown_option=True)
+
+	def test_lazy_imports(self):
+
+		# requests is only needed for PanelApp
+		result = subprocess.run([sys.executable, '-c', 'import sys; import utils.pipeline_utils; print("requests" in sys.modules)'],
+			capture_output=True, text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+		self.assertEqual(result.stdout.strip(), 'False')
+
+
+class FilterServerTest(unittest.TestCase):
+
+	"""
+	Test running jobs on the filter server and reloading changed resources.
+
+	"""
+
+	def post(self, port, path, data):
+
+		request = urllib.request.Request(f'http://127.0.0.1:{port}{path}', data=json.dumps(data).encode(), method='POST')
+
+		try:
+
+			with urllib.request.urlopen(request) as response:
+
+				return response.status, json.load(response)
+
+		except urllib.error.HTTPError as e:
+
+			return e.code, json.load(e)
+
+	def test_filter_server(self):
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			files = generate_benchmark_data(out_dir, 100, trios=1)
+
+			state = new_server_state(files['config'], add_panel_app_info=True, local_panel_app_dump=files['panel_app'])
+
+			server = start_filter_server(state, port=0)
+			port = server.server_address[1]
+
+			threading.Thread(target=server.serve_forever, daemon=True).start()
+
+			try:
+
+				with open(files['csq']) as f:
+
+					csq = f.read().strip()
+
+				job_options = {'csv_file': files['input'], 'ped_file': files['ped'], 'csq_desc': csq, 'parse_splice_ai': True, 'smart_synonymous_filtering': True,
+					'add_ccrs': True, 'add_gnomad_constraint_scores': True, 'add_panel_app_info': True, 'patient_hpos': files['patient_hpos'],
+					'worksheet': 'WS1', 'results_dir': out_dir}
+
+				status_code, response = self.post(port, '/jobs', job_options)
+
+				self.assertEqual(status_code, 202)
+
+				job_id = response['job_id']
+
+				for attempt in range(300):
+
+					with urllib.request.urlopen(f'http://127.0.0.1:{port}/jobs/{job_id}') as response:
+
+						job_record = json.load(response)
+
+					if job_record['status'] not in ['QUEUED', 'RUNNING']:
+
+						break
+
+					time.sleep(0.1)
+
+				self.assertEqual(job_record['status'], 'SUCCESS')
+				self.assertIn('workflow', job_record['stages'])
+				self.assertTrue(os.path.getsize(f'{out_dir}/proband0.csv') > 0)
+
+				# Bad options are rejected straight away
+				status_code, response = self.post(port, '/jobs', {'csv_file': files['input']})
+
+				self.assertEqual(status_code, 400)
+
+				# Only the changed file is loaded again
+				self.assertEqual(self.post(port, '/reload', {}), (200, {'reloaded': []}))
+
+				with open(files['hpo'], 'a') as f:
+
+					f.write('1\tGENE1\tname\tHP:0000001\n')
+
+				os.utime(files['hpo'], (0, 0))
+
+				self.assertEqual(self.post(port, '/reload', {}), (200, {'reloaded': ['hpo_index']}))
+
+			finally:
+
+				server.shutdown()
+				server.server_close()
+				stop_server_jobs(state)
+
+	def test_concurrent_jobs(self):
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			files = generate_benchmark_data(out_dir, 20, trios=1)
+
+			with open(files['csq']) as f:
+
+				csq = f.read().strip()
+
+			with open(files['input']) as f:
+
+				input_data = f.read()
+
+			# The first job waits to read its input until we write to the pipe
+			blocked_input = f'{out_dir}/blocked_input.tsv'
+
+			os.mkfifo(blocked_input)
+
+			state = new_server_state(files['config'], add_panel_app_info=True, local_panel_app_dump=files['panel_app'], jobs=2)
+
+			try:
+
+				job_ids = []
+
+				for input_file, results_dir in [(blocked_input, f'{out_dir}/blocked'), (files['input'], f'{out_dir}/free')]:
+
+					os.mkdir(results_dir)
+
+					job_options = {'csv_file': input_file, 'ped_file': files['ped'], 'csq_desc': csq, 'parse_splice_ai': True, 'smart_synonymous_filtering': True,
+						'add_ccrs': True, 'add_gnomad_constraint_scores': True, 'add_panel_app_info': True, 'patient_hpos': files['patient_hpos'],
+						'worksheet': 'WS1', 'results_dir': results_dir}
+
+					job_ids.append(submit_server_job(state, job_options))
+
+				for attempt in range(300):
+
+					if state['jobs'][job_ids[1]]['status'] not in ['QUEUED', 'RUNNING']:
+
+						break
+
+					time.sleep(0.1)
+
+				# The second job finished while the first was still running
+				self.assertEqual(state['jobs'][job_ids[1]]['status'], 'SUCCESS')
+				self.assertEqual(state['jobs'][job_ids[0]]['status'], 'RUNNING')
+
+			finally:
+
+				# Opening the pipe for reading and writing does not wait for a reader so this cannot hang
+				pipe = os.open(blocked_input, os.O_RDWR)
+				os.write(pipe, input_data.encode())
+				os.close(pipe)
+
+				stop_server_jobs(state)
+
+			self.assertEqual(state['jobs'][job_ids[0]]['status'], 'SUCCESS')
+
+			with open(f'{out_dir}/blocked/proband0.csv') as f, open(f'{out_dir}/free/proband0.csv') as g:
+
+				self.assertEqual(f.read(), g.read())
+
+	def test_lazy_resources(self):
+
+		# The example config points at reference files which are not here
+		state = new_server_state('config/config.yaml')
+
+		self.assertEqual(state['resources'], {})
+		self.assertEqual(refresh_server_resources(state), [])
+
+		with self.assertRaises(Exception):
+
+			refresh_server_resources(state, ['gnomad_constraint_df'])
+
+		stop_server_jobs(state)
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			files = generate_benchmark_data(out_dir, 10, trios=1)
+
+			state = new_server_state(files['config'])
+
+			self.assertEqual(refresh_server_resources(state, ['hpo_index']), ['hpo_index'])
+			self.assertEqual(refresh_server_resources(state), [])
+
+			# Changing where the index is kept loads it again
+			with open(files['config'], 'a') as f:
+
+				f.write(f"hpo_index_dir: {out_dir}/hpo_index\n")
+
+			self.assertEqual(refresh_server_resources(state), ['config_dict', 'hpo_index'])
+
+			stop_server_jobs(state)
+
+
+class MetricsTest(unittest.TestCase):
+
+	"""
+	Test recording the stage metrics and the filter funnel.
+
+	"""
+
+	def test_measure_stage(self):
+
+		job = {'metrics': new_metrics()}
+
+		for rows in [10, 20]:
+
+			with measure_stage(job, 'qc', sample='sample1') as stage_rows:
+
+				stage_rows['rows_in'] = rows
+				stage_rows['rows_out'] = rows - 5
+
+		with measure_stage(job, 'genotypes'):
+
+			pass
+
+		self.assertEqual(job['metrics']['stages']['qc']['calls'], 2)
+		self.assertEqual(job['metrics']['stages']['qc']['rows_in'], 30)
+		self.assertEqual(job['metrics']['samples']['sample1']['qc']['rows_out'], 20)
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			write_metrics(job['metrics'], f'{out_dir}/metrics.json')
+
+			with open(f'{out_dir}/metrics.json') as f:
+
+				metrics = json.load(f)
+
+		self.assertEqual(metrics['funnel'], [{'stage': 'qc', 'rows_in': 30, 'rows_out': 20}])
+
+	def test_measure_stage_disabled(self):
+
+		job = {'metrics': None}
+
+		with measure_stage(job, 'qc') as stage_rows:
+
+			stage_rows['rows_in'] = 10
+
+		self.assertEqual(job['metrics'], None)
+
+
+class ProfilingTest(unittest.TestCase):
+
+	"""
+	Test profiling each stage.
+
+	"""
+
+	def test_profile_nested_stages(self):
+
+		with tempfile.TemporaryDirectory() as profile_dir:
+
+			job = {'profile': new_profile(profile_dir, trace_memory=True)}
+
+			with measure_stage(job, 'outer'):
+
+				with measure_stage(job, 'inner'):
+
+					fix_column_names(['CSQ', 'sample.GT'])
+
+			report_file = write_profile(job['profile'])
+
+			self.assertTrue(os.path.exists(f'{profile_dir}/outer.prof'))
+			self.assertTrue(os.path.exists(f'{profile_dir}/inner.prof'))
+
+			outer_stats = pstats.Stats(f'{profile_dir}/outer.prof')
+			inner_stats = pstats.Stats(f'{profile_dir}/inner.prof')
+
+			# The inner stage is not counted in the outer stage
+			self.assertEqual(get_slowest_functions(outer_stats, 10), [])
+			self.assertEqual([row[1] for row in get_slowest_functions(inner_stats, 10)], ['fix_column_names'])
+
+			with open(report_file) as f:
+
+				self.assertIn('utils.utils.fix_column_names', f.read())
+
+			self.assertEqual(job['profile']['active'], [])
+			self.assertIn('inner', job['profile']['memory'])
+
+
+class GnomadConstraintTest(unittest.TestCase):
+
+	"""
+	Test loading the gnomad constraint scores and adding them to each transcript.
+
+	"""
+
+	def test_annotate_with_gnomad_constraint(self):
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			gnomad_file = f'{out_dir}/constraint.txt'
+
+			with open(gnomad_file, 'w') as f:
+
+				f.write('transcript,gene,pLI,oe_lof,oe_mis\nNM_1,A,0.5,0.1,0.9\nNM_2,B,0.25,,0.8\nNM_1,A,0.75,0.2,0.7\n')
+
+			gnomad_constraint_df = load_gnomad_constraint(gnomad_file, ['pLI', 'oe_mis'])
+
+			self.assertEqual(list(gnomad_constraint_df.columns), ['pLI', 'oe_mis'])
+
+			features = pd.Series(['NM_1.3', 'NM_2.1', None, 'NM_3.1', 'NM_1.4'], dtype='category').values
+
+			scores = annotate_with_gnomad_constraint(features, gnomad_constraint_df)
+
+			self.assertEqual(scores['pLI'].fillna(-1).tolist(), [0.75, 0.25, -1, -1, 0.75])
+			self.assertEqual(scores['oe_mis'].fillna(-1).tolist(), [0.7, 0.8, -1, -1, 0.7])
+
+			with self.assertRaises(Exception):
+
+				load_gnomad_constraint(gnomad_file, ['pLI', 'missing'])
+
+
+class CsqFrequencyMaskTest(unittest.TestCase):
+
+	"""
+	Test that the pre split frequency filter keeps the same variants as the frequency filter.
+
+	"""
+
+	def test_get_csq_frequency_mask(self):
+
+		csq_desc = ['Allele', 'gnomADg_AF_POPMAX', 'Feature', 'gnomADe_AF_POPMAX']
+
+		csq_values = np.array([
+			'A|0.5|NM_1|0.001,A|0.001|NM_2|0.001',
+			'A|0.5|NM_1|.,A|0.02|NM_2|',
+			'A|.|NM_1|0.02',
+			'A||NM_1|',
+			'A|0.5&0.6|NM_1|0.001',
+			'A|0.01|NM_1|0.01',
+			'A|0.5|NM_1',
+			None], dtype=object)
+
+		keep = get_csq_frequency_mask(csq_values, csq_desc, 0.01, 0.01)
+
+		self.assertEqual(list(keep), [True, False, False, True, True, True, True, True])
+
+		# Compare with splitting the CSQ and then filtering each transcript
+		df = pd.DataFrame({'CSQ': csq_values[:6], 'variant': range(6)})
+
+		vep_df = split_vep_transcripts(df, csq_desc, csq_desc, ['CSQ', 'variant'])
+
+		for column in ['gnomADg_AF_POPMAX', 'gnomADe_AF_POPMAX']:
+
+			vep_df[column] = pd.to_numeric(vep_df.apply(fix_gnomad, axis=1, args=(column,))).fillna(0.0)
+
+		vep_df = vep_df[(vep_df['gnomADg_AF_POPMAX'] <= 0.01) & (vep_df['gnomADe_AF_POPMAX'] <= 0.01)]
+
+		self.assertEqual(sorted(vep_df['variant'].unique()), [i for i in range(6) if keep[i] == True])
+
+
+class RegionsTest(unittest.TestCase):
+
+	"""
+	Test restricting the variants to the regions in a BED file.
+
+	"""
+
+	def test_get_regions_mask(self):
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			bed_file = f'{out_dir}/regions.bed'
+
+			with open(bed_file, 'w') as f:
+
+				f.write('track name=panel\n1\t100\t200\n1\t150\t300\n1\t300\t310\n2\t10\t20\tname\n1\t500\t600\n')
+
+			regions = read_regions(bed_file)
+
+			self.assertEqual(list(regions['1']['starts']), [100, 500])
+			self.assertEqual(list(regions['1']['ends']), [310, 600])
+
+			chroms = ['1', '1', '1', '1', '1', '2', '3', '1']
+			positions = [100, 101, 310, 311, 98, 20, 150, 600]
+			refs = ['A', 'A', 'A', 'A', 'AAAA', 'A', 'A', None]
+
+			keep = get_regions_mask(chroms, positions, refs, regions)
+
+			self.assertEqual(list(keep), [False, True, True, False, True, True, False, True])
+
+			self.assertEqual([is_variant_in_regions(chrom, pos, ref if ref != None else '', regions) for chrom, pos, ref in zip(chroms, positions, refs)], list(keep))
+
+	def test_read_region_rows(self):
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			csv_file = f'{out_dir}/input.tsv'
+
+			df = pd.DataFrame({'CHROM': ['1', '1', '1', '1', '2', '2'], 'POS': [5, 50, 60, 500, 5, 50], 'REF': ['A', 'A', 'A', 'A', 'A', 'A'], 'ID': range(6)})
+
+			df.to_csv(csv_file, sep='\t', index=False)
+
+			regions = {'1': {'starts': np.array([40]), 'ends': np.array([100])}, '2': {'starts': np.array([0]), 'ends': np.array([10])}}
+
+			row_ranges = get_region_row_ranges(csv_file, regions, chunk_size=4)
+
+			self.assertEqual(row_ranges, [[1, 3], [4, 5]])
+
+			self.assertEqual(list(pd.concat(read_region_rows(csv_file, row_ranges))['ID']), [1, 2, 4])
+			self.assertEqual([list(chunk['ID']) for chunk in read_region_rows(csv_file, row_ranges, 2)], [[1, 2], [4]])
+
+			# No rows in the regions still gives the columns when reading in chunks
+			self.assertEqual([list(chunk.columns) for chunk in read_region_rows(csv_file, [], 2)], [list(df.columns)])
+
+			# Not sorted
+			df.iloc[[0, 4, 1, 2, 3, 5]].to_csv(csv_file, sep='\t', index=False)
+
+			self.assertEqual(get_region_row_ranges(csv_file, regions), None)
+
+	def test_no_overlapping_regions(self):
+
+		with tempfile.TemporaryDirectory() as out_dir:
+
+			files = generate_benchmark_data(out_dir, 50, trios=1, singles=0)
+
+			with open(files['csq']) as f:
+
+				csq = f.read().strip()
+
+			# Sorted so only the rows in the regions are read
+			input_df = pd.read_csv(files['input'], sep='\t', dtype={'CHROM': object})
+			input_df.sort_values(['CHROM', 'POS'], kind='stable').to_csv(files['input'], sep='\t', index=False)
+
+			bed_file = f'{out_dir}/regions.bed'
+
+			with open(bed_file, 'w') as f:
+
+				f.write('Z\t0\t100\n')
+
+			config_dict = parse_config(files['config'])
+
+			outputs = []
+
+			for chunk_size in [None, 7]:
+
+				results_dir = f'{out_dir}/chunk_size_{chunk_size}'
+				os.mkdir(results_dir)
+
+				options = get_options(csv_file=files['input'], ped_file=files['ped'], csq_desc=csq, parse_splice_ai=True, smart_synonymous_filtering=True,
+					add_ccrs=True, add_gnomad_constraint_scores=True, add_panel_app_info=True, local_panel_app_dump=files['panel_app'],
+					patient_hpos=files['patient_hpos'], worksheet='WS1', results_dir=results_dir, regions=bed_file, chunk_size=chunk_size)
+
+				no_variants_samples = run_filter(options, config_dict)
+
+				self.assertEqual(sorted(no_variants_samples), sorted(parse_ped_file(files['ped']).keys()))
+
+				outputs.append({sample_file: open(f'{results_dir}/{sample_file}').read() for sample_file in sorted(os.listdir(results_dir))})
+
+			self.assertEqual(outputs[0], outputs[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,596 @@
+"""
+Functions for running the filter as a long lived server.
+
+The server keeps the config, the gnomad constraint scores, the HPO gene map and the PanelApp data \
+loaded and takes jobs as JSON over HTTP. Each resource is loaded when the first job which uses it \
+runs and only loaded again when its file or the config settings it is loaded with change. Each job \
+runs in a forked process so jobs share the loaded resources with the server without copying them \
+and several jobs can run at the same time.
+
+"""
+
+from utils.pipeline_utils import *
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import argparse
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import threading
+import time
+
+logger = logging.getLogger('germline_variant_filter')
+
+# Options which are set when the server is started rather than for each job
+server_option_keys = ['local_panel_app_dump', 'panel_app_cache']
+
+
+def new_server_state(config_file, add_panel_app_info=False, local_panel_app_dump=None, panel_app_cache=None, jobs=1):
+	"""
+	Load the config and start the thread which runs the queued jobs - the resources are loaded when a job needs them.
+
+	jobs = the number of jobs to run at the same time
+
+	"""
+
+	if jobs < 1:
+
+		raise Exception('The number of jobs must be at least 1.')
+
+	state = {}
+	state['config_file'] = config_file
+	state['add_panel_app_info'] = add_panel_app_info
+	state['local_panel_app_dump'] = local_panel_app_dump
+	state['panel_app_cache'] = panel_app_cache
+	state['max_jobs'] = jobs
+	state['config_dict'] = None
+	state['resources'] = {}
+	state['stamps'] = {}
+	state['settings'] = {}
+	state['lock'] = threading.Lock()
+	state['jobs'] = {}
+	state['queue'] = []
+	state['next_job_id'] = 1
+	state['stopping'] = False
+	state['started'] = time.time()
+
+	# Written to whenever a job is queued or the server is stopping to wake up the dispatcher
+	state['wake_receiver'], state['wake_sender'] = multiprocessing.Pipe(duplex=False)
+
+	refresh_server_resources(state)
+
+	state['dispatcher'] = threading.Thread(target=dispatch_server_jobs, args=(state,), daemon=True)
+	state['dispatcher'].start()
+
+	return state
+
+
+def get_resource_files(state):
+	"""
+	Get the file each resource is loaded from - None if the resource is not used or has no file.
+
+	"""
+
+	config_dict = state['config_dict']
+
+	resource_files = {}
+	resource_files['gnomad_constraint_df'] = config_dict.get('gnomad_gene_scores')
+	resource_files['hpo_index'] = config_dict.get('hpo_file')
+
+	if state['add_panel_app_info'] == True:
+
+		resource_files['panel_app_dict'] = state['panel_app_cache'] if state['panel_app_cache'] != None else state['local_panel_app_dump']
+
+	return resource_files
+
+
+def get_resource_settings(state, name):
+	"""
+	Get the config settings a resource is loaded with - it is loaded again if these change.
+
+	"""
+
+	config_dict = state['config_dict']
+
+	if name == 'gnomad_constraint_df':
+
+		return config_dict.get('gnomad_constraint_metrics', default_gnomad_constraint_metrics)
+
+	elif name == 'hpo_index':
+
+		return config_dict.get('hpo_index_dir')
+
+	return None
+
+
+def get_job_resources(options):
+	"""
+	Get the names of the resources a job uses.
+
+	"""
+
+	job_resources = []
+
+	if options['add_gnomad_constraint_scores'] == True:
+
+		job_resources.append('gnomad_constraint_df')
+
+	if options['add_hpo'] == True:
+
+		job_resources.append('hpo_index')
+
+	if options['add_panel_app_info'] == True:
+
+		job_resources.append('panel_app_dict')
+
+	return job_resources
+
+
+def load_server_resource(state, name):
+	"""
+	Load one of the resources with load_resources.
+
+	"""
+
+	config_dict = state['config_dict']
+
+	if name == 'gnomad_constraint_df':
+
+		return load_resources(config_dict, True, False, None, False)
+
+	elif name == 'hpo_index':
+
+		return load_resources(config_dict, False, False, None, True)
+
+	return load_resources(config_dict, False, True, state['local_panel_app_dump'], False, state['panel_app_cache'])
+
+
+def refresh_server_resources(state, needed=()):
+	"""
+	Load the config, any of the needed resources which have not been loaded yet and any loaded \
+	resources whose files or settings have changed since they were loaded.
+
+	The resources are replaced rather than changed so jobs which have already started keep the \
+	resources they started with.
+
+	Returns a list of what was loaded.
+
+	"""
+
+	with state['lock']:
+
+		reloaded = []
+
+		config_stamp = get_file_stamp(state['config_file'])
+
+		if state['config_dict'] == None or config_stamp != state['stamps'].get('config_dict'):
+
+			logger.info(f"Loading the config from {state['config_file']}.")
+
+			state['config_dict'] = parse_config(state['config_file'])
+			state['stamps']['config_dict'] = config_stamp
+			reloaded.append('config_dict')
+
+		resources = dict(state['resources'])
+
+		for name, resource_file in get_resource_files(state).items():
+
+			# Resources are only loaded once a job uses them so a missing file only fails the jobs which need it
+			if name not in needed and name not in resources:
+
+				continue
+
+			# PanelApp data is still needed without a local dump or cache - it is fetched as it is used
+			if resource_file == None and name != 'panel_app_dict':
+
+				continue
+
+			stamp = get_file_stamp(resource_file)
+			settings = get_resource_settings(state, name)
+
+			if name in resources and stamp == state['stamps'].get(name) and settings == state['settings'].get(name):
+
+				continue
+
+			logger.info(f'Loading {name} from {resource_file}.')
+
+			resources.update(load_server_resource(state, name))
+			state['stamps'][name] = stamp
+			state['settings'][name] = settings
+			reloaded.append(name)
+
+		state['resources'] = resources
+
+		return reloaded
+
+
+def save_server_panel_app_data(state, panel_app_updates):
+	"""
+	Add the PanelApp data fetched by a job to the resources and save it to the local dump or cache.
+
+	"""
+
+	with state['lock']:
+
+		resources = state['resources']
+
+		resources['panel_app_dict'].update(panel_app_updates)
+
+		save_panel_app_data(resources, state['config_dict'], state['local_panel_app_dump'], state['panel_app_cache'])
+
+		resources['panel_app_loaded'] = dict(resources['panel_app_dict'])
+
+		# Our own changes don't need to be loaded again
+		state['stamps']['panel_app_dict'] = get_file_stamp(get_resource_files(state)['panel_app_dict'])
+
+
+def submit_server_job(state, job_options):
+	"""
+	Check the options for a job and queue it to be run.
+
+	job_options = any of the options taken by get_options apart from those in server_option_keys
+
+	Returns the job ID.
+
+	"""
+
+	for key in server_option_keys:
+
+		if job_options.get(key) != None:
+
+			raise Exception(f'The {key} option is set when the server is started.')
+
+	options = get_options(**job_options)
+
+	if options['results_dir'] == None or options['worksheet'] == None:
+
+		raise Exception('The results_dir and worksheet options are required.')
+
+	if options['add_panel_app_info'] == True and state['add_panel_app_info'] == False:
+
+		raise Exception('The server needs to be started with --panelapp to add PanelApp data.')
+
+	job_args = argparse.Namespace(local_panel_app_dump=None, panel_app_cache=None, panelapp=options['add_panel_app_info'],
+		spliceai=options['parse_splice_ai'], smart_synonymous=options['smart_synonymous_filtering'], add_ccrs=options['add_ccrs'],
+		gnomad_constraint_scores=options['add_gnomad_constraint_scores'], patient_hpos=options['patient_hpos'], csq=['|'.join(options['csq_desc'])])
+
+	if are_arguments_valid(job_args, state['config_dict']) == False:
+
+		raise Exception('Invalid options - see the server log.')
+
+	with state['lock']:
+
+		if state['stopping'] == True:
+
+			raise Exception('The server is stopping.')
+
+		job_id = str(state['next_job_id'])
+		state['next_job_id'] = state['next_job_id'] + 1
+
+		job_record = {}
+		job_record['job_id'] = job_id
+		job_record['worksheet'] = options['worksheet']
+		job_record['input'] = options['csv_file'] if options['csv_file'] != None else options['vcf_file']
+		job_record['status'] = 'QUEUED'
+		job_record['error'] = ''
+		job_record['no_variants_samples'] = []
+		job_record['submitted'] = time.time()
+		job_record['started'] = None
+		job_record['finished'] = None
+		job_record['queued_seconds'] = None
+		job_record['seconds'] = None
+		job_record['stages'] = {}
+
+		state['jobs'][job_id] = job_record
+		state['queue'].append((job_id, options))
+
+		state['wake_sender'].send(None)
+
+	logger.info(f"Queued job {job_id}: {job_record['input']}")
+
+	return job_id
+
+
+def run_forked_job(job_id, options, config_dict, resources, connection):
+	"""
+	Run a job in a forked process and send the summary, the PanelApp data it fetched and its metrics back.
+
+	"""
+
+	worker_state['config_dict'] = config_dict
+	worker_state['resources'] = resources
+
+	metrics = new_metrics()
+
+	summary, panel_app_updates = run_batch_job(job_id, options, metrics)
+
+	connection.send((summary, panel_app_updates, metrics))
+	connection.close()
+
+
+def start_server_job(state, job_id, options):
+	"""
+	Load the resources a queued job needs and start it in a forked process.
+
+	Returns the running job or None if the job could not be started.
+
+	"""
+
+	job_record = state['jobs'][job_id]
+
+	job_record['status'] = 'RUNNING'
+	job_record['started'] = time.time()
+	job_record['queued_seconds'] = round(job_record['started'] - job_record['submitted'], 3)
+
+	try:
+
+		refresh_server_resources(state, get_job_resources(options))
+
+		with state['lock']:
+
+			config_dict = state['config_dict']
+			resources = state['resources']
+
+		context = multiprocessing.get_context('fork')
+
+		receiver, sender = context.Pipe(duplex=False)
+
+		process = context.Process(target=run_forked_job, args=(job_id, options, config_dict, resources, sender))
+		process.start()
+
+		# Only the job process should hold the sending end so recv fails if the job process dies
+		sender.close()
+
+	except Exception as e:
+
+		logger.error(f'Job {job_id} failed: {e}')
+
+		record_server_job(state, job_id, {'status': 'FAILED', 'error': str(e), 'no_variants_samples': ''})
+
+		return None
+
+	running_job = {}
+	running_job['job_id'] = job_id
+	running_job['process'] = process
+	running_job['receiver'] = receiver
+
+	return running_job
+
+
+def finish_server_job(state, running_job):
+	"""
+	Collect the results of a job whose process has sent them or stopped and save the PanelApp data it fetched.
+
+	"""
+
+	job_id = running_job['job_id']
+
+	panel_app_updates = {}
+	metrics = None
+
+	try:
+
+		try:
+
+			summary, panel_app_updates, metrics = running_job['receiver'].recv()
+
+		except EOFError:
+
+			summary = {'status': 'FAILED', 'error': 'The job process stopped without sending its results.', 'no_variants_samples': ''}
+
+		running_job['receiver'].close()
+		running_job['process'].join()
+
+		if len(panel_app_updates) > 0:
+
+			save_server_panel_app_data(state, panel_app_updates)
+
+	except Exception as e:
+
+		logger.error(f'Job {job_id} failed: {e}')
+
+		summary = {'status': 'FAILED', 'error': str(e), 'no_variants_samples': ''}
+
+	record_server_job(state, job_id, summary, metrics)
+
+
+def record_server_job(state, job_id, summary, metrics=None):
+	"""
+	Record how a job went.
+
+	"""
+
+	job_record = state['jobs'][job_id]
+
+	job_record['finished'] = time.time()
+	job_record['seconds'] = round(job_record['finished'] - job_record['started'], 3)
+	job_record['error'] = summary['error']
+	job_record['no_variants_samples'] = [sample for sample in summary['no_variants_samples'].split(',') if sample != '']
+
+	if metrics != None:
+
+		job_record['stages'] = {stage: round(measurement['wall_seconds'], 3) for stage, measurement in metrics['stages'].items()}
+		job_record['peak_rss_mb'] = metrics.get('run', {}).get('peak_rss_mb')
+
+	job_record['status'] = summary['status']
+
+	logger.info(f"Finished job {job_id} in {job_record['seconds']}s: {job_record['status']}")
+
+
+def dispatch_server_jobs(state):
+	"""
+	Start the queued jobs, up to max_jobs at a time, and record each job as its process finishes.
+
+	Every job is forked from this one thread - forking while another job thread is part way through \
+	loading resources or logging can leave the child waiting on a lock which is never released.
+
+	Runs until stop_server_jobs is called and the queued and running jobs have finished.
+
+	"""
+
+	running = {}
+
+	while True:
+
+		# Start queued jobs while there are free slots
+		while len(running) < state['max_jobs']:
+
+			with state['lock']:
+
+				if len(state['queue']) == 0:
+
+					break
+
+				job_id, options = state['queue'].pop(0)
+
+			running_job = start_server_job(state, job_id, options)
+
+			if running_job != None:
+
+				running[running_job['receiver']] = running_job
+
+		with state['lock']:
+
+			if state['stopping'] == True and len(state['queue']) == 0 and len(running) == 0:
+
+				break
+
+		for connection in multiprocessing.connection.wait(list(running) + [state['wake_receiver']]):
+
+			if connection is state['wake_receiver']:
+
+				connection.recv()
+
+			else:
+
+				finish_server_job(state, running.pop(connection))
+
+
+def stop_server_jobs(state):
+	"""
+	Stop taking jobs and wait for the queued and running jobs to finish.
+
+	"""
+
+	with state['lock']:
+
+		state['stopping'] = True
+		state['wake_sender'].send(None)
+
+	state['dispatcher'].join()
+
+
+def get_server_status(state):
+	"""
+	Get when the server started, the files each resource was loaded from and the number of jobs in each state.
+
+	"""
+
+	with state['lock']:
+
+		status = {}
+		status['uptime_seconds'] = round(time.time() - state['started'], 3)
+		status['config_file'] = state['config_file']
+		status['resources'] = {name: None if stamp == None else {'file': stamp[0], 'size': stamp[1], 'mtime': stamp[2]} for name, stamp in state['stamps'].items()}
+		status['jobs'] = {}
+
+		for job_record in state['jobs'].values():
+
+			status['jobs'][job_record['status']] = status['jobs'].get(job_record['status'], 0) + 1
+
+	return status
+
+
+def make_request_handler(state):
+	"""
+	Make the HTTP request handler for a server.
+
+	GET /status = the output of get_server_status
+	GET /jobs = the status of every job
+	GET /jobs/JOB_ID = the status and timings of a job
+	POST /jobs = queue a job with the options in the JSON body - returns the job ID
+	POST /reload = load any resources whose files have changed now rather than before the next job
+
+	"""
+
+	class FilterRequestHandler(BaseHTTPRequestHandler):
+
+		def send_json(self, status_code, data):
+
+			body = json.dumps(data, default=str).encode()
+
+			self.send_response(status_code)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def do_GET(self):
+
+			if self.path == '/status':
+
+				self.send_json(200, get_server_status(state))
+
+			elif self.path == '/jobs':
+
+				self.send_json(200, [dict(job_record) for job_record in state['jobs'].values()])
+
+			elif self.path.startswith('/jobs/') and self.path[len('/jobs/'):] in state['jobs']:
+
+				self.send_json(200, dict(state['jobs'][self.path[len('/jobs/'):]]))
+
+			else:
+
+				self.send_json(404, {'error': f'Not found: {self.path}'})
+
+		def do_POST(self):
+
+			if self.path == '/jobs':
+
+				try:
+
+					job_options = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+					if not isinstance(job_options, dict):
+
+						raise Exception('The job options should be a JSON object.')
+
+					job_id = submit_server_job(state, job_options)
+
+				except Exception as e:
+
+					self.send_json(400, {'error': str(e)})
+					return
+
+				self.send_json(202, {'job_id': job_id, 'status': 'QUEUED'})
+
+			elif self.path == '/reload':
+
+				try:
+
+					self.send_json(200, {'reloaded': refresh_server_resources(state)})
+
+				except Exception as e:
+
+					self.send_json(500, {'error': str(e)})
+
+			else:
+
+				self.send_json(404, {'error': f'Not found: {self.path}'})
+
+		def log_message(self, format, *args):
+
+			logger.debug(format % args)
+
+	return FilterRequestHandler
+
+
+def start_filter_server(state, host='127.0.0.1', port=8765):
+	"""
+	Create the HTTP server for the state - call serve_forever on the result to start taking requests.
+
+	Only listens on localhost by default as there is no authentication.
+
+	"""
+
+	return ThreadingHTTPServer((host, port), make_request_handler(state))
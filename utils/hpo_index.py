@@ -0,0 +1,229 @@
+"""
+Functions for the compiled HPO gene map.
+
+The genes to phenotype file is parsed once and saved as sorted integer coded arrays which are memory \
+mapped by later runs. An index is stored under the sha256 of the file it was made from and is reused \
+while the file is unchanged.
+
+The index is a dictionary of:
+
+genes = sorted gene IDs
+terms = sorted HPO term IDs
+offsets = the terms of genes[i] are gene_terms[offsets[i]:offsets[i + 1]]
+gene_terms = the index in terms of each term of each gene - sorted and unique within each gene
+
+"""
+
+from utils.utils import parse_hpo_file
+from utils.variant_cache import hash_file
+import pandas as pd
+import numpy as np
+import json
+import os
+import shutil
+import tempfile
+
+# Change this if the format of the index changes
+hpo_index_version = 1
+
+hpo_index_arrays = ['genes', 'terms', 'offsets', 'gene_terms']
+
+
+def compile_hpo_index(hpo_file):
+	"""
+	Parse the HPO gene map and convert it to the arrays described above.
+
+	"""
+
+	hpo_dict = parse_hpo_file(hpo_file)
+
+	genes = np.array(sorted(hpo_dict.keys()), dtype=str)
+	terms = np.array(sorted(set(term for gene_terms in hpo_dict.values() for term in gene_terms)), dtype=str)
+
+	term_codes = {term: code for code, term in enumerate(terms)}
+
+	gene_term_codes = [sorted(term_codes[term] for term in hpo_dict[gene]) for gene in genes]
+
+	hpo_index = {}
+	hpo_index['genes'] = genes
+	hpo_index['terms'] = terms
+	hpo_index['offsets'] = np.concatenate([[0], np.cumsum([len(codes) for codes in gene_term_codes])]).astype(np.int64)
+	hpo_index['gene_terms'] = np.array([code for codes in gene_term_codes for code in codes], dtype=np.int32)
+
+	return hpo_index
+
+
+def write_hpo_index(hpo_index, index_dir):
+	"""
+	Write the arrays of an index to index_dir as .npy files.
+
+	The arrays are written to a temporary directory first so other runs never see half written indexes.
+
+	"""
+
+	parent_dir = os.path.dirname(os.path.abspath(index_dir))
+
+	temp_dir = tempfile.mkdtemp(dir=parent_dir, suffix='.tmp')
+
+	try:
+
+		for name in hpo_index_arrays:
+
+			np.save(os.path.join(temp_dir, f'{name}.npy'), hpo_index[name])
+
+		os.chmod(temp_dir, 0o755)
+
+		os.rename(temp_dir, index_dir)
+
+	except OSError:
+
+		shutil.rmtree(temp_dir, ignore_errors=True)
+
+		# Another run wrote the same index first
+		if not os.path.exists(index_dir):
+
+			raise
+
+
+def read_hpo_index(index_dir):
+	"""
+	Memory map the arrays of an index.
+
+	"""
+
+	return {name: np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r') for name in hpo_index_arrays}
+
+
+def load_hpo_index(hpo_file, index_root=None):
+	"""
+	Get the index for an HPO gene map, compiling it if it has not been compiled before.
+
+	index_root = where to keep the index - defaults to HPO_FILE.index next to the HPO file
+
+	The size and modification time of the file are checked first and the file is only hashed if \
+	they have changed. If the index can't be written e.g. the directory is read only it is compiled \
+	in memory for this run.
+
+	"""
+
+	if index_root == None:
+
+		index_root = f'{hpo_file}.index'
+
+	stamp_file = os.path.join(index_root, 'source.json')
+
+	file_stat = os.stat(hpo_file)
+
+	stamp = {'version': hpo_index_version, 'file': os.path.abspath(hpo_file), 'size': file_stat.st_size, 'mtime': file_stat.st_mtime}
+
+	# Skip hashing the file if it has not been touched since the index was made
+	try:
+
+		with open(stamp_file) as f:
+
+			saved_stamp = json.load(f)
+
+	except (OSError, ValueError):
+
+		saved_stamp = {}
+
+	checksum = saved_stamp.get('sha256')
+
+	if checksum == None or {key: saved_stamp.get(key) for key in stamp} != stamp:
+
+		checksum = hash_file(hpo_file)
+
+	index_dir = os.path.join(index_root, f'v{hpo_index_version}_{checksum}')
+
+	if os.path.exists(index_dir):
+
+		hpo_index = read_hpo_index(index_dir)
+
+	else:
+
+		hpo_index = compile_hpo_index(hpo_file)
+
+		try:
+
+			os.makedirs(index_root, exist_ok=True)
+
+			write_hpo_index(hpo_index, index_dir)
+
+		except OSError:
+
+			return hpo_index
+
+		# Runs which already have an older index memory mapped can carry on using it after it is removed
+		for name in os.listdir(index_root):
+
+			if name.startswith('v') and os.path.join(index_root, name) != index_dir:
+
+				shutil.rmtree(os.path.join(index_root, name), ignore_errors=True)
+
+	stamp['sha256'] = checksum
+
+	if stamp != saved_stamp:
+
+		try:
+
+			temp_file, temp_path = tempfile.mkstemp(dir=index_root, suffix='.tmp')
+
+			with os.fdopen(temp_file, 'w') as f:
+
+				json.dump(stamp, f)
+
+			os.chmod(temp_path, 0o644)
+			os.replace(temp_path, stamp_file)
+
+		except OSError:
+
+			pass
+
+	return hpo_index
+
+
+def count_hpo_matches(genes, patient_hpos, hpo_index):
+	"""
+	Count how many of the patient HPO terms are linked to each gene.
+
+	Each unique gene is only looked up once. Genes which are missing or not in the index get 0.
+
+	Returns a numpy array with a count for each gene.
+
+	"""
+
+	gene_codes, unique_genes = pd.factorize(pd.Series(genes, dtype=object))
+
+	counts = np.zeros(len(unique_genes), dtype=np.int64)
+
+	index_genes = hpo_index['genes']
+	index_terms = hpo_index['terms']
+
+	if len(index_genes) > 0 and len(unique_genes) > 0:
+
+		# Which of the terms in the index the patient has
+		patient_terms = np.unique(np.array([term for term in patient_hpos if isinstance(term, str)], dtype=str))
+
+		term_positions = np.minimum(np.searchsorted(index_terms, patient_terms), len(index_terms) - 1)
+
+		has_term = np.zeros(len(index_terms), dtype=bool)
+		has_term[term_positions[index_terms[term_positions] == patient_terms]] = True
+
+		# Number of patient terms up to each position in gene_terms
+		matches = np.concatenate([[0], np.cumsum(has_term[hpo_index['gene_terms']])])
+
+		unique_genes = np.asarray(unique_genes, dtype=str)
+
+		gene_positions = np.minimum(np.searchsorted(index_genes, unique_genes), len(index_genes) - 1)
+
+		in_index = index_genes[gene_positions] == unique_genes
+
+		offsets = hpo_index['offsets']
+
+		counts[in_index] = matches[offsets[gene_positions[in_index] + 1]] - matches[offsets[gene_positions[in_index]]]
+
+	gene_counts = np.zeros(len(gene_codes), dtype=np.int64)
+
+	gene_counts[gene_codes != -1] = counts[gene_codes[gene_codes != -1]]
+
+	return gene_counts
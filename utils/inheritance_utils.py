@@ -3,6 +3,26 @@ Functions for working out the inheritiance of variants.
 
 """
 
+from utils.utils import get_alt_dosage
+import numpy as np
+import pandas as pd
+
+# The prefix of the config settings for the frequency filter of each workflow and whether it also filters on AC
+workflow_filter_settings = {
+	'OTHER': ('other', True),
+	'COMPOUND_HET': ('compound_het', False),
+	'UNIPARENTAL_ISODISOMY': ('upi', False),
+	'MITOCHONDRIAL': ('mito', False),
+	'RECCESSIVE_X_FEMALE': ('reccessive_x_female', True),
+	'RECCESSIVE_AUTOSOMAL': ('reccessive_autosomal', True),
+	'X_LINKED_MALE': ('x_linked_male', True),
+	'Y_LINKED_MALE': ('y_linked_male', True),
+	'DOMINANT_AUTOSOMAL': ('dom_autosomal', True),
+	'DOMINANT_X_FEMALE': ('dom_x_female', True),
+	'DE_NOVO_HC': ('de_novo', True),
+	'DE_NOVO_LC': ('de_novo', True),
+}
+
 def is_compound_het(chrom, ref, alt, sample_gt, sample_sex,transcript, compound_het_dict):
 	"""
 	Takes a transcript and returns True if the transcript has more than one variant in.
@@ -371,3 +391,234 @@ def annotate_workflow_single(df,sample, sample_sex, compound_het_dict):
 
 	return '|'.join(workflows)
 
+
+# The workflows in the order they are added to the annotation - the position is the bit used in the workflow bitmask
+workflow_bits = ['COMPOUND_HET', 'DOMINANT_AUTOSOMAL', 'DOMINANT_X_FEMALE', 'X_LINKED_MALE', 'Y_LINKED_MALE', 'RECCESSIVE_AUTOSOMAL',
+	'RECCESSIVE_X_FEMALE', 'MITOCHONDRIAL', 'DE_NOVO_HC', 'DE_NOVO_LC', 'UNIPARENTAL_ISODISOMY', 'OTHER']
+
+
+def get_workflow_flags(df, sample, sample_sex, compound_het_dict):
+	"""
+	Vectorised version of the single sample checks in annotate_workflow_single.
+
+	Returns a dictionary of workflow name to a boolean array along with the chromosome masks \
+	and ALT allele count needed for the trio checks.
+
+	"""
+
+	chrom = df['CHROM'].values
+	alt_count = get_alt_dosage(df, sample)
+
+	is_x = chrom == 'X'
+	is_y = chrom == 'Y'
+	is_mt = chrom == 'MT'
+	is_autosome = ~(is_x | is_y | is_mt)
+
+	is_female = sample_sex == 'Female'
+	is_male = sample_sex == 'Male'
+
+	transcript_count = df['Feature'].astype(object).map(compound_het_dict).fillna(0).values
+
+	flags = {}
+	flags['COMPOUND_HET'] = (is_autosome | (is_x & is_female)) & (transcript_count > 1) & (alt_count == 1)
+	flags['DOMINANT_AUTOSOMAL'] = (alt_count == 1) & is_autosome
+	flags['DOMINANT_X_FEMALE'] = (alt_count == 1) & is_x & is_female
+	flags['X_LINKED_MALE'] = (alt_count >= 1) & is_x & is_male
+	flags['Y_LINKED_MALE'] = (alt_count >= 1) & is_y & is_male
+	flags['RECCESSIVE_AUTOSOMAL'] = (alt_count == 2) & is_autosome
+	flags['RECCESSIVE_X_FEMALE'] = (alt_count == 2) & is_x & is_female
+	flags['MITOCHONDRIAL'] = (alt_count >= 1) & is_mt
+
+	return flags, is_autosome, is_x, alt_count
+
+
+def workflow_flags_to_strings(flags, n_rows):
+	"""
+	Pack the workflow flags into a bitmask and turn each distinct bitmask into a workflow \
+	annotation e.g. COMPOUND_HET|DOMINANT_AUTOSOMAL.
+
+	"""
+
+	bitmask = np.zeros(n_rows, dtype=np.int64)
+
+	for bit, workflow in enumerate(workflow_bits):
+
+		if workflow in flags:
+
+			bitmask = bitmask | (flags[workflow].astype(np.int64) << bit)
+
+	unique_bitmasks, bitmask_codes = np.unique(bitmask, return_inverse=True)
+
+	workflow_strings = ['|'.join(workflow for bit, workflow in enumerate(workflow_bits) if value & (1 << bit)) for value in unique_bitmasks]
+
+	return np.array(workflow_strings, dtype=object)[bitmask_codes]
+
+
+def annotate_workflows_trio(df, sample, mother, father, sample_sex, compound_het_dict, min_parental_depth_dn, min_parental_gq_dn, min_parental_depth_uid, min_parental_gq_uid, gt_depth_tag):
+	"""
+	Vectorised version of annotate_workflow_trio - returns the workflow annotation for every row of the dataframe.
+
+	"""
+
+	flags, is_autosome, is_x, alt_count = get_workflow_flags(df, sample, sample_sex, compound_het_dict)
+
+	mother_alt_count = get_alt_dosage(df, mother)
+	father_alt_count = get_alt_dosage(df, father)
+
+	mother_dp = pd.to_numeric(df['sample_' + mother + '_' + gt_depth_tag], errors='coerce').values
+	father_dp = pd.to_numeric(df['sample_' + father + '_' + gt_depth_tag], errors='coerce').values
+	mother_gq = pd.to_numeric(df['sample_' + mother + '_GQ'], errors='coerce').values
+	father_gq = pd.to_numeric(df['sample_' + father + '_GQ'], errors='coerce').values
+
+	with np.errstate(invalid='ignore'):
+
+		parents_pass_dn = (mother_dp >= min_parental_depth_dn) & (father_dp >= min_parental_depth_dn) & (mother_gq >= min_parental_gq_dn) & (father_gq >= min_parental_gq_dn)
+		parents_pass_uid = (mother_dp >= min_parental_depth_uid) & (father_dp >= min_parental_depth_uid) & (mother_gq >= min_parental_gq_uid) & (father_gq >= min_parental_gq_uid)
+
+	is_de_novo = (alt_count >= 1) & (mother_alt_count == 0) & (father_alt_count == 0)
+
+	flags['DE_NOVO_HC'] = is_de_novo & parents_pass_dn
+	flags['DE_NOVO_LC'] = is_de_novo & ~parents_pass_dn
+
+	from_mother = (mother_alt_count == 1) & (father_alt_count == 0)
+	from_father = (father_alt_count == 1) & (mother_alt_count == 0)
+	from_hom_father = (mother_alt_count == 0) & (father_alt_count == 2)
+
+	if sample_sex == 'Female':
+
+		from_one_parent = np.where(is_autosome, from_mother | from_father, is_x & (from_mother | from_hom_father))
+
+	else:
+
+		from_one_parent = is_autosome & (from_mother | from_father)
+
+	flags['UNIPARENTAL_ISODISOMY'] = (alt_count == 2) & from_one_parent & parents_pass_uid
+
+	# If the variant does not fit in any then add other
+	n_flags = sum(flag.astype(np.int64) for flag in flags.values())
+
+	flags['OTHER'] = (n_flags == 0) | ((n_flags == 1) & (flags['DE_NOVO_HC'] | flags['DE_NOVO_LC']))
+
+	return workflow_flags_to_strings(flags, df.shape[0])
+
+
+def annotate_workflows_single(df, sample, sample_sex, compound_het_dict):
+	"""
+	Vectorised version of annotate_workflow_single - returns the workflow annotation for every row of the dataframe.
+
+	"""
+
+	flags, is_autosome, is_x, alt_count = get_workflow_flags(df, sample, sample_sex, compound_het_dict)
+
+	# If the variant does not fit in any then add other
+	flags['OTHER'] = ~np.logical_or.reduce(list(flags.values()))
+
+	return workflow_flags_to_strings(flags, df.shape[0])
+
+
+def compile_workflow_filters(config_dict):
+	"""
+	Build a table of the frequency filter settings for each workflow in wf_restrictiveness.
+
+	Returns a dictionary with:
+
+	ranks = dictionary of workflow to its position in wf_restrictiveness - lower is less restrictive
+	gnomadg, gnomade, ac = arrays of the cutoffs for each workflow in wf_restrictiveness order. \
+	The ac cutoff is NaN for workflows which do not filter on AC.
+	has_settings = array of whether we know how to filter each workflow
+
+	"""
+
+	wf_restrictiveness = config_dict['wf_restrictiveness']
+
+	ranks = {}
+
+	for rank, workflow in enumerate(wf_restrictiveness):
+
+		if workflow not in ranks:
+
+			ranks[workflow] = rank
+
+	gnomadg = np.full(len(wf_restrictiveness), np.nan)
+	gnomade = np.full(len(wf_restrictiveness), np.nan)
+	ac = np.full(len(wf_restrictiveness), np.nan)
+	has_settings = np.zeros(len(wf_restrictiveness), dtype=bool)
+
+	for rank, workflow in enumerate(wf_restrictiveness):
+
+		if workflow not in workflow_filter_settings:
+
+			continue
+
+		prefix, filter_on_ac = workflow_filter_settings[workflow]
+
+		gnomadg[rank] = config_dict[f'{prefix}_gnomadg']
+		gnomade[rank] = config_dict[f'{prefix}_gnomade']
+
+		if filter_on_ac == True:
+
+			ac[rank] = config_dict[f'{prefix}_ac']
+
+		has_settings[rank] = True
+
+	workflow_filters = {}
+	workflow_filters['ranks'] = ranks
+	workflow_filters['wf_restrictiveness'] = wf_restrictiveness
+	workflow_filters['gnomadg'] = gnomadg
+	workflow_filters['gnomade'] = gnomade
+	workflow_filters['ac'] = ac
+	workflow_filters['has_settings'] = has_settings
+
+	return workflow_filters
+
+
+def get_workflow_frequency_flags(df, workflow_filters):
+	"""
+	Whether each row passes the frequency filter of each workflow. This does not depend on the sample \
+	so can be worked out once for all samples.
+
+	Returns a boolean array with a row for each row of df and a column for each workflow in wf_restrictiveness.
+
+	"""
+
+	gnomadg = df['gnomADg_AF_POPMAX'].values.astype(float)[:, np.newaxis]
+	gnomade = df['gnomADe_AF_POPMAX'].values.astype(float)[:, np.newaxis]
+	ac = df['AC'].values.astype(float)[:, np.newaxis]
+
+	filter_on_ac = ~np.isnan(workflow_filters['ac'])
+
+	with np.errstate(invalid='ignore'):
+
+		passes_gnomadg = (gnomadg < workflow_filters['gnomadg']) | np.isnan(gnomadg)
+		passes_gnomade = (gnomade < workflow_filters['gnomade']) | np.isnan(gnomade)
+		passes_ac = (ac < workflow_filters['ac']) | ~filter_on_ac
+
+	return passes_gnomadg & passes_gnomade & passes_ac
+
+
+def get_least_restrictive_workflows(workflows, workflow_filters):
+	"""
+	For each workflow annotation e.g. DOMINANT_AUTOSOMAL|DE_NOVO_HC get the position in wf_restrictiveness \
+	of the least restrictive workflow.
+
+	"""
+
+	ranks = workflow_filters['ranks']
+
+	least_restrictive = np.zeros(len(workflows), dtype=np.int64)
+
+	for i, workflow in enumerate(workflows):
+
+		for wf in workflow.split('|'):
+
+			if wf not in ranks:
+
+				raise Exception(f'Unknown workflow {wf} - add it to wf_restrictiveness in the config file.')
+
+		least_restrictive[i] = min(ranks[wf] for wf in workflow.split('|'))
+
+		if workflow_filters['has_settings'][least_restrictive[i]] == False:
+
+			raise Exception('Unknown workflow')
+
+	return least_restrictive
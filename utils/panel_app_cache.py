@@ -0,0 +1,167 @@
+"""
+Functions for storing the PanelApp data in a SQLite database rather than the TSV dump.
+
+The database is keyed on gene symbol and can be shared by several runs at the same time - each run \
+only writes the genes it has fetched and the writes are done in a single transaction.
+
+"""
+
+from utils.utils import parse_panel_app_dump
+import sqlite3
+import datetime
+import time
+import os
+
+panel_app_cache_schema = """
+CREATE TABLE IF NOT EXISTS panel_app (
+	gene TEXT PRIMARY KEY,
+	disease TEXT,
+	inheritance TEXT,
+	fetched REAL NOT NULL,
+	expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS panel_app_expires ON panel_app (expires);
+CREATE TABLE IF NOT EXISTS imported_dumps (
+	dump TEXT PRIMARY KEY,
+	imported REAL NOT NULL
+);
+"""
+
+
+def open_panel_app_cache(panel_app_cache):
+	"""
+	Open the PanelApp database, creating it if it does not exist.
+
+	"""
+
+	# Wait for other runs to finish writing rather than failing straight away
+	connection = sqlite3.connect(panel_app_cache, timeout=60)
+
+	connection.execute('PRAGMA journal_mode=WAL')
+
+	connection.executescript(panel_app_cache_schema)
+
+	return connection
+
+
+def panel_app_date_to_epoch(date):
+	"""
+	Convert a date from the PanelApp dump e.g. 2019-03-01 12:00:00.123456 to seconds since the epoch.
+
+	Returns None if the date can't be parsed.
+
+	"""
+
+	for date_format in ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']:
+
+		try:
+
+			return datetime.datetime.strptime(date, date_format).timestamp()
+
+		except (ValueError, TypeError):
+
+			continue
+
+	return None
+
+
+def import_panel_app_dump(connection, panel_app_dump, panel_app_dump_max_time):
+	"""
+	Copy the data from a TSV dump written by write_panel_app_dump into the database.
+
+	Each dump is only imported once and genes already in the database with newer data are left alone.
+
+	Returns the number of genes imported or None if the dump has been imported before.
+
+	"""
+
+	dump = os.path.abspath(panel_app_dump)
+
+	if connection.execute('SELECT 1 FROM imported_dumps WHERE dump = ?', (dump,)).fetchone() != None:
+
+		return None
+
+	panel_app_dict = parse_panel_app_dump(panel_app_dump)
+
+	rows = []
+
+	for gene, gene_info in panel_app_dict.items():
+
+		fetched = panel_app_date_to_epoch(gene_info['date'])
+
+		# Skips the header line of the dump
+		if fetched == None:
+
+			continue
+
+		rows.append((gene, gene_info['disease'], gene_info['inheritance'], fetched, fetched + panel_app_dump_max_time * 86400))
+
+	with connection:
+
+		# Another run may have imported the dump since we checked - claiming it first in the same transaction means only one run imports it
+		if connection.execute('INSERT OR IGNORE INTO imported_dumps (dump, imported) VALUES (?, ?)', (dump, time.time())).rowcount == 0:
+
+			return None
+
+		upsert_panel_app_rows(connection, rows)
+
+	return len(rows)
+
+
+def read_panel_app_cache(connection):
+	"""
+	Read the genes which have not expired from the database into the same format as parse_panel_app_dump.
+
+	"""
+
+	panel_app_dict = {}
+
+	for gene, disease, inheritance, fetched in connection.execute('SELECT gene, disease, inheritance, fetched FROM panel_app WHERE expires > ?', (time.time(),)):
+
+		panel_app_dict[gene] = {}
+		panel_app_dict[gene]['date'] = str(datetime.datetime.fromtimestamp(fetched))
+		panel_app_dict[gene]['disease'] = disease
+		panel_app_dict[gene]['inheritance'] = inheritance
+
+	return panel_app_dict
+
+
+def upsert_panel_app_rows(connection, rows):
+	"""
+	Insert or update genes in the database - if another run has stored newer data for a gene then keep that.
+
+	Uses INSERT OR REPLACE rather than ON CONFLICT DO UPDATE so it works with SQLite older than 3.24.
+
+	"""
+
+	connection.executemany(
+		'INSERT OR REPLACE INTO panel_app (gene, disease, inheritance, fetched, expires) SELECT ?, ?, ?, ?, ? '
+		'WHERE NOT EXISTS (SELECT 1 FROM panel_app WHERE gene = ? AND fetched > ?)',
+		[row + (row[0], row[3]) for row in rows])
+
+
+def update_panel_app_cache(connection, panel_app_updates, panel_app_dump_max_time):
+	"""
+	Write the genes fetched during this run to the database in a single transaction.
+
+	Returns the number of genes written.
+
+	"""
+
+	rows = []
+
+	for gene, gene_info in panel_app_updates.items():
+
+		fetched = panel_app_date_to_epoch(gene_info['date'])
+
+		if not isinstance(gene, str) or fetched == None:
+
+			continue
+
+		rows.append((gene, gene_info['disease'], gene_info['inheritance'], fetched, fetched + panel_app_dump_max_time * 86400))
+
+	with connection:
+
+		upsert_panel_app_rows(connection, rows)
+
+	return len(rows)
@@ -0,0 +1,1473 @@
+"""
+Functions for running the filtering pipeline.
+
+Shared by germline_variant_filter.py and the batch runner so that reference data can be \
+loaded once and reused for several jobs.
+
+"""
+
+from utils.utils import *
+from utils.inheritance_utils import *
+from utils.panel_app_cache import *
+from utils.variant_cache import *
+from utils.profiling import *
+from utils.hpo_index import *
+from utils.regions import *
+import pandas as pd
+import numpy as np
+import logging
+import multiprocessing
+import os
+import time
+import contextlib
+import resource
+import json
+import sys
+
+version = '0.0.1'
+
+logger = logging.getLogger('germline_variant_filter')
+
+# Set before forking worker processes so the workers can see the filtered variants without them being pickled.
+worker_state = {}
+
+
+def get_peak_memory_mb():
+	"""
+	Peak resident memory of this process in MB.
+
+	"""
+
+	peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+	# ru_maxrss is in bytes on macOS and KB on Linux
+	if sys.platform == 'darwin':
+
+		return peak_memory / 1024 ** 2
+
+	return peak_memory / 1024
+
+
+def new_metrics():
+	"""
+	Empty metrics for measure_stage to fill in.
+
+	"""
+
+	return {'stages': {}, 'samples': {}}
+
+
+@contextlib.contextmanager
+def measure_stage(job, stage, sample=None):
+	"""
+	Record the wall and CPU time, the growth in peak memory and the rows going in and out of the \
+	with block in job['metrics']['stages'][stage] and, if sample is given, in \
+	job['metrics']['samples'][sample][stage].
+
+	The rows are counted by setting rows_in and rows_out on the yielded dictionary. Stages which run \
+	more than once e.g. for each chunk are added together.
+
+	If the job has a profile from new_profile the stage is also profiled.
+
+	Does nothing if the job has no metrics or profile.
+
+	"""
+
+	metrics = job.get('metrics')
+	profile = job.get('profile')
+
+	stage_rows = {}
+
+	if metrics == None and profile == None:
+
+		yield stage_rows
+		return
+
+	wall_start = time.perf_counter()
+	cpu_start = time.process_time()
+	peak_memory_start = get_peak_memory_mb()
+
+	if profile != None:
+
+		start_stage_profile(profile, stage)
+
+	try:
+
+		yield stage_rows
+
+	finally:
+
+		if profile != None:
+
+			stop_stage_profile(profile)
+
+		if metrics != None:
+
+			measurement = {}
+			measurement['calls'] = 1
+			measurement['wall_seconds'] = time.perf_counter() - wall_start
+			measurement['cpu_seconds'] = time.process_time() - cpu_start
+			measurement['peak_rss_delta_mb'] = get_peak_memory_mb() - peak_memory_start
+			measurement.update(stage_rows)
+
+			add_stage_metrics(metrics['stages'], stage, measurement)
+
+			if sample != None:
+
+				add_stage_metrics(metrics['samples'].setdefault(sample, {}), stage, measurement)
+
+
+def add_stage_metrics(stages, stage, measurement):
+	"""
+	Add a measurement from measure_stage to the totals for the stage.
+
+	"""
+
+	if stage not in stages:
+
+		stages[stage] = dict(measurement)
+
+	else:
+
+		for key, value in measurement.items():
+
+			stages[stage][key] = stages[stage].get(key, 0) + value
+
+
+def merge_metrics(metrics, other_metrics):
+	"""
+	Add the metrics recorded by a worker process to metrics.
+
+	"""
+
+	for stage, measurement in other_metrics['stages'].items():
+
+		add_stage_metrics(metrics['stages'], stage, measurement)
+
+	for sample, stages in other_metrics['samples'].items():
+
+		for stage, measurement in stages.items():
+
+			add_stage_metrics(metrics['samples'].setdefault(sample, {}), stage, measurement)
+
+
+def write_metrics(metrics, metrics_file):
+	"""
+	Write the metrics as JSON along with the filter funnel - the rows going in and out of each stage \
+	which counts them in the order they first ran.
+
+	"""
+
+	metrics['funnel'] = [{'stage': stage, 'rows_in': measurement['rows_in'], 'rows_out': measurement['rows_out']}
+		for stage, measurement in metrics['stages'].items() if 'rows_in' in measurement and 'rows_out' in measurement]
+
+	with open(metrics_file, 'w') as f:
+
+		json.dump(metrics, f, indent=2)
+
+
+def load_resources(config_dict, add_gnomad_constraint_scores, add_panel_app_info, local_panel_app_dump, add_hpo, panel_app_cache=None):
+	"""
+	Load the reference data which is shared between jobs - the gnomad constraint scores, \
+	the local PanelApp data and the HPO gene map.
+
+	If panel_app_cache is given the PanelApp data is read from that database and local_panel_app_dump \
+	is only used to import an old TSV dump into it.
+
+	"""
+
+	resources = {}
+
+	# Load Gnomad gene constraint scores
+	if add_gnomad_constraint_scores == True:
+
+		logger.info('Parsing gnomad constraint scores.')
+		gnomad_constraint_metrics = config_dict.get('gnomad_constraint_metrics', default_gnomad_constraint_metrics)
+		resources['gnomad_constraint_df'] = load_gnomad_constraint(config_dict['gnomad_gene_scores'], gnomad_constraint_metrics)
+
+	# If we want to add panel app data
+	if add_panel_app_info == True:
+
+		if panel_app_cache != None:
+
+			logger.info('Reading PanelApp cache.')
+
+			connection = open_panel_app_cache(panel_app_cache)
+
+			# One off import of the old TSV dump
+			if local_panel_app_dump != None and os.path.exists(local_panel_app_dump):
+
+				imported = import_panel_app_dump(connection, local_panel_app_dump, config_dict['panel_app_dump_max_time'])
+
+				if imported != None:
+
+					logger.info(f'Imported {imported} genes from the local Panel App dump into the PanelApp cache.')
+
+			resources['panel_app_dict'] = read_panel_app_cache(connection)
+
+			connection.close()
+
+		elif local_panel_app_dump != None:
+
+			logger.info('Reading Local Panel App data.')
+
+			try:
+
+				resources['panel_app_dict'] = parse_panel_app_dump(local_panel_app_dump)
+				
+			except:
+
+				logger.info('Could not local Panel App data.')
+				resources['panel_app_dict'] = {}
+		else:
+
+			resources['panel_app_dict'] = {}
+
+		# Copy of what was loaded so we can tell which genes have been fetched during the run
+		resources['panel_app_loaded'] = dict(resources['panel_app_dict'])
+
+	# If we want to annotate variants with HPO matches
+	if add_hpo == True:
+
+		logger.info('Loading HPO Gene Map index.')
+
+		# Compiled the first time the file is seen - see utils/hpo_index.py
+		resources['hpo_index'] = load_hpo_index(config_dict['hpo_file'], config_dict.get('hpo_index_dir'))
+
+	return resources
+
+
+def get_panel_app_updates(panel_app_before, panel_app_dict):
+	"""
+	Get the PanelApp entries which have been added or replaced since panel_app_before was copied.
+
+	"""
+
+	panel_app_updates = {}
+
+	for gene, gene_info in panel_app_dict.items():
+
+		if panel_app_before.get(gene) is not gene_info:
+
+			panel_app_updates[gene] = gene_info
+
+	return panel_app_updates
+
+
+def save_panel_app_data(resources, config_dict, local_panel_app_dump, panel_app_cache=None):
+	"""
+	Store the PanelApp data so it can be reused by later runs. If there is a PanelApp cache only the genes \
+	fetched during this run are written to it, otherwise the whole TSV dump is rewritten.
+
+	"""
+
+	if panel_app_cache != None:
+
+		panel_app_updates = get_panel_app_updates(resources['panel_app_loaded'], resources['panel_app_dict'])
+
+		connection = open_panel_app_cache(panel_app_cache)
+
+		updated = update_panel_app_cache(connection, panel_app_updates, config_dict['panel_app_dump_max_time'])
+
+		connection.close()
+
+		logger.info(f'Updated {updated} genes in the PanelApp cache.')
+
+	elif local_panel_app_dump != None:
+
+		write_panel_app_dump(resources['panel_app_dict'], local_panel_app_dump)
+
+
+def read_input_chunks(options, samples, gt_depth_tag, regions=None):
+	"""
+	Read the input CSV or VCF.
+
+	If regions is given VCF records outside them are skipped as they are read, and if the CSV is \
+	coordinate sorted only the rows which overlap the regions are parsed.
+
+	Returns a list containing a single dataframe or, if options['chunk_size'] is set, an iterator of chunks.
+
+	"""
+
+	chunk_size = options['chunk_size']
+
+	if options['vcf_file'] != None:
+
+		logger.info('Parsing VCF into dataframe.')
+
+		input_chunks = read_vcf_chunks(options['vcf_file'], samples, ['GT', 'GQ', gt_depth_tag], chunk_size, regions)
+
+		if chunk_size != None:
+
+			return group_variant_chunks(input_chunks)
+
+		return list(input_chunks)
+
+	logger.info('Parsing CSV into dataframe.')
+
+	if regions != None:
+
+		row_ranges = get_region_row_ranges(options['csv_file'], regions)
+
+		if row_ranges != None:
+
+			logger.info(f'Reading the {sum(end - start for start, end in row_ranges)} rows of the sorted input which overlap the regions.')
+
+			input_chunks = read_region_rows(options['csv_file'], row_ranges, chunk_size)
+
+			if chunk_size != None:
+
+				return group_variant_chunks(input_chunks)
+
+			return list(input_chunks)
+
+		logger.info('The input is not coordinate sorted so all of it will be read.')
+
+	if chunk_size != None:
+
+		return read_variant_chunks(options['csv_file'], chunk_size)
+
+	# Parse CSV into dataframe
+	return [pd.read_csv(options['csv_file'], sep='\t', dtype={'CHROM': object})]
+
+
+def filter_variants(df, job):
+	"""
+	Apply the variant level filters (quality, frequency and consequence) to a dataframe read \
+	from the input CSV and split the CSQ field so that each transcript is on its own row.
+
+	Returns the transcripts which pass the filters.
+
+	"""
+
+	options = job['options']
+	config_dict = job['config_dict']
+	samples = job['samples']
+
+	csq_desc = options['csq_desc']
+	csq_projection = job['csq_projection']
+	vep_fields = config_dict['vep_fields']
+	parse_splice_ai = options['parse_splice_ai']
+	smart_synonymous_filtering = options['smart_synonymous_filtering']
+
+	min_dp = config_dict['min_dp']
+	min_gq = config_dict['min_gq']
+	gt_depth_tag = config_dict['gt_depth_tag']
+
+	default_cutoff_gnomad_genomes = config_dict['default_cutoff_gnomad_genomes']
+	default_cutoff_gnomad_exomes = config_dict['default_cutoff_gnomad_exomes']
+	splice_ai_cutoff = config_dict['splice_ai_cutoff']
+	consequence_ranks = job['consequence_ranks']
+
+	# Remove the variants outside the regions - most are already skipped when the input is read
+	if job['regions'] != None:
+
+		with measure_stage(job, 'regions') as stage_rows:
+
+			stage_rows['rows_in'] = df.shape[0]
+
+			df = df[get_regions_mask(df['CHROM'].values, df['POS'].values, df['REF'].values, job['regions'])]
+
+			stage_rows['rows_out'] = df.shape[0]
+
+	with measure_stage(job, 'qc') as stage_rows:
+
+		stage_rows['rows_in'] = df.shape[0]
+
+		# Filter out variants that fail variant level QC
+		df = df[(df['FILTER'] == 'PASS') | (df['FILTER'] == '') | (pd.isna(df['FILTER']))]
+
+		stage_rows['rows_out'] = df.shape[0]
+
+	with measure_stage(job, 'frequency_prefilter') as stage_rows:
+
+		stage_rows['rows_in'] = df.shape[0]
+
+		# Remove the variants which fail the frequency filter in every transcript before the CSQ is split
+		if 'gnomADg_AF_POPMAX' in csq_desc and 'gnomADe_AF_POPMAX' in csq_desc:
+
+			df = df[get_csq_frequency_mask(df['CSQ'].values, csq_desc, default_cutoff_gnomad_genomes, default_cutoff_gnomad_exomes)]
+
+		stage_rows['rows_out'] = df.shape[0]
+
+	with measure_stage(job, 'genotypes'):
+
+		# Parse the genotypes once - the dosage columns are used by the per sample stages rather than the GT strings
+		genotype_df = decode_genotypes(df, samples, gt_depth_tag)
+
+		for column in genotype_df.columns:
+			df[column] = genotype_df[column]
+
+		# For each sample in the PED file create a column which specifies whether the variant is relevant for that sample
+		relevant_df = select_variants_for_samples(df, samples, min_dp, min_gq, gt_depth_tag)
+
+		for column in relevant_df.columns:
+			df[column] = relevant_df[column]
+
+	with measure_stage(job, 'csq_split') as stage_rows:
+
+		stage_rows['rows_in'] = df.shape[0]
+
+		# Fix column names
+		df.columns = fix_column_names(df.columns)
+
+		# Store the repeated strings once before they are copied for each transcript
+		if options['compact_dtypes'] == True:
+
+			df = compact_dtypes(df, ['CHROM'] + [f'sample_{sample}_GT' for sample in samples])
+
+		# Parse CSQ data - putting each consequence block on its own line.
+		vep_df = split_vep_transcripts(df, csq_desc, vep_fields, list(df.columns), csq_projection)
+
+		# We don't need the raw CSQ string once it has been split
+		vep_df = vep_df.drop(columns=['CSQ'])
+
+		if options['compact_dtypes'] == True:
+
+			vep_df = compact_dtypes(vep_df, categorical_columns)
+
+		stage_rows['rows_out'] = vep_df.shape[0]
+
+	# Nothing left to filter - can happen when reading the input in chunks
+	if vep_df.shape[0] == 0:
+
+		return vep_df
+
+	# Initial Frequency Filter
+
+	with measure_stage(job, 'frequency') as stage_rows:
+
+		logger.info('Filtering on default filtering settings.')
+
+		stage_rows['rows_in'] = vep_df.shape[0]
+
+		#Parse columns where we have two results e.g 0.001&0.3
+		vep_df['gnomADg_AF_POPMAX'] = vep_df.apply(fix_gnomad, axis=1, args=('gnomADg_AF_POPMAX',))
+		vep_df['gnomADe_AF_POPMAX'] = vep_df.apply(fix_gnomad, axis=1, args=('gnomADe_AF_POPMAX',))
+		vep_df['gnomADg_AF_POPMAX'] = pd.to_numeric(vep_df['gnomADg_AF_POPMAX'])
+		vep_df['gnomADe_AF_POPMAX'] = pd.to_numeric(vep_df['gnomADe_AF_POPMAX'])
+
+
+		vep_df.fillna(value = {'gnomADg_AF_POPMAX':0.0, 'gnomADe_AF_POPMAX':0.0}, inplace=True)
+
+		# Filter on gnomad genomes and exomes - if data is missing or we have less than largest cutoff  e.g. (1%)
+		vep_df = vep_df[((vep_df['gnomADg_AF_POPMAX'] <= default_cutoff_gnomad_genomes) | (pd.isna(vep_df['gnomADg_AF_POPMAX']) )) &
+					   ((vep_df['gnomADe_AF_POPMAX'] <= default_cutoff_gnomad_exomes ) | (pd.isna(vep_df['gnomADe_AF_POPMAX'])))]
+
+		stage_rows['rows_out'] = vep_df.shape[0]
+
+	if vep_df.shape[0] == 0:
+
+		return vep_df
+
+	with measure_stage(job, 'variant_id'):
+
+		# Also create the variant key e.g.12:12345A>G
+		vep_df['VariantId'] = vep_df.apply(get_variant_key,axis=1)
+
+	# Process SpliceAI columns if requested
+
+	with measure_stage(job, 'splice_ai'):
+
+		if parse_splice_ai == True:
+
+			logger.info('Fixing SpliceAI columns.')
+
+			# Apply fix for splice AI columns
+
+			vep_df['SpliceAI_DS_AG'] = vep_df.apply(fix_splice_ai, axis=1, args=('SpliceAI_DS_AG',))
+			vep_df['SpliceAI_DS_AL'] = vep_df.apply(fix_splice_ai, axis=1, args=('SpliceAI_DS_AL',))
+			vep_df['SpliceAI_DS_DG'] = vep_df.apply(fix_splice_ai, axis=1, args=('SpliceAI_DS_DG',))
+			vep_df['SpliceAI_DS_DL'] = vep_df.apply(fix_splice_ai, axis=1, args=('SpliceAI_DS_DL',))
+
+			vep_df['SpliceAI_DS_AG'] = pd.to_numeric(vep_df['SpliceAI_DS_AG'])
+			vep_df['SpliceAI_DS_AL'] = pd.to_numeric(vep_df['SpliceAI_DS_AL'])
+			vep_df['SpliceAI_DS_DG'] = pd.to_numeric(vep_df['SpliceAI_DS_DG'])
+			vep_df['SpliceAI_DS_DL'] = pd.to_numeric(vep_df['SpliceAI_DS_DL'])
+
+			vep_df['has_affect_on_splicing'] = vep_df.apply(has_affect_on_splicing, axis=1, args=(splice_ai_cutoff,))
+			vep_df['any_has_splicing_affect'] = vep_df.groupby('VariantId')['has_affect_on_splicing'].transform(any_has_splicing_affect)
+
+	# Consequence Filtering
+
+	with measure_stage(job, 'consequence') as stage_rows:
+
+		logger.info('Filtering on Consequence.')
+
+		stage_rows['rows_in'] = vep_df.shape[0]
+
+		# Get worst consequence (in any feature)
+		worst_ranks, vep_df['WorstConsequence'] = get_worst_consequences(vep_df, consequence_ranks)
+
+		# Has the variant got a relevant clinical consequence e.g. Pathogenic?
+		vep_df['has_important_clinsig'] = get_important_clinsigs(vep_df, consequence_ranks)
+
+		# Apply consequence filter
+		vep_df['consequence_filter'] = ~np.isin(worst_ranks, list(consequence_ranks['keep_ranks']))
+
+		if smart_synonymous_filtering == True:
+
+			vep_df = vep_df[(vep_df['consequence_filter'] == False) | ((vep_df['WorstConsequence'] == 'synonymous_variant') & ((vep_df['has_important_clinsig'] == True) | (vep_df['has_affect_on_splicing'] == True))) ]
+
+		else:
+
+			vep_df = vep_df[(vep_df['consequence_filter'] == False)]
+
+		stage_rows['rows_out'] = vep_df.shape[0]
+
+	return vep_df
+
+
+def annotate_transcripts(vep_df, job, panel_app_prefetch=None):
+	"""
+	Work out the annotations which do not depend on the sample - the CCRs, gnomad constraint scores, \
+	PanelApp data and the formatted exon, intron and HGVS - once for all the transcripts in vep_df.
+
+	Each value is calculated once per transcript or gene and then looked up for each row. Any \
+	PanelApp data which was not prefetched is fetched with the panel_app_prefetch settings.
+
+	Returns a dataframe with the same index as vep_df.
+
+	"""
+
+	options = job['options']
+	config_dict = job['config_dict']
+	resources = job['resources']
+
+	transcript_annotations = pd.DataFrame(index=vep_df.index)
+
+	if vep_df.shape[0] == 0:
+
+		return transcript_annotations
+
+	# If we want to add the constrained coding regions
+	if options['add_ccrs'] == True:
+
+		transcript_annotations['CCR_percentile'] = apply_once_per_value(vep_df, fix_ccrs, ['ccrs'])
+
+	# If we want to add the gnomad per gene constraint scores
+	if options['add_gnomad_constraint_scores'] == True:
+
+		gnomad_constraint_df = annotate_with_gnomad_constraint(vep_df['Feature'].values, resources['gnomad_constraint_df'])
+
+		for metric in gnomad_constraint_df.columns:
+
+			transcript_annotations[metric] = gnomad_constraint_df[metric].values
+
+	# Add gene information from panel app
+	if options['add_panel_app_info'] == True:
+
+		panel_app_dict = resources['panel_app_dict']
+		panel_app_dump_max_time = config_dict['panel_app_dump_max_time']
+
+		transcript_annotations['DiseaseName'] = apply_once_per_value(vep_df, apply_panel_app_data_disease, ['SYMBOL'], args=(panel_app_dict, panel_app_dump_max_time, panel_app_prefetch))
+		transcript_annotations['ModeOfInheritance'] = apply_once_per_value(vep_df, apply_panel_app_data_inheritance, ['SYMBOL'], args=(panel_app_dict, panel_app_dump_max_time, panel_app_prefetch))
+
+	transcript_annotations['Exon'] = apply_once_per_value(vep_df, fix_exon, ['EXON'])
+	transcript_annotations['Intron'] = apply_once_per_value(vep_df, fix_intron, ['INTRON'])
+	transcript_annotations['HGVSc'] = apply_once_per_value(vep_df, get_hgvsc, ['HGVSc'])
+	transcript_annotations['HGVSp'] = apply_once_per_value(vep_df, get_hgvsp, ['HGVSp'])
+
+	return transcript_annotations
+
+
+def get_sample_cache_key(sample, sample_df, job):
+	"""
+	Get the key for everything which goes into the output of a sample - the filtered variants, the config, \
+	the PED entries of the sample and its parents, its HPO terms and the PanelApp data for its genes.
+
+	"""
+
+	options = job['options']
+	config_dict = job['config_dict']
+	ped_dict = job['ped_dict']
+	resources = job['resources']
+
+	family = [ped_dict.get(member) for member in [sample, ped_dict[sample]['maternalID'], ped_dict[sample]['paternalID']]]
+
+	option_values = {key: options.get(key) for key in sample_cache_option_keys}
+
+	reference_files = [get_file_stamp(config_dict.get('hpo_file')), get_file_stamp(config_dict.get('gnomad_gene_scores'))]
+
+	patient_hpos = None
+
+	if options['add_hpo'] == True and isinstance(job['patient_hpos'], dict):
+
+		patient_hpos = job['patient_hpos'].get(sample)
+
+	panel_app_data = None
+
+	if options['add_panel_app_info'] == True:
+
+		panel_app_dict = resources['panel_app_dict']
+
+		panel_app_data = [[gene, panel_app_dict[gene]['disease'], panel_app_dict[gene]['inheritance']] if gene in panel_app_dict else [gene]
+			for gene in sorted(gene for gene in sample_df['SYMBOL'].unique() if isinstance(gene, str))]
+
+	return hash_values(job['variant_cache_key'], sample, config_dict, option_values, reference_files, family, patient_hpos, panel_app_data)
+
+
+def get_sample_sex(sex):
+	"""
+	Get the sex from the code in the PED file - Male, Female or Unknown.
+
+	"""
+
+	if sex == '1':
+
+		return 'Male'
+
+	elif sex == '2':
+
+		return 'Female'
+
+	return 'Unknown'
+
+
+def filter_sample(sample, vep_df, job):
+	"""
+	Annotate and filter the variants for a single sample.
+
+	Returns a DataFrame with the columns in the final_fields for the sample which is empty if \
+	the sample has no variants left.
+
+	"""
+
+	options = job['options']
+	config_dict = job['config_dict']
+	ped_dict = job['ped_dict']
+	resources = job['resources']
+	patient_hpos = job['patient_hpos']
+
+	add_hpo = options['add_hpo']
+	worksheet = options['worksheet']
+
+	hpo_index = resources.get('hpo_index')
+
+	min_parental_depth_dn = config_dict['min_parental_depth_dn']
+	min_parental_gq_dn = config_dict['min_parental_gq_dn']
+	min_parental_depth_uid = config_dict['min_parental_depth_uid']
+	min_parental_gq_uid = config_dict['min_parental_gq_uid']
+	gt_depth_tag = config_dict['gt_depth_tag']
+
+	final_fields_trio = config_dict['final_fields_trio']
+	final_fields_single = config_dict['final_fields_single']
+
+	logger.info(f'Processing sample: {sample}')
+
+	proband_in_trio = is_proband_in_trio(sample, ped_dict)
+
+	logger.info(f'{sample} is proband in trio:\t{proband_in_trio}')
+
+	if proband_in_trio == True:
+
+		final_fields = final_fields_trio
+
+	else:
+
+		final_fields = final_fields_single
+
+	logger.info(f"{sample} sex:\t{ped_dict[sample]['sex']}")
+
+	sample_sex = get_sample_sex(ped_dict[sample]['sex'])
+
+	if sample_sex == 'Unknown':
+
+		logger.warning(f'{sample}: sex is unknown - downstream calculations will assume patient is Male. We reccomend rerunning program when sex is known.')
+
+	# Get variants relevant to this sample
+	is_relevant = (vep_df[f'sample_{sample}_is_relevant'] == True).values
+	sample_df = vep_df[is_relevant]
+
+	logger.info(f'{sample}: Found {sample_df.shape[0]} relevant variants in sample.')
+
+	# If there are no variants for this sample
+	if sample_df.shape[0] == 0:
+
+		logger.warning(f'{sample}: sample has 0 variants - cannot carry out downstream filtering.')
+		return pd.DataFrame(columns=final_fields)
+
+	with measure_stage(job, 'workflow', sample=sample) as stage_rows:
+
+		stage_rows['rows_in'] = sample_df.shape[0]
+
+		# Create compound HET dict
+		compound_het_dict = sample_df.groupby('Feature', observed=True).count()['CHROM'].to_dict()
+		compound_het_dict[None] = 0
+
+		# Seperate workflows for trios and single samples - annotate each variant with inheritance pattern
+		if proband_in_trio == True:
+
+			mother = ped_dict[sample]['maternalID']
+			father = ped_dict[sample]['paternalID']
+
+			sample_df['Workflow'] = annotate_workflows_trio(sample_df, sample, mother, father, sample_sex, compound_het_dict, min_parental_depth_dn, min_parental_gq_dn, min_parental_depth_uid, min_parental_gq_uid, gt_depth_tag)
+
+		else:
+
+			sample_df['Workflow'] = annotate_workflows_single(sample_df, sample, sample_sex, compound_het_dict)
+
+
+		# Filter on least restrictive workflow
+		workflow_filters = job['workflow_filters']
+
+		workflow_codes, workflows = pd.factorize(sample_df['Workflow'])
+
+		least_restrictive = get_least_restrictive_workflows(workflows, workflow_filters)[workflow_codes]
+
+		# Look up whether each variant passes the frequency filter for its workflow
+		passes_workflow_filter = job['workflow_frequency_flags'][np.flatnonzero(is_relevant), least_restrictive]
+
+		# Group the variants by workflow with the most common first
+		workflow_order = sample_df['Workflow'].value_counts().index.get_indexer(workflows)[workflow_codes]
+
+		keep = np.flatnonzero(passes_workflow_filter)
+		keep = keep[np.argsort(workflow_order[keep], kind='stable')]
+
+		master_sample_df = sample_df.iloc[keep]
+
+		stage_rows['rows_out'] = master_sample_df.shape[0]
+
+	# If there are no variants left for this sample
+	if master_sample_df.shape[0] == 0:
+
+		logger.warning(f'{sample}: sample has 0 variants - cannot carry out downstream filtering.')
+		return pd.DataFrame(columns=final_fields)
+
+	logger.info(f"{sample}: variants remaining after filtering: {master_sample_df.groupby('VariantId').count().shape[0]}")
+
+	with measure_stage(job, 'sample_annotation', sample=sample):
+
+		# Add the annotations which are the same for every sample
+		transcript_annotations = job['transcript_annotations']
+
+		for column in transcript_annotations.columns:
+
+			master_sample_df[column] = transcript_annotations.loc[master_sample_df.index, column]
+
+		if add_hpo == True:
+
+			if sample in patient_hpos:
+
+				master_sample_df['HPOCount'] = count_hpo_matches(master_sample_df['Gene'].values, patient_hpos[sample], hpo_index)
+				master_sample_df['HPOCountMax'] = master_sample_df.groupby('VariantId')['HPOCount'].transform('max')
+
+			else:
+			
+				master_sample_df['HPOCount'] = 'NA'
+				master_sample_df['HPOCountMax'] = 'NA'
+				logger.warning(f'{sample}: Could not find any HPO terms for this sample in file.')
+
+
+		# Check each variant has at least one pick flag
+		pick_dict = master_sample_df[['VariantId','PICK']].groupby('VariantId').sum().to_dict()
+
+		# Process CSV for saving to file.
+		master_sample_df['SampleId'] = sample
+		master_sample_df['RunId'] = worksheet
+		master_sample_df['Genotype'] = get_genotypes(master_sample_df, sample)
+		master_sample_df['Proband'] = master_sample_df['sample_' + sample + '_GT']
+
+		# Change column names if we have trio samples
+		if proband_in_trio == True:
+
+			master_sample_df['Father'] = master_sample_df['sample_' + father + '_GT']
+			master_sample_df['Mother'] = master_sample_df['sample_' + mother + '_GT']
+
+		master_sample_df['Gene'] = master_sample_df['SYMBOL']
+		master_sample_df['Transcript'] = master_sample_df['Feature']
+
+		if options['compact_dtypes'] == True:
+
+			master_sample_df = compact_dtypes(master_sample_df, ['SampleId', 'RunId', 'Workflow', 'Genotype'])
+
+		# Check every variant has at least one PICK flag
+		master_sample_df['Pick'] = master_sample_df.apply(check_picks, axis=1, args=(pick_dict,))
+
+	return master_sample_df[final_fields]
+
+
+def write_sample_output(sample, sample_df, job):
+	"""
+	Write the output of filter_sample to results_dir/SAMPLE.csv with a header line describing the sample.
+
+	"""
+
+	ped_dict = job['ped_dict']
+	results_dir = job['options']['results_dir']
+
+	sample_sex = get_sample_sex(ped_dict[sample]['sex'])
+
+	if is_proband_in_trio(sample, ped_dict) == True:
+
+		father = ped_dict[sample]['paternalID']
+		mother = ped_dict[sample]['maternalID']
+
+		header = f'#Variant Germline Filter Version {version}|Proband={sample}|father={father}|mother={mother}|proband_sex={sample_sex}\n'
+
+	else:
+
+		header = f'#Variant Germline Filter Version {version}|Proband={sample}|proband_sex={sample_sex}\n'
+
+	with open(f'{results_dir}/{sample}.csv', 'w') as f:
+		f.write(header)
+
+	sample_df.to_csv(f'{results_dir}/{sample}.csv', sep='\t', float_format='%.6f', mode='a', index=False)
+
+
+def process_sample(sample, vep_df, job):
+	"""
+	Annotate, filter and write the variants for a single sample.
+
+	Returns False if the sample has no variants left to write.
+
+	"""
+
+	results_dir = job['options']['results_dir']
+
+	# Skip the sample if nothing which goes into its output has changed since the last run
+	if job['variant_cache_key'] != None:
+
+		sample_cache_key = get_sample_cache_key(sample, vep_df[(vep_df[f'sample_{sample}_is_relevant'] == True).values], job)
+
+		if is_sample_output_current(results_dir, sample, sample_cache_key):
+
+			logger.info(f'{sample}: inputs have not changed since the last run - keeping {results_dir}/{sample}.csv')
+			return True
+
+	sample_df = filter_sample(sample, vep_df, job)
+
+	if sample_df.shape[0] == 0:
+
+		return False
+
+	with measure_stage(job, 'write', sample=sample) as stage_rows:
+
+		stage_rows['rows_out'] = sample_df.shape[0]
+
+		write_sample_output(sample, sample_df, job)
+
+	if job['variant_cache_key'] != None:
+
+		write_sample_record(results_dir, sample, sample_cache_key)
+
+	return True
+
+
+def process_sample_in_worker(sample):
+	"""
+	Run worker_state['sample_function'] for a sample in a worker process using the job in worker_state.
+
+	Also returns the PanelApp entries fetched while processing the sample and the metrics recorded \
+	for it so they can be merged back into the main process.
+
+	"""
+
+	job = worker_state['job']
+
+	# Record the metrics for this sample on their own so they are only merged once
+	if job['metrics'] != None:
+
+		job = dict(job)
+		job['metrics'] = new_metrics()
+
+	panel_app_dict = job['resources'].get('panel_app_dict', {})
+
+	panel_app_before = dict(panel_app_dict)
+
+	with measure_stage(job, 'process_sample', sample=sample):
+
+		result = worker_state['sample_function'](sample, worker_state['vep_df'], job)
+
+	return sample, result, get_panel_app_updates(panel_app_before, panel_app_dict), job['metrics']
+
+
+def process_samples(sample_function, vep_df, job):
+	"""
+	Run sample_function(sample, vep_df, job) for each sample in the PED file, using job['workers'] processes.
+
+	Yields (sample, result) in the same order as the samples in the PED file.
+
+	"""
+
+	options = job['options']
+	resources = job['resources']
+	samples = job['samples']
+	metrics = job['metrics']
+
+	workers = job['workers']
+
+	if workers == 1:
+
+		for sample in samples:
+
+			with measure_stage(job, 'process_sample', sample=sample):
+
+				result = sample_function(sample, vep_df, job)
+
+			yield sample, result
+
+	else:
+
+		# Forked workers share vep_df with the main process so it is not copied for each sample
+		logger.info(f'Processing samples using {workers} workers.')
+
+		worker_state['job'] = job
+		worker_state['vep_df'] = vep_df
+		worker_state['sample_function'] = sample_function
+
+		try:
+
+			with multiprocessing.get_context('fork').Pool(min(workers, len(samples))) as pool:
+
+				# Results come back in the same order as samples so the merge is deterministic
+				for sample, result, panel_app_updates, sample_metrics in pool.imap(process_sample_in_worker, samples, chunksize=1):
+
+					if options['add_panel_app_info'] == True:
+
+						resources['panel_app_dict'].update(panel_app_updates)
+
+					if metrics != None:
+
+						merge_metrics(metrics, sample_metrics)
+
+					yield sample, result
+
+		finally:
+
+			worker_state.clear()
+
+
+def read_and_filter_variants(job, panel_app_prefetch=None):
+	"""
+	Read the input and apply the variant level filters, in chunks if options['chunk_size'] is set.
+
+	The genes which pass the filters are passed to the PanelApp prefetch as they are found.
+
+	"""
+
+	options = job['options']
+	config_dict = job['config_dict']
+	resources = job['resources']
+	samples = job['samples']
+
+	chunk_size = options['chunk_size']
+
+	with measure_stage(job, 'read') as stage_rows:
+
+		input_chunks = read_input_chunks(options, samples, config_dict['gt_depth_tag'], job['regions'])
+
+		if chunk_size == None:
+
+			stage_rows['rows_out'] = input_chunks[0].shape[0]
+
+	if chunk_size == None:
+
+		vep_df = filter_variants(input_chunks[0], job)
+
+		if options['add_panel_app_info'] == True:
+
+			submit_panel_app_prefetch(panel_app_prefetch, vep_df['SYMBOL'].unique(), resources['panel_app_dict'])
+
+	else:
+
+		# Stream the input and only keep the transcripts which pass the variant level filters
+		logger.info(f'Reading input in chunks of {chunk_size} variants.')
+
+		filtered_chunks = []
+
+		input_chunks = iter(input_chunks)
+
+		while True:
+
+			# The chunks are read as they are needed
+			with measure_stage(job, 'read') as stage_rows:
+
+				chunk = next(input_chunks, None)
+
+				stage_rows['rows_out'] = 0 if chunk is None else chunk.shape[0]
+
+			if chunk is None:
+
+				break
+
+			filtered_chunk = filter_variants(chunk, job)
+
+			# The genes in this chunk are fetched while the next chunk is read
+			if options['add_panel_app_info'] == True:
+
+				submit_panel_app_prefetch(panel_app_prefetch, filtered_chunk['SYMBOL'].unique(), resources['panel_app_dict'])
+
+			filtered_chunks.append(filtered_chunk)
+
+		if options['compact_dtypes'] == True:
+
+			filtered_chunks = unify_categories(filtered_chunks)
+
+		vep_df = pd.concat(filtered_chunks, ignore_index=True, sort=False)
+
+		del filtered_chunks
+
+	del input_chunks
+
+	return vep_df
+
+
+default_options = {
+	'csv_file': None,
+	'vcf_file': None,
+	'ped_file': None,
+	'csq_desc': None,
+	'parse_splice_ai': False,
+	'smart_synonymous_filtering': False,
+	'add_ccrs': False,
+	'add_gnomad_constraint_scores': False,
+	'add_panel_app_info': False,
+	'local_panel_app_dump': None,
+	'panel_app_cache': None,
+	'add_hpo': False,
+	'patient_hpos': None,
+	'worksheet': None,
+	'results_dir': None,
+	'chunk_size': None,
+	'regions': None,
+	'workers': 1,
+	'compact_dtypes': True,
+	'cache_dir': None,
+	'cache_max_size': 10.0,
+	'metrics_json': None,
+	'profile_dir': None,
+	'profile_memory': False,
+	'profile_top': 20
+	}
+
+
+def get_options(**kwargs):
+	"""
+	Get the options for run_filter and stream_filter with the same defaults as the command line.
+
+	Takes any of the keys in default_options e.g. get_options(csv_file='input.csv', ped_file='family.ped', \
+	csq_desc=csq, worksheet='WS1'). The csq_desc can be given as the CSQ string and is read from the \
+	header of vcf_file if it is not given. add_hpo is set if patient_hpos is given.
+
+	"""
+
+	options = dict(default_options)
+
+	for key, value in kwargs.items():
+
+		if key not in default_options:
+
+			raise Exception(f'Unknown option: {key}')
+
+		options[key] = value
+
+	if (options['csv_file'] == None) == (options['vcf_file'] == None):
+
+		raise Exception('Give one of csv_file or vcf_file.')
+
+	if options['ped_file'] == None:
+
+		raise Exception('The ped_file option is required.')
+
+	if options['csq_desc'] == None and options['vcf_file'] != None:
+
+		options['csq_desc'] = get_vcf_csq_description(options['vcf_file'])
+
+	if options['csq_desc'] == None:
+
+		raise Exception('Could not find the CSQ description - use the csq_desc option.')
+
+	if isinstance(options['csq_desc'], str):
+
+		options['csq_desc'] = options['csq_desc'].split('|')
+
+	options['add_hpo'] = options['patient_hpos'] != None
+
+	return options
+
+
+def prepare_job(options, config_dict, resources=None, metrics=None):
+	"""
+	Read and filter the variants and add the annotations which are the same for every sample.
+
+	Returns the job and the filtered variants for process_samples.
+
+	"""
+
+	wall_start = time.perf_counter()
+	cpu_start = time.process_time()
+
+	if metrics == None and options.get('metrics_json') != None:
+
+		metrics = new_metrics()
+
+	if resources == None:
+
+		resources = load_resources(config_dict, options['add_gnomad_constraint_scores'], options['add_panel_app_info'],
+			options['local_panel_app_dump'], options['add_hpo'], options['panel_app_cache'])
+
+	ped_dict = parse_ped_file(options['ped_file'])
+	samples = list(ped_dict.keys())
+
+	job = {}
+	job['options'] = options
+	job['config_dict'] = config_dict
+	job['ped_dict'] = ped_dict
+	job['samples'] = samples
+	job['resources'] = resources
+	job['patient_hpos'] = None
+	job['metrics'] = metrics
+	job['wall_start'] = wall_start
+	job['cpu_start'] = cpu_start
+	job['profile'] = None
+
+	# Profile each stage if asked to - see utils/profiling.py
+	if options.get('profile_dir') != None:
+
+		job['profile'] = new_profile(options['profile_dir'], options['profile_memory'], options['profile_top'])
+
+	# Merged intervals for each chromosome so variants outside the regions can be dropped as they are read
+	job['regions'] = None
+
+	if options['regions'] != None:
+
+		job['regions'] = read_regions(options['regions'])
+
+	# Work out where the vep_fields are in the CSQ string - fails here if any are missing
+	job['csq_projection'] = compile_csq_projection(options['csq_desc'], config_dict['vep_fields'])
+
+	# Rank each consequence by severity so the consequence filter can work on integers
+	job['consequence_ranks'] = compile_consequence_ranks(config_dict['consequence_severity'], config_dict['to_keep_consequences'], config_dict['clin_sig_words'])
+
+	# Table of the frequency cutoffs for each workflow
+	job['workflow_filters'] = compile_workflow_filters(config_dict)
+
+	if options['add_hpo'] == True:
+
+		patient_hpos = options['patient_hpos']
+
+		try:
+
+			patient_hpos = pd.read_csv(patient_hpos, sep='\t').to_dict(orient='list')
+
+		except:
+
+			logger.warning('Could not read HPO gene map')
+
+		job['patient_hpos'] = patient_hpos
+
+	# Fetch PanelApp data in the background for the genes which pass the variant level filters
+	if options['add_panel_app_info'] == True:
+
+		panel_app_prefetch = start_panel_app_prefetch(config_dict)
+
+	else:
+
+		panel_app_prefetch = None
+
+	# Variant level filtering - the filtered variants from an earlier run are reused if the inputs have not changed
+	cache_dir = options['cache_dir']
+
+	job['variant_cache_key'] = None
+	vep_df = None
+
+	if cache_dir != None:
+
+		input_file = options['vcf_file'] if options['vcf_file'] != None else options['csv_file']
+
+		job['variant_cache_key'] = get_variant_cache_key(input_file, options, config_dict, samples, version)
+
+		vep_df = read_variant_cache(cache_dir, job['variant_cache_key'])
+
+	if vep_df is None:
+
+		vep_df = read_and_filter_variants(job, panel_app_prefetch)
+
+		if cache_dir != None and write_variant_cache(cache_dir, job['variant_cache_key'], vep_df, options['cache_max_size'] * 1024 ** 3) == None:
+
+			logger.warning('The filtered variants can not be stored as Parquet so they have not been cached.')
+
+	else:
+
+		logger.info(f"Using the cached filtered variants in {cache_dir}.")
+
+		if options['add_panel_app_info'] == True:
+
+			submit_panel_app_prefetch(panel_app_prefetch, vep_df['SYMBOL'].unique(), resources['panel_app_dict'])
+
+	if options['add_panel_app_info'] == True:
+
+		panel_app_stats = finish_panel_app_prefetch(panel_app_prefetch, resources['panel_app_dict'])
+
+		logger.info(f"PanelApp prefetch: {panel_app_stats['genes']} genes, cache hit rate {panel_app_stats['hit_rate']:.1%}, "
+			f"{panel_app_stats['fetched']} fetched, {panel_app_stats['failed']} failed, "
+			f"mean latency {panel_app_stats['mean_latency']:.3f}s, max latency {panel_app_stats['max_latency']:.3f}s.")
+
+		if panel_app_stats['circuit_open'] == True:
+
+			logger.warning('Stopped querying PanelApp after too many failed requests.')
+
+	with measure_stage(job, 'transcript_annotation') as stage_rows:
+
+		stage_rows['rows_in'] = vep_df.shape[0]
+
+		# Annotations which are the same for every sample
+		job['transcript_annotations'] = annotate_transcripts(vep_df, job, panel_app_prefetch)
+
+		# Whether each variant passes the frequency filter of each workflow
+		job['workflow_frequency_flags'] = get_workflow_frequency_flags(vep_df, job['workflow_filters'])
+
+	if options['add_panel_app_info'] == True:
+
+		close_panel_app_prefetch(panel_app_prefetch)
+
+	# The profilers can't follow the samples into other processes
+	job['workers'] = options['workers']
+
+	if job['profile'] != None and job['workers'] > 1:
+
+		logger.warning('Processing samples in one process as the run is being profiled.')
+		job['workers'] = 1
+
+	return job, vep_df
+
+
+def finish_job(job, no_variants_samples):
+	"""
+	Write the metrics and profile of a job if they were asked for.
+
+	"""
+
+	options = job['options']
+	metrics = job['metrics']
+
+	if metrics != None:
+
+		metrics['run'] = {
+			'wall_seconds': time.perf_counter() - job['wall_start'],
+			'cpu_seconds': time.process_time() - job['cpu_start'],
+			'peak_rss_mb': get_peak_memory_mb(),
+			'samples': len(job['samples']),
+			'no_variants_samples': len(no_variants_samples),
+			'workers': job['workers']
+			}
+
+		if options.get('metrics_json') != None:
+
+			write_metrics(metrics, options['metrics_json'])
+
+	if job['profile'] != None:
+
+		report_file = write_profile(job['profile'])
+
+		logger.info(f"Wrote the profile of each stage to {options['profile_dir']} - see {report_file} for the slowest functions.")
+
+
+def run_filter(options, config_dict, resources=None, metrics=None):
+	"""
+	Run the whole filter for one input file and write a CSV for each sample in the PED file.
+
+	options = dictionary of the options - see get_options
+	config_dict = the parsed YAML config
+	resources = the output of load_resources - PanelApp data fetched during the run is added to this. \
+		Loaded using the options if not given.
+	metrics = if given a dictionary from new_metrics which the measurements of each stage are added to - \
+		otherwise they are only recorded if options['metrics_json'] is set
+
+	Returns a list of the samples with no variants.
+
+	"""
+
+	job, vep_df = prepare_job(options, config_dict, resources, metrics)
+
+	# List of samples in which we have no variants
+	no_variants_samples = []
+
+	for sample, has_variants in process_samples(process_sample, vep_df, job):
+
+		if has_variants == False:
+
+			no_variants_samples.append(sample)
+
+	# Write blank files for samples with no variants in.
+	for sample in no_variants_samples:
+
+		with open(f"{options['results_dir']}/{sample}.csv", 'w') as f:
+				f.write(f'')
+
+	finish_job(job, no_variants_samples)
+
+	return no_variants_samples
+
+
+def stream_filter(options, config_dict, resources=None, metrics=None):
+	"""
+	Run the whole filter for one input file without writing the results to disk.
+
+	Takes the same arguments as run_filter and yields (sample, DataFrame) for each sample in the PED \
+	file in order as soon as it is ready. The DataFrame has the columns in the final_fields of the \
+	config and is empty if the sample has no variants. options['results_dir'] is not used.
+
+	"""
+
+	job, vep_df = prepare_job(options, config_dict, resources, metrics)
+
+	no_variants_samples = []
+
+	for sample, sample_df in process_samples(filter_sample, vep_df, job):
+
+		if sample_df.shape[0] == 0:
+
+			no_variants_samples.append(sample)
+
+		yield sample, sample_df
+
+	finish_job(job, no_variants_samples)
+
+
+def estimate_job_memory(input_file, memory_factor):
+	"""
+	Rough estimate of the peak memory in GB needed to run a job.
+
+	Taken as memory_factor times the size of the input - gzipped inputs are assumed to be \
+	a fifth of their uncompressed size.
+
+	"""
+
+	input_size = os.path.getsize(input_file)
+
+	with open(input_file, 'rb') as f:
+
+		if f.read(2) == b'\x1f\x8b':
+
+			input_size = input_size * 5
+
+	return input_size * memory_factor / 1024**3
+
+
+def new_batch_summary(job_id, options):
+	"""
+	Make the summary of a job from a batch manifest - see run_batch_job.
+
+	"""
+
+	summary = {}
+	summary['job_id'] = job_id
+	summary['worksheet'] = options['worksheet']
+	summary['input'] = options['csv_file'] if options['csv_file'] != None else options['vcf_file']
+	summary['status'] = 'SUCCESS'
+	summary['error'] = ''
+	summary['no_variants_samples'] = ''
+
+	return summary
+
+
+def run_batch_job(job_id, options, metrics=None):
+	"""
+	Run one job from a batch manifest using the config and resources in worker_state.
+
+	Errors are caught and reported in the returned summary so one bad job does not stop the batch. \
+	If metrics is given the measurements of each stage are added to it - see run_filter.
+
+	"""
+
+	resources = worker_state['resources']
+
+	panel_app_dict = resources.get('panel_app_dict', {})
+
+	panel_app_before = dict(panel_app_dict)
+
+	summary = new_batch_summary(job_id, options)
+
+	start_time = time.time()
+
+	try:
+
+		logger.info(f"Starting job {job_id}: {summary['input']}")
+
+		no_variants_samples = run_filter(options, worker_state['config_dict'], resources, metrics)
+
+		summary['no_variants_samples'] = ','.join(no_variants_samples)
+
+	except Exception as e:
+
+		logger.error(f'Job {job_id} failed: {e}')
+
+		summary['status'] = 'FAILED'
+		summary['error'] = str(e)
+
+	summary['seconds'] = round(time.time() - start_time, 3)
+
+	return summary, get_panel_app_updates(panel_app_before, panel_app_dict)
+
+
+def send_batch_job(job_id, options, connection):
+	"""
+	Run a job from a batch manifest in a forked process and send its summary and the PanelApp data it fetched back.
+
+	"""
+
+	connection.send(run_batch_job(job_id, options))
+	connection.close()
+
+
+def start_batch_job(job_id, options):
+	"""
+	Start a job from a batch manifest in a forked process which shares worker_state with this one.
+
+	A job whose process dies e.g. is killed for using too much memory only fails that job. Returns the \
+	running job - pass it to finish_batch_job once its receiver has something to read.
+
+	"""
+
+	context = multiprocessing.get_context('fork')
+
+	receiver, sender = context.Pipe(duplex=False)
+
+	process = context.Process(target=send_batch_job, args=(job_id, options, sender))
+	process.start()
+
+	# Only the job process should hold the sending end so recv fails if the job process dies
+	sender.close()
+
+	running_job = {}
+	running_job['job_id'] = job_id
+	running_job['options'] = options
+	running_job['process'] = process
+	running_job['receiver'] = receiver
+	running_job['started'] = time.time()
+
+	return running_job
+
+
+def finish_batch_job(running_job):
+	"""
+	Get the summary and the PanelApp data fetched by a job started with start_batch_job.
+
+	The job is recorded as failed if its process stopped without sending them.
+
+	"""
+
+	try:
+
+		summary, panel_app_updates = running_job['receiver'].recv()
+
+	except EOFError:
+
+		summary = None
+		panel_app_updates = {}
+
+	running_job['receiver'].close()
+	running_job['process'].join()
+
+	if summary == None:
+
+		summary = new_batch_summary(running_job['job_id'], running_job['options'])
+		summary['status'] = 'FAILED'
+		summary['error'] = f"The job process stopped without sending its results - exit code {running_job['process'].exitcode}."
+		summary['seconds'] = round(time.time() - running_job['started'], 3)
+
+		logger.error(f"Job {running_job['job_id']} failed: {summary['error']}")
+
+	return summary, panel_app_updates
@@ -0,0 +1,217 @@
+"""
+Functions for profiling each stage of the filter.
+
+Each stage gets its own cProfile profiler which is paused while any stage inside it runs, so the \
+profile of a stage only has the time spent in that stage. The per stage profiles are written as \
+pstats dumps along with a report of the slowest functions in utils.utils and utils.inheritance_utils.
+
+"""
+
+import cProfile
+import os
+import pstats
+import tracemalloc
+
+# The modules which are shown in the report of the slowest functions
+profile_report_modules = {os.path.join('utils', 'utils.py'): 'utils.utils', os.path.join('utils', 'inheritance_utils.py'): 'utils.inheritance_utils'}
+
+
+def new_profile(profile_dir, trace_memory=False, top=20):
+	"""
+	Empty profile for measure_stage to fill in.
+
+	profile_dir = where to write the profiles of each stage
+	trace_memory = also record the peak memory allocated by Python in each stage using tracemalloc - much slower
+	top = how many functions and allocations to show for each stage in the report
+
+	"""
+
+	profile = {}
+	profile['dir'] = profile_dir
+	profile['trace_memory'] = trace_memory
+	profile['top'] = top
+	profile['profilers'] = {}
+	profile['memory'] = {}
+	profile['active'] = []
+	profile['started_tracemalloc'] = False
+
+	if trace_memory == True and not tracemalloc.is_tracing():
+
+		tracemalloc.start()
+		profile['started_tracemalloc'] = True
+
+	return profile
+
+
+def update_memory_peaks(profile):
+	"""
+	Add the peak traced memory since the last reset to each active stage and reset it.
+
+	The peak can only be reset on Python 3.9+ - on older versions it is the peak since tracing \
+	started so the stage peaks are an upper bound.
+
+	"""
+
+	current_memory, peak_memory = tracemalloc.get_traced_memory()
+
+	for active_stage in profile['active']:
+
+		active_stage['peak_memory'] = max(active_stage['peak_memory'], peak_memory)
+
+	if hasattr(tracemalloc, 'reset_peak'):
+
+		tracemalloc.reset_peak()
+
+	return current_memory
+
+
+def start_stage_profile(profile, stage):
+	"""
+	Start profiling a stage, pausing the profiler of the stage it is inside.
+
+	"""
+
+	if profile['trace_memory'] == True:
+
+		current_memory = update_memory_peaks(profile)
+
+	else:
+
+		current_memory = 0
+
+	if len(profile['active']) > 0:
+
+		profile['profilers'][profile['active'][-1]['stage']].disable()
+
+	profile['active'].append({'stage': stage, 'start_memory': current_memory, 'peak_memory': current_memory})
+
+	profiler = profile['profilers'].setdefault(stage, cProfile.Profile())
+	profiler.enable()
+
+
+def stop_stage_profile(profile):
+	"""
+	Stop profiling the current stage and carry on profiling the stage it is inside.
+
+	"""
+
+	active_stage = profile['active'][-1]
+	stage = active_stage['stage']
+
+	profile['profilers'][stage].disable()
+
+	if profile['trace_memory'] == True:
+
+		update_memory_peaks(profile)
+
+		peak_memory_mb = (active_stage['peak_memory'] - active_stage['start_memory']) / 1024 ** 2
+
+		stage_memory = profile['memory'].setdefault(stage, {'peak_traced_mb': 0.0, 'top_allocations': []})
+
+		# Keep the allocations from the call of the stage which used the most memory
+		if peak_memory_mb >= stage_memory['peak_traced_mb']:
+
+			snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+			stage_memory['peak_traced_mb'] = peak_memory_mb
+			stage_memory['top_allocations'] = [str(statistic) for statistic in snapshot.statistics('lineno')[:profile['top']]]
+
+	profile['active'].pop()
+
+	if len(profile['active']) > 0:
+
+		profile['profilers'][profile['active'][-1]['stage']].enable()
+
+
+def get_slowest_functions(stats, top):
+	"""
+	Get the functions in the report modules which took the most time, not counting the functions they call.
+
+	Returns a list of [module, function, line, calls, own seconds, cumulative seconds].
+
+	"""
+
+	functions = []
+
+	for (filename, line, function), (primitive_calls, calls, own_seconds, cumulative_seconds, callers) in stats.stats.items():
+
+		for module_path, module in profile_report_modules.items():
+
+			if filename.endswith(module_path):
+
+				functions.append([module, function, line, calls, own_seconds, cumulative_seconds])
+
+	return sorted(functions, key=lambda x: x[4], reverse=True)[:top]
+
+
+def format_slowest_functions(functions):
+	"""
+	Format the output of get_slowest_functions as a table.
+
+	"""
+
+	lines = [f"{'own_seconds':>12} {'cum_seconds':>12} {'calls':>10}  function"]
+
+	for module, function, line, calls, own_seconds, cumulative_seconds in functions:
+
+		lines.append(f'{own_seconds:12.4f} {cumulative_seconds:12.4f} {calls:10d}  {module}.{function}:{line}')
+
+	return lines
+
+
+def write_profile(profile):
+	"""
+	Write a pstats dump for each stage to profile_dir/STAGE.prof and a report of the slowest \
+	functions in utils.utils and utils.inheritance_utils to profile_dir/report.txt.
+
+	Returns the path of the report.
+
+	"""
+
+	os.makedirs(profile['dir'], exist_ok=True)
+
+	if profile['started_tracemalloc'] == True:
+
+		tracemalloc.stop()
+		profile['started_tracemalloc'] = False
+
+	all_stats = None
+
+	report = []
+
+	for stage, profiler in profile['profilers'].items():
+
+		profiler.dump_stats(os.path.join(profile['dir'], f'{stage}.prof'))
+
+		stats = pstats.Stats(profiler)
+
+		if all_stats == None:
+
+			all_stats = pstats.Stats(profiler)
+
+		else:
+
+			all_stats.add(profiler)
+
+		report.append(f'## {stage} - {stats.total_tt:.3f} seconds')
+		report.extend(format_slowest_functions(get_slowest_functions(stats, profile['top'])))
+
+		if stage in profile['memory']:
+
+			report.append(f"Peak traced memory: {profile['memory'][stage]['peak_traced_mb']:.1f} MB")
+			report.append('Largest allocations at the end of the stage:')
+			report.extend(profile['memory'][stage]['top_allocations'])
+
+		report.append('')
+
+	if all_stats != None:
+
+		report = ['## All stages'] + format_slowest_functions(get_slowest_functions(all_stats, profile['top'])) + [''] + report
+
+	report_file = os.path.join(profile['dir'], 'report.txt')
+
+	with open(report_file, 'w') as f:
+
+		f.write('\n'.join(report))
+
+	return report_file
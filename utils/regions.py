@@ -0,0 +1,295 @@
+"""
+Functions for restricting the filter to the regions in a BED file e.g. a virtual panel.
+
+The regions on each chromosome are sorted and merged so that they do not overlap, which means \
+the interval a variant could overlap can be found with a binary search on the interval ends.
+
+The regions are a dictionary of chromosome: {'starts': array, 'ends': array} with the BED \
+coordinates i.e. starting from 0 with the end not included.
+
+"""
+
+import pandas as pd
+import numpy as np
+import bisect
+import gzip
+import io
+import itertools
+
+
+def open_text_file(filepath):
+	"""
+	Open a plain or gzipped file for reading as text.
+
+	"""
+
+	with open(filepath, 'rb') as f:
+
+		is_gzipped = f.read(2) == b'\x1f\x8b'
+
+	if is_gzipped:
+
+		return gzip.open(filepath, 'rt')
+
+	return open(filepath, 'r')
+
+
+def merge_intervals(starts, ends):
+	"""
+	Sort the intervals and merge any which overlap or touch.
+
+	Returns the starts and ends of the merged intervals as numpy arrays.
+
+	"""
+
+	starts = np.asarray(starts, dtype=np.int64)
+	ends = np.asarray(ends, dtype=np.int64)
+
+	if len(starts) == 0:
+
+		return starts, ends
+
+	order = np.lexsort((ends, starts))
+
+	starts = starts[order]
+	ends = ends[order]
+
+	# An interval starts a new merged interval if it starts after the end of all the intervals before it
+	furthest_ends = np.maximum.accumulate(ends)
+
+	is_new_interval = np.concatenate([[True], starts[1:] > furthest_ends[:-1]])
+
+	merged_starts = starts[is_new_interval]
+	merged_ends = np.maximum.reduceat(ends, np.flatnonzero(is_new_interval))
+
+	return merged_starts, merged_ends
+
+
+def read_regions(bed_file):
+	"""
+	Read a plain or gzipped BED file into the merged regions for each chromosome.
+
+	Only the first three columns are used. Header, track and browser lines are ignored.
+
+	"""
+
+	bed_intervals = {}
+
+	with open_text_file(bed_file) as f:
+
+		for line_number, line in enumerate(f, start=1):
+
+			if line.strip() == '' or line.startswith(('#', 'track', 'browser')):
+
+				continue
+
+			fields = line.split()
+
+			try:
+
+				start = int(fields[1])
+				end = int(fields[2])
+
+			except (IndexError, ValueError):
+
+				raise Exception(f'Could not read line {line_number} of the BED file {bed_file}.')
+
+			if start < 0 or end < start:
+
+				raise Exception(f'Line {line_number} of the BED file {bed_file} is not a valid region.')
+
+			chrom_intervals = bed_intervals.setdefault(fields[0], ([], []))
+			chrom_intervals[0].append(start)
+			chrom_intervals[1].append(end)
+
+	regions = {}
+
+	for chrom, (starts, ends) in bed_intervals.items():
+
+		merged_starts, merged_ends = merge_intervals(starts, ends)
+
+		regions[chrom] = {'starts': merged_starts, 'ends': merged_ends}
+
+	return regions
+
+
+def get_regions_mask(chroms, positions, refs, regions):
+	"""
+	Check which variants overlap the regions.
+
+	A variant covers the bases of its REF allele starting at POS, so a deletion which starts \
+	before a region but runs into it is kept.
+
+	Returns a boolean array which is True for the variants to keep.
+
+	"""
+
+	chrom_codes, unique_chroms = pd.factorize(pd.Series(chroms, dtype=object))
+
+	positions = np.asarray(positions, dtype=np.int64)
+
+	# Variants with no REF cover the base at POS
+	ref_lengths = pd.Series(refs, dtype=object).str.len().fillna(1).clip(lower=1).values.astype(np.int64)
+
+	variant_starts = positions - 1
+	variant_ends = variant_starts + ref_lengths
+
+	keep = np.zeros(len(chrom_codes), dtype=bool)
+
+	for code, chrom in enumerate(unique_chroms):
+
+		if chrom not in regions:
+
+			continue
+
+		on_chrom = chrom_codes == code
+
+		region_starts = regions[chrom]['starts']
+		region_ends = regions[chrom]['ends']
+
+		# The first region which ends after the variant starts is the only one it can overlap
+		region_positions = np.searchsorted(region_ends, variant_starts[on_chrom], side='right')
+
+		in_range = region_positions < len(region_ends)
+
+		overlaps = np.zeros(len(region_positions), dtype=bool)
+		overlaps[in_range] = region_starts[region_positions[in_range]] < variant_ends[on_chrom][in_range]
+
+		keep[on_chrom] = overlaps
+
+	return keep
+
+
+def is_variant_in_regions(chrom, pos, ref, regions):
+	"""
+	Check whether a single variant overlaps the regions - used when streaming a VCF.
+
+	"""
+
+	if chrom not in regions:
+
+		return False
+
+	region_ends = regions[chrom]['ends']
+
+	variant_start = pos - 1
+	variant_end = variant_start + max(len(ref), 1)
+
+	region_position = bisect.bisect_right(region_ends, variant_start)
+
+	return region_position < len(region_ends) and regions[chrom]['starts'][region_position] < variant_end
+
+
+def get_region_row_ranges(csv_file, regions, chunk_size=1000000):
+	"""
+	Find the rows of a coordinate sorted input CSV which overlap the regions.
+
+	Only the CHROM, POS and REF columns are read. The input counts as sorted if the rows for each \
+	chromosome are together and in order of position.
+
+	Returns a list of [first row, row after the last row] for each run of rows to keep, or None if \
+	the input is not sorted.
+
+	"""
+
+	masks = []
+
+	seen_chroms = set()
+	last_chrom = None
+	last_pos = None
+
+	# Blank lines are kept so the row numbers match the lines of the file
+	index_chunks = pd.read_csv(csv_file, sep='\t', usecols=['CHROM', 'POS', 'REF'], dtype={'CHROM': object, 'REF': object},
+		skip_blank_lines=False, chunksize=chunk_size)
+
+	for index_chunk in index_chunks:
+
+		if index_chunk.shape[0] == 0:
+
+			continue
+
+		chroms = index_chunk['CHROM'].values
+		positions = index_chunk['POS'].values
+
+		if pd.isna(positions).any():
+
+			return None
+
+		# Where a new chromosome starts within the chunk
+		chrom_changes = np.flatnonzero(np.concatenate([[chroms[0] != last_chrom], chroms[1:] != chroms[:-1]]))
+
+		for chrom_change in chrom_changes:
+
+			if chroms[chrom_change] in seen_chroms:
+
+				return None
+
+			seen_chroms.add(chroms[chrom_change])
+
+		same_chrom = np.concatenate([[chroms[0] == last_chrom], chroms[1:] == chroms[:-1]])
+		previous_positions = np.concatenate([[last_pos if last_pos != None else 0], positions[:-1]])
+
+		if (same_chrom & (positions < previous_positions)).any():
+
+			return None
+
+		last_chrom = chroms[-1]
+		last_pos = positions[-1]
+
+		masks.append(get_regions_mask(chroms, positions, index_chunk['REF'].values, regions))
+
+	if len(masks) == 0:
+
+		return []
+
+	keep = np.concatenate(masks).astype(np.int8)
+
+	# The rows where a run of rows to keep starts and stops
+	changes = np.diff(np.concatenate([[0], keep, [0]]))
+
+	return [[int(start), int(end)] for start, end in zip(np.flatnonzero(changes == 1), np.flatnonzero(changes == -1))]
+
+
+def read_region_rows(csv_file, row_ranges, chunk_size=None):
+	"""
+	Read only the rows of the input CSV in row_ranges - the other lines are skipped without being parsed.
+
+	Yields dataframes of up to chunk_size rows as they are read, or a single dataframe of all the \
+	rows if chunk_size is None. If no rows are in the ranges an empty dataframe is yielded so the \
+	columns are still known.
+
+	"""
+
+	with open_text_file(csv_file) as f:
+
+		header = f.readline()
+
+		lines = []
+		current_row = 0
+		chunks_yielded = 0
+
+		for start, end in row_ranges:
+
+			# Skip the lines before the range without parsing them
+			next(itertools.islice(f, start - current_row, start - current_row), None)
+
+			current_row = start
+
+			while current_row < end:
+
+				rows_to_read = end - current_row if chunk_size == None else min(end - current_row, chunk_size - len(lines))
+
+				lines.extend(itertools.islice(f, rows_to_read))
+
+				current_row = current_row + rows_to_read
+
+				if chunk_size != None and len(lines) >= chunk_size:
+
+					yield pd.read_csv(io.StringIO(header + ''.join(lines)), sep='\t', dtype={'CHROM': object})
+
+					lines = []
+					chunks_yielded = chunks_yielded + 1
+
+		if chunk_size == None or len(lines) > 0 or chunks_yielded == 0:
+
+			yield pd.read_csv(io.StringIO(header + ''.join(lines)), sep='\t', dtype={'CHROM': object})
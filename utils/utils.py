@@ -1,8 +1,26 @@
+from utils.regions import is_variant_in_regions
 import yaml
 import csv
 import pandas as pd
-import requests
+import numpy as np
 import datetime
+import gzip
+import re
+import threading
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# Dosage used for genotypes with no called alleles e.g. ./.
+missing_dosage = -1
+
+# Columns which repeat the same few values in every transcript row - stored as categoricals by compact_dtypes
+categorical_columns = ['CHROM', 'Consequence', 'IMPACT', 'SYMBOL', 'Gene', 'Feature', 'BIOTYPE', 'SIFT', 'PolyPhen', 'CLIN_SIG', 'SpliceAI_SYMBOL']
+
+default_panel_app_url = 'https://panelapp.genomicsengland.co.uk/WebServices/search_genes/{gene}/?format=json&LevelOfConfidence=HighEvidence'
+
+# The gnomad constraint scores added to each transcript if gnomad_constraint_metrics is not in the config
+default_gnomad_constraint_metrics = ['pLI', 'oe_lof', 'oe_lof_lower', 'oe_lof_upper']
 
 def parse_config(yaml_file):
 	"""
@@ -41,6 +59,37 @@ def parse_ped_file(ped_file):
 	return ped_dict
 
 
+def parse_batch_manifest(manifest_file):
+	"""
+	Parse the batch manifest into a list of dictionaries - one per job.
+
+	The manifest is a TSV file with the columns input, ped, worksheet, results_dir and optionally patient_hpos.
+
+	"""
+
+	jobs = []
+
+	with open(manifest_file) as csvfile:
+
+		spamreader = csv.DictReader(csvfile, delimiter='\t')
+
+		for row in spamreader:
+
+			for column in ['input', 'ped', 'worksheet', 'results_dir']:
+
+				if row.get(column) in [None, '']:
+
+					raise Exception(f'Manifest row {len(jobs) + 1} is missing a value for {column}.')
+
+			if row.get('patient_hpos') == '':
+
+				row['patient_hpos'] = None
+
+			jobs.append(row)
+
+	return jobs
+
+
 def parse_panel_app_dump(panel_app_dump):
 	"""
 	Parse the local panelapp dump. This stores the data retrieved from the PanelApp API locally so \
@@ -63,6 +112,266 @@ def parse_panel_app_dump(panel_app_dump):
 	return panel_app_dict
 
 
+def group_variant_chunks(chunks):
+	"""
+	Takes an iterable of dataframes and yields them back so that all the records for a variant \
+	are in the same chunk.
+
+	Rows at the end of a chunk which have the same position as the last row are carried over \
+	into the next chunk.
+
+	If there are no rows at all an empty chunk is yielded so the columns are still known.
+
+	"""
+
+	carry_over = None
+	empty_chunk = None
+
+	for chunk in chunks:
+
+		if carry_over is not None:
+
+			chunk = pd.concat([carry_over, chunk])
+
+		if chunk.shape[0] == 0:
+
+			empty_chunk = chunk
+			continue
+
+		last_row = chunk.iloc[-1]
+
+		is_last_position = (chunk['CHROM'] == last_row['CHROM']) & (chunk['POS'] == last_row['POS'])
+
+		carry_over = chunk[is_last_position]
+
+		if chunk[~is_last_position].shape[0] > 0:
+
+			yield chunk[~is_last_position]
+
+	# Every non empty chunk leaves some rows to carry over so this is only None if nothing was yielded
+	if carry_over is not None:
+
+		yield carry_over
+
+	elif empty_chunk is not None:
+
+		yield empty_chunk
+
+
+def read_variant_chunks(csv_file, chunk_size):
+	"""
+	Read the input CSV in chunks of roughly chunk_size variants.
+
+	"""
+
+	return group_variant_chunks(pd.read_csv(csv_file, sep='\t', dtype={'CHROM': object}, chunksize=chunk_size))
+
+
+def open_vcf(vcf_file):
+	"""
+	Open a plain or gzipped/bgzipped VCF for reading as text.
+
+	"""
+
+	with open(vcf_file, 'rb') as f:
+
+		is_gzipped = f.read(2) == b'\x1f\x8b'
+
+	if is_gzipped:
+
+		return gzip.open(vcf_file, 'rt')
+
+	return open(vcf_file, 'r')
+
+
+def get_vcf_csq_description(vcf_file):
+	"""
+	Get the VEP CSQ description e.g. Allele|Consequence|IMPACT|SYMBOL... from the VCF header.
+
+	Returns None if there is no CSQ INFO field in the header.
+
+	"""
+
+	with open_vcf(vcf_file) as f:
+
+		for line in f:
+
+			if not line.startswith('##'):
+
+				break
+
+			if line.startswith('##INFO=<ID=CSQ,'):
+
+				return line.split('Format: ')[1].split('"')[0].strip()
+
+	return None
+
+
+def convert_vcf_genotype(genotype, alleles):
+	"""
+	Convert a VCF genotype such as 0/1 into the bases e.g. A/G as in the GATK VariantsToTable output.
+
+	"""
+
+	converted = []
+
+	for allele in re.split(r'([/|])', genotype):
+
+		if allele in ('/', '|', '.'):
+
+			converted.append(allele)
+
+		else:
+
+			converted.append(alleles[int(allele)])
+
+	return ''.join(converted)
+
+
+def read_vcf_chunks(vcf_file, samples, format_fields, chunk_size=None, regions=None):
+	"""
+	Stream a plain or bgzipped VCF into dataframes with the same columns as the GATK \
+	VariantsToTable output described in the readme.
+
+	Only the CSQ and AC INFO fields and the format_fields for the samples given are extracted.
+
+	If chunk_size is None the whole file is returned as a single dataframe. If there are no records \
+	an empty dataframe is yielded so the columns are still known.
+
+	If regions is given (see utils/regions.py) records outside them are skipped before their \
+	INFO and genotypes are parsed.
+
+	"""
+
+	info_fields = ['CSQ', 'AC']
+
+	columns = ['CHROM', 'POS', 'REF', 'ALT', 'ID', 'QUAL', 'FILTER'] + info_fields
+
+	for sample in samples:
+
+		for format_field in format_fields:
+
+			columns.append(f'{sample}.{format_field}')
+
+	with open_vcf(vcf_file) as f:
+
+		sample_positions = None
+
+		for line in f:
+
+			if line.startswith('#CHROM'):
+
+				header = line.rstrip('\n').split('\t')
+
+				missing_samples = [sample for sample in samples if sample not in header]
+
+				if len(missing_samples) > 0:
+
+					raise Exception(f'Samples {missing_samples} from the PED file are not in the VCF.')
+
+				sample_positions = [header.index(sample) for sample in samples]
+
+				break
+
+		if sample_positions == None:
+
+			raise Exception('Could not find the #CHROM header line in the VCF.')
+
+		records = []
+		chunks_yielded = 0
+
+		for line in f:
+
+			fields = line.rstrip('\n').split('\t')
+
+			chrom, pos, variant_id, ref, alt, qual, vcf_filter, info, vcf_format = fields[:9]
+
+			if regions != None and not is_variant_in_regions(chrom, int(pos), ref, regions):
+
+				continue
+
+			info_dict = {}
+
+			for info_field in info.split(';'):
+
+				key, _, value = info_field.partition('=')
+
+				if key in info_fields:
+
+					info_dict[key] = value
+
+			record = [chrom, pos, ref, alt, variant_id, qual, None if vcf_filter == '.' else vcf_filter]
+
+			for info_field in info_fields:
+
+				record.append(info_dict.get(info_field))
+
+			format_keys = vcf_format.split(':')
+			alleles = [ref] + alt.split(',')
+
+			for sample_position in sample_positions:
+
+				sample_data = dict(zip(format_keys, fields[sample_position].split(':')))
+
+				for format_field in format_fields:
+
+					value = sample_data.get(format_field)
+
+					if value == None or value == '.':
+
+						record.append(None)
+
+					elif format_field == 'GT':
+
+						record.append(convert_vcf_genotype(value, alleles))
+
+					else:
+
+						record.append(value)
+
+			records.append(record)
+
+			if chunk_size != None and len(records) >= chunk_size:
+
+				yield vcf_records_to_dataframe(records, columns)
+
+				records = []
+				chunks_yielded = chunks_yielded + 1
+
+		if chunk_size == None or len(records) > 0 or chunks_yielded == 0:
+
+			yield vcf_records_to_dataframe(records, columns)
+
+
+def vcf_records_to_dataframe(records, columns):
+	"""
+	Turn the records parsed by read_vcf_chunks into a dataframe with numeric columns \
+	where pandas.read_csv would have made them.
+
+	"""
+
+	df = pd.DataFrame(records, columns=columns)
+
+	for column in columns:
+
+		if column in ['POS', 'QUAL', 'AC'] or ('.' in column and not column.endswith('.GT')):
+
+			df[column] = pd.to_numeric(df[column], errors='coerce')
+
+	return df
+
+
+def write_panel_app_dump(panel_app_dict, panel_app_dump):
+	"""
+	Write the PanelApp data to the local dump so it can be reused by later runs.
+
+	"""
+
+	panel_app_df = pd.DataFrame(panel_app_dict)
+
+	panel_app_df.transpose().to_csv(panel_app_dump, sep='\t')
+
+
 def is_proband_in_trio(sample, ped_dict):
 	"""
 	Is the sample a proband in a trio?
@@ -126,6 +435,129 @@ def select_variants_for_sample(df, sample, min_dp, min_gq, gt_depth_tag):
 		  return False
 
 
+def split_genotypes(genotypes):
+	"""
+	Split a column of genotypes e.g. A/G or A|G into a dataframe with one column per allele.
+
+	Genotypes containing a | are split on | and the rest on / - the same as the row wise functions.
+
+	"""
+
+	genotypes = genotypes.reset_index(drop=True)
+
+	is_phased = genotypes.str.contains('|', regex=False)
+	is_unphased = genotypes.str.contains('/', regex=False)
+
+	if (~(is_phased | is_unphased)).any():
+
+		raise Exception('There is a genotype without either | or / in.')
+
+	phased_alleles = genotypes[is_phased].str.split('|', expand=True)
+	unphased_alleles = genotypes[~is_phased].str.split('/', expand=True)
+
+	return pd.concat([phased_alleles, unphased_alleles]).sort_index()
+
+
+def convert_genotype_field(values):
+	"""
+	Convert a GQ or depth column to numbers.
+
+	. and blank are deliberately treated as missing and become NaN, so they fail the cutoffs. Any \
+	other value which is not a number raises an error rather than being silently treated as missing.
+
+	"""
+
+	return pd.to_numeric(values.replace(['.', ''], np.nan))
+
+
+def decode_genotypes(df, samples, gt_depth_tag):
+	"""
+	Parse the GT of each sample once into columns which the later stages can use without splitting \
+	the genotype strings again:
+
+	SAMPLE.DOSAGE = int8 number of copies of the ALT allele - missing_dosage if no alleles are called e.g. ./.
+	SAMPLE.PHASED = whether the genotype is phased e.g. A|G
+
+	The GQ and depth columns are also converted to numbers with convert_genotype_field.
+
+	"""
+
+	alt = df['ALT'].reset_index(drop=True)
+
+	genotype_df = pd.DataFrame(index=df.index)
+
+	for sample in samples:
+
+		genotypes = df[sample + '.GT']
+
+		alleles = split_genotypes(genotypes)
+
+		dosage = alleles.eq(alt, axis=0).sum(axis=1).values.astype(np.int8)
+
+		is_missing = (alleles.isin(['.']) | alleles.isna()).all(axis=1).values
+
+		dosage[is_missing] = missing_dosage
+
+		genotype_df[sample + '.DOSAGE'] = dosage
+		genotype_df[sample + '.PHASED'] = genotypes.str.contains('|', regex=False).values
+		genotype_df[sample + '.GQ'] = convert_genotype_field(df[sample + '.GQ'])
+		genotype_df[sample + '.' + gt_depth_tag] = convert_genotype_field(df[sample + '.' + gt_depth_tag])
+
+	return genotype_df
+
+
+def get_alt_dosage(df, sample):
+	"""
+	Get the number of copies of the ALT allele the sample has for each row - missing genotypes count as 0.
+
+	Uses the dosage column from decode_genotypes if there is one otherwise the GT strings are parsed.
+
+	"""
+
+	if f'sample_{sample}_DOSAGE' in df.columns:
+
+		return np.maximum(df[f'sample_{sample}_DOSAGE'].values, 0)
+
+	alleles = split_genotypes(df[f'sample_{sample}_GT'])
+
+	return alleles.eq(df['ALT'].reset_index(drop=True), axis=0).sum(axis=1).values
+
+
+def select_variants_for_samples(df, samples, min_dp, min_gq, gt_depth_tag):
+	"""
+	Vectorised version of select_variants_for_sample.
+
+	Needs the columns added by decode_genotypes.
+
+	Returns a dataframe with a SAMPLE_is_relevant column for each sample which is True if the sample \
+	has the ALT allele and the genotype passes the min_dp and min_gq filters.
+
+	"""
+
+	relevant_df = pd.DataFrame(index=df.index)
+
+	for sample in samples:
+
+		is_variant = (df[sample + '.DOSAGE'] >= 1).values
+
+		passes_filter = ((df[sample + '.GQ'] >= min_gq) & (df[sample + '.' + gt_depth_tag] >= min_dp)).values
+
+		relevant_df[sample + '_is_relevant'] = is_variant & passes_filter
+
+	return relevant_df
+
+
+def get_genotypes(df, sample):
+	"""
+	Vectorised version of get_genotype - HET, HOM or UNKNOWN for each row.
+
+	"""
+
+	dosage = get_alt_dosage(df, sample)
+
+	return np.where(dosage == 1, 'HET', np.where(dosage == 2, 'HOM', 'UNKNOWN')).astype(object)
+
+
 def fix_column_names(columns):
 	"""
 	Change column names to valid python variable names by replacing '.' with '_'
@@ -149,50 +581,35 @@ def fix_column_names(columns):
 	return fixed_columns
 
 
-def parse_csq(csq_string, csq_desc):
+def compile_csq_projection(csq_desc, vep_fields):
 	"""
-	Take the raw VEP string and parse it into a list of dictionaries containing the information.
-	
+	Work out the position of each of the vep_fields in the CSQ description.
+
+	This is done once per run so that each transcript only needs to be split as far as the \
+	last field we want, rather than zipping every field into a dictionary.
+
 	"""
-	
-	transcript_list = []
-	
-	# if we don't have a CSQ string then set everything to None
-	if pd.isna(csq_string) == True:
-		
-		transcript_dict = {}
-		
-		for key in csq_desc:
-			
-			transcript_dict[key] = None
-			
-		transcript_list.append(transcript_dict)
-		
-		return transcript_list
-	
-	# Split out the consequence blocks
-	transcripts = csq_string.split(',')
-	
-	for transcript in transcripts:
-		
-		transcript_dict = {}
-		
-		vep_data = transcript.split('|')
 
-		if len(csq_desc) != len(vep_data):
+	# If a field is duplicated use the last one
+	csq_positions = {key: i for i, key in enumerate(csq_desc)}
 
-			raise Exception('VEP CSQ String Mismatch! Check the input CSQ description.')
-		
-		for key, value in zip(csq_desc, vep_data):
-			
-			transcript_dict[key] = value
-			
-		transcript_list.append(transcript_dict)
-		
-	return transcript_list
-		
-		
-def split_vep_transcripts(df, csq_desc, vep_fields, column_names):
+	missing_fields = [vep_field for vep_field in vep_fields if vep_field not in csq_positions]
+
+	if len(missing_fields) > 0:
+
+		raise Exception(f'VEP fields {missing_fields} are not in the CSQ description! Check the input CSQ description.')
+
+	positions = [csq_positions[vep_field] for vep_field in vep_fields]
+
+	csq_projection = {}
+	csq_projection['n_fields'] = len(csq_desc)
+	csq_projection['positions'] = positions
+	csq_projection['max_split'] = max(positions, default=-1) + 1
+
+	return csq_projection
+
+
+def split_vep_transcripts(df, csq_desc, vep_fields, column_names, csq_projection=None):
 	"""
 	Takes a df and splits out the CSQ field so that each line in the dataframe is a \
 	seperate transcript.
@@ -201,52 +618,102 @@ def split_vep_transcripts(df, csq_desc, vep_fields, column_names):
 	csq_desc = the csq string from the vcf header
 	vep_fields = the vep fields to extract
 	column_names = the new columns for the new df
+	csq_projection = the output of compile_csq_projection - compiled here if not given
+
+	The CSQ column is split and exploded using pandas string methods rather than \
+	looping through each variant.
 	
 	"""
-	
-	new_df_list = []
 
-	for variant in df.itertuples():
-		
-		csq = variant.CSQ
-		
-		# Parse csq string into a list of dictionaries
-		transcript_list = parse_csq(csq, csq_desc)
-		
-		# Add the standard vcf columns
-		vcf_row = []
-		for data in variant:
-			
-			vcf_row.append(data)
-		
-		# Combine the standard columns and the genotype columns                
-		for transcript in transcript_list:
-			
-			vep_row = []
-			
-			for vep_field in vep_fields:
-				
-				data = transcript[vep_field]
-				
-				if data == '.':
-					
-					data = None
-				
-				vep_row = vep_row + [data]
-				
-			final_row = vcf_row + vep_row
-			
-			# first item in list is the index so exclude
-			new_df_list.append(final_row[1:])
-			
-	for vep_field in vep_fields:
-		
-		column_names = column_names + [vep_field]
-		
-	new_df = pd.DataFrame(new_df_list, columns = column_names)
+	if csq_projection == None:
+
+		csq_projection = compile_csq_projection(csq_desc, vep_fields)
+
+	df = df.reset_index(drop=True)
+
+	# Put each consequence block on its own row - variants without a CSQ string get a single empty block
+	transcripts = df['CSQ'].astype(object).str.split(',').explode()
+	has_csq = pd.notna(transcripts).values
+
+	vep_data = transcripts[has_csq]
+
+	field_counts = np.fromiter((transcript.count('|') + 1 for transcript in vep_data.values), dtype=np.int64, count=vep_data.shape[0])
+
+	if (field_counts != csq_projection['n_fields']).any():
+
+		raise Exception('VEP CSQ String Mismatch! Check the input CSQ description.')
+
+	vep_values = np.full((transcripts.shape[0], len(vep_fields)), None, dtype=object)
+
+	if vep_data.shape[0] > 0:
+
+		# Fields after the last one we want are left unsplit
+		vep_data = vep_data.str.split('|', n=csq_projection['max_split'])
+
+		vep_values[has_csq] = pd.DataFrame(vep_data.tolist()).values[:, csq_projection['positions']]
+
+	vep_values[vep_values == '.'] = None
+
+	new_df = df.take(transcripts.index).reset_index(drop=True)
+	new_df.columns = column_names
+
+	for i, vep_field in enumerate(vep_fields):
+
+		new_df[vep_field] = vep_values[:, i]
 	
 	return new_df
 
+def compact_dtypes(df, columns):
+	"""
+	Store the columns as categoricals so each distinct string is held once rather than once per row.
+
+	Only object columns are converted and columns not in df are ignored.
+
+	"""
+
+	for column in columns:
+
+		if column in df.columns and df[column].dtype == object:
+
+			df[column] = df[column].astype('category')
+
+	return df
+
+
+def unify_categories(dfs):
+	"""
+	Give each categorical column the same categories in all of the dataframes so that pd.concat \
+	keeps it categorical rather than turning it back into strings.
+
+	"""
+
+	categories = {}
+
+	for df in dfs:
+
+		for column in df.columns:
+
+			if isinstance(df[column].dtype, pd.CategoricalDtype):
+
+				categories.setdefault(column, []).append(df[column].cat.categories)
+
+	for column, column_categories in categories.items():
+
+		union = column_categories[0]
+
+		for other in column_categories[1:]:
+
+			union = union.union(other, sort=False)
+
+		for df in dfs:
+
+			if column in df.columns and isinstance(df[column].dtype, pd.CategoricalDtype):
+
+				df[column] = df[column].cat.set_categories(union)
+
+	return dfs
+
+
 def get_variant_key(df):
 	"""
 	Make a key for the variant.
@@ -288,6 +755,120 @@ def get_worst_consequence(consequences, consequence_severity):
 		return consequence_severity[worst_index]
 	
 	
+def compile_consequence_ranks(consequence_severity, to_keep_consequences, clin_sig_words):
+	"""
+	Turn the consequence settings from the config into integer ranks so the consequence filter \
+	can be done on arrays. The most severe consequence has rank 0.
+
+	Returns a dictionary with:
+
+	ranks = dictionary of consequence to rank
+	keep_ranks = set of the ranks of the consequences in to_keep_consequences
+	clin_sig_pattern = compiled case insensitive regex matching any of the clin_sig_words
+
+	"""
+
+	ranks = {}
+
+	for rank, consequence in enumerate(consequence_severity):
+
+		if consequence not in ranks:
+
+			ranks[consequence] = rank
+
+	for consequence in to_keep_consequences:
+
+		if consequence not in ranks:
+
+			raise Exception(f'Unknown consequence {consequence} in to_keep_consequences - add it to consequence_severity in the config file.')
+
+	consequence_ranks = {}
+	consequence_ranks['ranks'] = ranks
+	consequence_ranks['consequence_severity'] = consequence_severity
+	consequence_ranks['keep_ranks'] = set(ranks[consequence] for consequence in to_keep_consequences)
+
+	if len(clin_sig_words) > 0:
+
+		consequence_ranks['clin_sig_pattern'] = re.compile('|'.join(re.escape(word) for word in clin_sig_words), re.IGNORECASE)
+
+	else:
+
+		consequence_ranks['clin_sig_pattern'] = re.compile('(?!)')
+
+	return consequence_ranks
+
+
+def get_worst_consequences(df, consequence_ranks):
+	"""
+	Vectorised version of get_worst_consequence - the worst consequence in any transcript of each variant.
+
+	As in get_worst_consequence transcripts are looked at in order and we stop at the first one without \
+	a consequence.
+
+	Returns a tuple of the rank and the name of the worst consequence for each row of df. Variants with \
+	no consequence get the rank len(consequence_severity) and None.
+
+	"""
+
+	ranks = consequence_ranks['ranks']
+	consequence_severity = consequence_ranks['consequence_severity']
+	no_consequence = len(consequence_severity)
+
+	variant_codes, variants = pd.factorize(df['VariantId'])
+
+	consequences = df['Consequence'].values
+
+	is_missing = pd.isna(consequences)
+	is_after_missing = pd.Series(is_missing).groupby(variant_codes).cumsum().values > 0
+
+	# Split each distinct consequence string e.g. missense_variant&splice_region_variant once
+	consequence_to_rank = {}
+
+	for consequence in pd.unique(consequences[~is_after_missing]):
+
+		terms = consequence.split('&')
+
+		for term in terms:
+
+			if term not in ranks:
+
+				raise Exception(f'Unknown consequence {term} - add it to consequence_severity in the config file.')
+
+		consequence_to_rank[consequence] = min(ranks[term] for term in terms)
+
+	row_ranks = np.full(len(consequences), no_consequence, dtype=np.int64)
+	row_ranks[~is_after_missing] = [consequence_to_rank[consequence] for consequence in consequences[~is_after_missing]]
+
+	# Smallest rank for each variant
+	worst_ranks = np.full(len(variants), no_consequence, dtype=np.int64)
+	np.minimum.at(worst_ranks, variant_codes, row_ranks)
+
+	worst_ranks = worst_ranks[variant_codes]
+
+	worst_consequences = np.array(list(consequence_severity) + [None], dtype=object)[worst_ranks]
+
+	return worst_ranks, worst_consequences
+
+
+def get_important_clinsigs(df, consequence_ranks):
+	"""
+	Vectorised version of has_important_clinsig - None where there is no CLIN_SIG otherwise whether \
+	it contains one of the clin_sig_words.
+
+	"""
+
+	clin_sig_pattern = consequence_ranks['clin_sig_pattern']
+
+	clin_sigs = df['CLIN_SIG'].values
+
+	has_clin_sig = ~pd.isna(clin_sigs)
+
+	important_clinsigs = np.full(len(clin_sigs), None, dtype=object)
+	important_clinsigs[has_clin_sig] = [clin_sig_pattern.search(clin_sig) != None for clin_sig in clin_sigs[has_clin_sig]]
+
+	return important_clinsigs
+
+
 def consequence_filter(df, to_keep_consequences):
 	"""
 	Whether to filter the variant on consequence?
@@ -435,87 +1016,342 @@ def fix_ccrs(df):
 
 
 
-def annotate_with_gnomad_scores(df, gnomad_scores_dict, value):
+def load_gnomad_constraint(gnomad_file, metrics):
 	"""
-	Add the gnomad constraint score for that transcript.
+	Load the gnomad constraint scores into a table indexed by transcript.
+
+	Only the transcript column (the first column) and the metrics columns are read. If a transcript \
+	is in the file more than once the last row is used.
 
 	"""
-	
-	feature = df['Feature']
-	
-	if feature == None:
-		
-		return None
-	
-	feature = feature.split('.')[0]
-	
-	if feature in gnomad_scores_dict[value]:
-		
-		return gnomad_scores_dict[value][feature]
-	
-	else:
-		
-		return None
 
-def get_panel_app_info(gene):
+	header = pd.read_csv(gnomad_file, nrows=0).columns
+
+	missing_metrics = [metric for metric in metrics if metric not in header]
+
+	if len(missing_metrics) > 0:
+
+		raise Exception(f'The gnomad constraint metrics {missing_metrics} are not in {gnomad_file}.')
+
+	transcript_column = header[0]
+
+	gnomad_constraint_df = pd.read_csv(gnomad_file, usecols=[transcript_column] + list(metrics), index_col=transcript_column)
+
+	gnomad_constraint_df = gnomad_constraint_df[~gnomad_constraint_df.index.duplicated(keep='last')]
+
+	return gnomad_constraint_df[list(metrics)]
+
+
+def annotate_with_gnomad_constraint(features, gnomad_constraint_df):
+	"""
+	Get the gnomad constraint scores for each transcript in features.
+
+	The version is stripped from each unique transcript once and all the metrics are looked up in a \
+	single join. Transcripts which are missing or not in the table get NaN.
+
+	Returns a DataFrame with a column for each metric and a row for each transcript in features.
+
+	"""
+
+	feature_codes, unique_features = pd.factorize(pd.Series(features, dtype=object))
+
+	unique_transcripts = pd.Series(unique_features, dtype=object).str.split('.', n=1).str[0]
+
+	unique_scores = gnomad_constraint_df.reindex(unique_transcripts.values)
+
+	# Missing transcripts have a code of -1 so add a row of NaN at the end for them
+	unique_scores = pd.concat([unique_scores, pd.DataFrame(np.nan, index=[None], columns=unique_scores.columns)])
+
+	return unique_scores.iloc[feature_codes].reset_index(drop=True)
+
+
+def get_panel_app_info(gene, session=None, panel_app_url=None, timeout=5):
 	"""
 	Query panel app and get the data for a specific gene.
 
 	"""
-	
-	url = f'https://panelapp.genomicsengland.co.uk/WebServices/search_genes/{gene}/?format=json&LevelOfConfidence=HighEvidence'
-	
+
+	try:
+
+		return fetch_panel_app_info(gene, session, panel_app_url, timeout)
+
+	except:
+
+		return None, None
+
+
+def fetch_panel_app_info(gene, session=None, panel_app_url=None, timeout=5):
+	"""
+	Query panel app and get the data for a specific gene.
+
+	Unlike get_panel_app_info a failed request (connection error, timeout or server error) raises \
+	requests.RequestException so that the caller can retry. Anything else which goes wrong, for example \
+	a response which is not in the expected format, returns None, None.
+
+	"""
+
+	# Only imported when PanelApp is used as it is slow to import
+	import requests
+
+	if panel_app_url == None:
+
+		panel_app_url = default_panel_app_url
+
+	if session == None:
+
+		session = requests
+
+	url = panel_app_url.format(gene=gene)
+
+	panel_response = session.get(url, timeout=timeout)
+
+	if panel_response.status_code >= 500:
+
+		raise requests.HTTPError(f'PanelApp returned status {panel_response.status_code} for {gene}')
+
 	try:
-		panel_response = requests.get(url, timeout=5)
 
 		panel_data = panel_response.json()
-		
+
 		if panel_data['meta']['numOfResults'] == 0:
-		
+
 			return None, None
-	
+
 		diseases = []
 		modes_of_inheritance = []
-	
+
 		for gene_info in panel_data['results']:
-				
+
 			if float(gene_info['version']) > 1.0:
-		   
+
 				diseases.append(gene_info.get('SpecificDiseaseName', 'None'))
-				
+
 				modes_of_inheritance.append(gene_info.get('ModeOfInheritance', 'None'))
-		
+
 		return '|'.join(list(set(diseases))), '|'.join(set(modes_of_inheritance))
-	
+
 	except:
-		
+
 		return None, None
 
-def apply_panel_app_data_disease(df, panel_app_dict, panel_app_dump_max_time):
+
+def is_panel_app_data_current(symbol, panel_app_dict, panel_app_dump_max_time):
+	"""
+	Whether we have PanelApp data for the gene which is newer than panel_app_dump_max_time days.
+
+	"""
+
+	if symbol not in panel_app_dict:
+
+		return False
+
+	today = datetime.datetime.now()
+
+	last_analyzed = parse_panel_app_date(panel_app_dict[symbol]['date'])
+
+	difference = today - last_analyzed
+
+	return difference.days < panel_app_dump_max_time
+
+
+@functools.lru_cache(maxsize=None)
+def parse_panel_app_date(date):
+	"""
+	Get the day from a date in the PanelApp data e.g. 2019-03-01 12:00:00.123456
+
+	The same dates are looked up for every row so the result is cached.
+
+	"""
+
+	last_analyzed = date.split(' ')[0].split('-')
+
+	return datetime.datetime(int(last_analyzed[0]), int(last_analyzed[1]), int(last_analyzed[2]))
+
+
+def start_panel_app_prefetch(config_dict):
+	"""
+	Start a pool of threads for fetching PanelApp data in the background.
+
+	Genes are added with submit_panel_app_prefetch and the results are added to the panel_app_dict \
+	by finish_panel_app_prefetch. The session is kept open for any genes which still need fetching \
+	when the transcripts are annotated and closed by close_panel_app_prefetch. The settings below \
+	can be overridden in the config file:
+
+	panel_app_url = URL to query with {gene} in place of the gene symbol
+	panel_app_workers = number of requests to have running at once
+	panel_app_retries = number of times to retry a failed request
+	panel_app_max_failures = stop querying PanelApp after this many genes in a row have failed
+
+	"""
+
+	import requests
+
+	panel_app_workers = config_dict.get('panel_app_workers', 8)
+
+	# One session so connections are reused - the pool is sized so each thread can keep its connection
+	session = requests.Session()
+	adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=panel_app_workers)
+	session.mount('http://', adapter)
+	session.mount('https://', adapter)
+
+	prefetch = {}
+	prefetch['session'] = session
+	prefetch['executor'] = ThreadPoolExecutor(max_workers=panel_app_workers)
+	prefetch['panel_app_url'] = config_dict.get('panel_app_url', default_panel_app_url)
+	prefetch['retries'] = config_dict.get('panel_app_retries', 2)
+	prefetch['max_failures'] = config_dict.get('panel_app_max_failures', 10)
+	prefetch['panel_app_dump_max_time'] = config_dict['panel_app_dump_max_time']
+	prefetch['futures'] = {}
+	prefetch['hits'] = set()
+	prefetch['lock'] = threading.Lock()
+	prefetch['consecutive_failures'] = 0
+	prefetch['circuit_open'] = False
+
+	return prefetch
+
+
+def prefetch_panel_app_gene(gene, prefetch):
+	"""
+	Fetch the PanelApp data for a gene, retrying failed requests.
+
+	Returns a tuple of (diseases, inheritance, seconds taken, whether the fetch failed).
+
+	"""
+
+	import requests
+
+	start = time.perf_counter()
+
+	for attempt in range(prefetch['retries'] + 1):
+
+		# Once too many genes have failed in a row assume PanelApp is down and don't wait for it
+		if prefetch['circuit_open'] == True:
+
+			break
+
+		if attempt > 0:
+
+			time.sleep(0.5 * 2 ** (attempt - 1))
+
+		try:
+
+			diseases, inheritance = fetch_panel_app_info(gene, prefetch['session'], prefetch['panel_app_url'])
+
+		except requests.RequestException:
+
+			continue
+
+		with prefetch['lock']:
+
+			prefetch['consecutive_failures'] = 0
+
+		return diseases, inheritance, time.perf_counter() - start, False
+
+	with prefetch['lock']:
+
+		prefetch['consecutive_failures'] = prefetch['consecutive_failures'] + 1
+
+		if prefetch['consecutive_failures'] >= prefetch['max_failures']:
+
+			prefetch['circuit_open'] = True
+
+	return None, None, time.perf_counter() - start, True
+
+
+def submit_panel_app_prefetch(prefetch, genes, panel_app_dict):
+	"""
+	Start fetching the PanelApp data for any of the genes which are not already in panel_app_dict.
+
+	"""
+
+	for gene in genes:
+
+		if not isinstance(gene, str) or gene in prefetch['futures'] or gene in prefetch['hits']:
+
+			continue
+
+		if is_panel_app_data_current(gene, panel_app_dict, prefetch['panel_app_dump_max_time']):
+
+			prefetch['hits'].add(gene)
+
+		else:
+
+			prefetch['futures'][gene] = prefetch['executor'].submit(prefetch_panel_app_gene, gene, prefetch)
+
+
+def finish_panel_app_prefetch(prefetch, panel_app_dict):
+	"""
+	Wait for the PanelApp requests to finish and add the results to panel_app_dict.
+
+	Genes which could not be fetched are stored as None in the same way as get_panel_app_info does \
+	so they are not queried again for each sample.
+
+	Returns a dictionary of statistics about the prefetch.
+
+	"""
+
+	latencies = []
+	failed = 0
+
+	for gene, future in prefetch['futures'].items():
+
+		diseases, inheritance, seconds, has_failed = future.result()
+
+		date = datetime.datetime.now()
+
+		panel_app_dict[gene] = {'disease': diseases, 'inheritance': inheritance, 'date': str(date)}
+
+		latencies.append(seconds)
+
+		if has_failed == True:
+
+			failed = failed + 1
+
+	stats = {}
+	stats['genes'] = len(prefetch['hits']) + len(prefetch['futures'])
+	stats['hits'] = len(prefetch['hits'])
+	stats['fetched'] = len(prefetch['futures']) - failed
+	stats['failed'] = failed
+	stats['hit_rate'] = stats['hits'] / stats['genes'] if stats['genes'] > 0 else 0.0
+	stats['mean_latency'] = float(np.mean(latencies)) if len(latencies) > 0 else 0.0
+	stats['max_latency'] = max(latencies) if len(latencies) > 0 else 0.0
+	stats['circuit_open'] = prefetch['circuit_open']
+
+	return stats
+
+
+def close_panel_app_prefetch(prefetch):
+	"""
+	Stop the threads and close the session used to fetch PanelApp data.
+
+	"""
+
+	prefetch['executor'].shutdown()
+	prefetch['session'].close()
+
+
+def apply_panel_app_data_disease(df, panel_app_dict, panel_app_dump_max_time, prefetch=None):
 	"""
 	Get the panel app data for each row in the dataframe.
 
+	If prefetch is given genes which were not prefetched are fetched with its session, URL and \
+	retries, and are not fetched at all once its circuit breaker is open.
+
 	"""
 	
 	symbol = df['SYMBOL']
 	
-	if symbol in panel_app_dict:
+	if is_panel_app_data_current(symbol, panel_app_dict, panel_app_dump_max_time):
 
-		today = datetime.datetime.now()
-
-		last_analyzed = panel_app_dict[symbol]['date']
-
-		last_analyzed = last_analyzed.split(' ')[0].split('-')
+		return panel_app_dict[symbol]['disease']
+	
+	if prefetch != None:
 
-		last_analyzed = datetime.datetime(int(last_analyzed[0]), int(last_analyzed[1]), int(last_analyzed[2]))
+		diseases, inheritance, seconds, has_failed = prefetch_panel_app_gene(symbol, prefetch)
 
-		difference = today - last_analyzed
+	else:
 
-		if difference.days < panel_app_dump_max_time:
-		
-			return panel_app_dict[symbol]['disease']
-	
-	diseases, inheritance = get_panel_app_info(symbol)
+		diseases, inheritance = get_panel_app_info(symbol)
 		
 	date = datetime.datetime.now()
 		
@@ -524,31 +1360,28 @@ def apply_panel_app_data_disease(df, panel_app_dict, panel_app_dump_max_time):
 	return panel_app_dict[symbol]['disease']
 
 
-def apply_panel_app_data_inheritance(df, panel_app_dict, panel_app_dump_max_time):
+def apply_panel_app_data_inheritance(df, panel_app_dict, panel_app_dump_max_time, prefetch=None):
 	"""
 	Get the panel app data for each row in the dataframe.
 
+	If prefetch is given genes which were not prefetched are fetched with its session, URL and \
+	retries, and are not fetched at all once its circuit breaker is open.
+
 	"""
 
 	symbol = df['SYMBOL']
 	
-	if symbol in panel_app_dict:
-
-		today = datetime.datetime.now()
+	if is_panel_app_data_current(symbol, panel_app_dict, panel_app_dump_max_time):
 
-		last_analyzed = panel_app_dict[symbol]['date']
-
-		last_analyzed = last_analyzed.split(' ')[0].split('-')
+		return panel_app_dict[symbol]['inheritance']
+	
+	if prefetch != None:
 
-		last_analyzed = datetime.datetime(int(last_analyzed[0]), int(last_analyzed[1]), int(last_analyzed[2]))
+		diseases, inheritance, seconds, has_failed = prefetch_panel_app_gene(symbol, prefetch)
 
-		difference = today - last_analyzed
+	else:
 
-		if difference.days < panel_app_dump_max_time:
-		
-			return panel_app_dict[symbol]['inheritance']
-	
-	diseases, inheritance = get_panel_app_info(symbol)
+		diseases, inheritance = get_panel_app_info(symbol)
 		
 	date = datetime.datetime.now()
 		
@@ -691,25 +1524,29 @@ def get_hgvsp(df):
 		return hgvsp.split(':')[1]
 
 
-def annotate_hpo(df, patient_hpos, hpo_dict):
+def apply_once_per_value(df, function, columns, args=()):
 	"""
-	Add the count of the matching HPO terms.
+	Apply a row wise function once for each unique combination of values in the columns \
+	rather than once for each row. The function must only depend on these columns.
+
+	Returns an array with the result for each row of df.
 
 	"""
 
-	gene_id = df['Gene']
+	unique_df = df[columns].drop_duplicates()
 
-	counter = 0
+	# Missing values in categoricals come out as NaN rather than None which the row wise functions check for
+	function_df = unique_df.copy()
 
-	if gene_id in hpo_dict:
-		
-		for patient_hpo in set(patient_hpos):
+	for column in columns:
+
+		if isinstance(function_df[column].dtype, pd.CategoricalDtype):
 
-			if patient_hpo in hpo_dict[gene_id]:
+			function_df[column] = function_df[column].astype(object).where(function_df[column].notna(), None)
 
-				counter = counter + 1
+	unique_df['value'] = function_df.apply(function, axis=1, args=args)
 
-	return counter
+	return df[columns].merge(unique_df, how='left', on=columns)['value'].values
 
 
 def check_picks(df, pick_dict):
@@ -743,6 +1580,11 @@ def are_arguments_valid(args, config_dict):
 		print ('Cannot select to use PanelApp dump and not select to add PanelApp Data.')
 		return False
 
+	if getattr(args, 'panel_app_cache', None) != None and args.panelapp == False:
+
+		print ('Cannot select to use PanelApp cache and not select to add PanelApp Data.')
+		return False
+
 	if args.spliceai == True and 'SpliceAI' not in args.csq[0]:
 
 		print ('Input file does not contain the required annotations for the spliceai option.')
@@ -826,6 +1668,92 @@ def fix_gnomad(df, column):
 			return None
 
 
+def does_gnomad_value_pass(value, cutoff):
+	"""
+	Check whether a raw gnomad AF_POPMAX value from a CSQ block passes the frequency cutoff, \
+	parsing it with fix_gnomad in the same way as the frequency filter does after the CSQ is split.
+
+	Missing values pass. Values fix_gnomad can't parse also pass so the variant is kept and the \
+	error is raised by the frequency filter as before.
+
+	"""
+
+	try:
+
+		gnomad = fix_gnomad({'gnomad': value}, 'gnomad')
+
+	except ValueError:
+
+		return True
+
+	return gnomad == None or np.isnan(gnomad) or gnomad <= cutoff
+
+
+def get_csq_frequency_mask(csq_values, csq_desc, cutoff_genomes, cutoff_exomes):
+	"""
+	Work out which variants could pass the gnomad frequency filter from their raw CSQ strings \
+	so that common variants can be removed before the CSQ is split into one row per transcript.
+
+	The AF_POPMAX values are the same in each block but a variant is only removed if every block \
+	fails, so exactly the same transcripts are left after the frequency filter. Each distinct value \
+	is only parsed once. Variants with no CSQ string or a block with the wrong number of fields \
+	are kept so the usual errors are raised when the CSQ is split.
+
+	Returns a boolean array which is True for the variants to keep.
+
+	"""
+
+	# If a field is duplicated use the last one - the same as compile_csq_projection
+	csq_positions = {key: i for i, key in enumerate(csq_desc)}
+
+	n_fields = len(csq_desc)
+	genomes_position = csq_positions['gnomADg_AF_POPMAX']
+	exomes_position = csq_positions['gnomADe_AF_POPMAX']
+	max_split = max(genomes_position, exomes_position) + 1
+
+	genomes_passes = {}
+	exomes_passes = {}
+
+	keep = np.ones(len(csq_values), dtype=bool)
+
+	for i, csq in enumerate(csq_values):
+
+		if not isinstance(csq, str):
+
+			continue
+
+		keep_variant = False
+
+		for block in csq.split(','):
+
+			if block.count('|') + 1 != n_fields:
+
+				keep_variant = True
+				break
+
+			fields = block.split('|', max_split)
+
+			genomes_value = fields[genomes_position]
+			exomes_value = fields[exomes_position]
+
+			if genomes_value not in genomes_passes:
+
+				genomes_passes[genomes_value] = does_gnomad_value_pass(genomes_value, cutoff_genomes)
+
+			if exomes_value not in exomes_passes:
+
+				exomes_passes[exomes_value] = does_gnomad_value_pass(exomes_value, cutoff_exomes)
+
+			if genomes_passes[genomes_value] == True and exomes_passes[exomes_value] == True:
+
+				keep_variant = True
+				break
+
+		keep[i] = keep_variant
+
+	return keep
+
+
 
 
 
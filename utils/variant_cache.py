@@ -0,0 +1,275 @@
+"""
+Functions for caching the filtered variants between runs.
+
+The transcripts which pass the variant level filters are stored under a key made from a hash of the \
+input file, the CSQ description and the config used by those filters, so a worksheet which is rerun \
+with a different PED or HPO file does not need to be read and filtered again.
+
+Each sample output also has a small record next to it with the key of everything that went into it \
+so that samples which have not changed can be skipped.
+
+The filtered variants are stored as Parquet and never pickled - the cache can be shared between users \
+and loading a pickle runs whatever code is in it.
+
+"""
+
+import pandas as pd
+import hashlib
+import json
+import os
+import tempfile
+
+# Change this if the format of the cached variants changes
+variant_cache_version = 2
+
+# The config used by the quality, frequency and consequence filters
+variant_cache_config_keys = ['vep_fields', 'min_dp', 'min_gq', 'gt_depth_tag', 'default_cutoff_gnomad_genomes', 'default_cutoff_gnomad_exomes',
+	'splice_ai_cutoff', 'consequence_severity', 'to_keep_consequences', 'clin_sig_words']
+
+# The options used by the variant level filters
+variant_cache_option_keys = ['csq_desc', 'parse_splice_ai', 'smart_synonymous_filtering', 'compact_dtypes', 'regions']
+
+# The options used by the per sample stages
+sample_cache_option_keys = ['add_ccrs', 'add_gnomad_constraint_scores', 'add_panel_app_info', 'add_hpo', 'worksheet']
+
+def hash_file(filepath, block_size=1048576):
+	"""
+	Get the sha256 of the contents of a file.
+
+	"""
+
+	file_hash = hashlib.sha256()
+
+	with open(filepath, 'rb') as f:
+
+		for block in iter(lambda: f.read(block_size), b''):
+
+			file_hash.update(block)
+
+	return file_hash.hexdigest()
+
+
+def hash_values(*values):
+	"""
+	Get the sha256 of some JSON serialisable values e.g. parts of the config.
+
+	"""
+
+	return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_file_stamp(filepath):
+	"""
+	Cheap stand in for hashing a large reference file - its path, size and modification time.
+
+	Returns None if there is no file.
+
+	"""
+
+	if filepath == None or not os.path.exists(filepath):
+
+		return None
+
+	file_stat = os.stat(filepath)
+
+	return [os.path.abspath(filepath), file_stat.st_size, file_stat.st_mtime]
+
+
+def get_variant_cache_key(input_file, options, config_dict, samples, version):
+	"""
+	Get the key for the filtered variants of an input file.
+
+	The samples are part of the key as the filtered variants have a column for each sample in the PED file. \
+	The contents of the regions BED file are part of the key as well as its path.
+
+	"""
+
+	config_values = {key: config_dict.get(key) for key in variant_cache_config_keys}
+	option_values = {key: options.get(key) for key in variant_cache_option_keys}
+
+	regions_hash = hash_file(options['regions']) if options.get('regions') != None else None
+
+	return hash_values(variant_cache_version, version, hash_file(input_file), config_values, option_values, sorted(samples), regions_hash)
+
+
+def read_variant_cache(cache_dir, key):
+	"""
+	Read the filtered variants for a key from the cache.
+
+	Returns None if they are not in the cache.
+
+	"""
+
+	cache_file = os.path.join(cache_dir, f'{key}.parquet')
+
+	try:
+
+		vep_df = pd.read_parquet(cache_file)
+
+	# Not cached or removed by another run while we were reading it
+	except (OSError, ValueError, ImportError):
+
+		return None
+
+	# Mark as recently used so it is evicted last
+	try:
+
+		os.utime(cache_file)
+
+	except OSError:
+
+		pass
+
+	return vep_df
+
+
+def write_variant_cache(cache_dir, key, vep_df, max_size):
+	"""
+	Write the filtered variants for a key to the cache as Parquet and then remove the least recently \
+	used entries until the cache is no bigger than max_size bytes.
+
+	Returns the cache file or None if the variants can't be stored as Parquet, in which case they are not cached.
+
+	"""
+
+	os.makedirs(cache_dir, exist_ok=True)
+
+	cache_file = os.path.join(cache_dir, f'{key}.parquet')
+
+	# Write to a temporary file first so other runs never see half written files
+	temp_file, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+
+	try:
+
+		try:
+
+			with os.fdopen(temp_file, 'wb') as f:
+
+				vep_df.to_parquet(f)
+
+		# Some object columns e.g. ones with mixed types can't be stored as Parquet
+		except (TypeError, ValueError, NotImplementedError, ImportError):
+
+			os.remove(temp_path)
+
+			return None
+
+		# mkstemp only gives the owner access - let other users share the cache
+		os.chmod(temp_path, 0o644)
+
+		os.replace(temp_path, cache_file)
+
+	except:
+
+		if os.path.exists(temp_path):
+
+			os.remove(temp_path)
+
+		raise
+
+	evict_variant_cache(cache_dir, max_size, keep=cache_file)
+
+	return cache_file
+
+
+def evict_variant_cache(cache_dir, max_size, keep=None):
+	"""
+	Remove the least recently used entries until the cache is no bigger than max_size bytes.
+
+	The keep file is never removed.
+
+	Returns the number of entries removed.
+
+	"""
+
+	entries = []
+
+	for filename in os.listdir(cache_dir):
+
+		# Pickles were written by older versions - they are never read but still take up space
+		if not filename.endswith(('.parquet', '.pickle')):
+
+			continue
+
+		cache_file = os.path.join(cache_dir, filename)
+
+		try:
+
+			file_stat = os.stat(cache_file)
+
+		except OSError:
+
+			continue
+
+		entries.append((file_stat.st_mtime, file_stat.st_size, cache_file))
+
+	total_size = sum(entry[1] for entry in entries)
+
+	removed = 0
+
+	for mtime, size, cache_file in sorted(entries):
+
+		if total_size <= max_size:
+
+			break
+
+		if keep != None and os.path.abspath(cache_file) == os.path.abspath(keep):
+
+			continue
+
+		try:
+
+			os.remove(cache_file)
+
+		except OSError:
+
+			continue
+
+		total_size = total_size - size
+		removed = removed + 1
+
+	return removed
+
+
+def get_sample_record_file(results_dir, sample):
+	"""
+	Where the record of the key for a sample output is kept.
+
+	"""
+
+	return os.path.join(results_dir, f'.{sample}.key')
+
+
+def is_sample_output_current(results_dir, sample, key):
+	"""
+	Whether the sample output exists and was made from inputs with the same key.
+
+	"""
+
+	output_file = os.path.join(results_dir, f'{sample}.csv')
+
+	# Samples without variants get a blank file which is rewritten every run
+	if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
+
+		return False
+
+	try:
+
+		with open(get_sample_record_file(results_dir, sample)) as f:
+
+			return f.read().strip() == key
+
+	except OSError:
+
+		return False
+
+
+def write_sample_record(results_dir, sample, key):
+	"""
+	Record the key of the inputs used to make a sample output.
+
+	"""
+
+	with open(get_sample_record_file(results_dir, sample), 'w') as f:
+
+		f.write(key + '\n')